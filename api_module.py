@@ -1,15 +1,48 @@
 # TODO: Implement saving and caching also merge audio genration
 
-from pathlib import Path
+import asyncio
 import threading
-from typing import Any, Dict, List, Optional, Type, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Type,
+    Tuple,
+    Union,
+)
+import aiohttp
 from pydantic import BaseModel, Field, ValidationError
 from dataclasses import dataclass
 import json
 import uuid
 
-from reader_new import Book, Chunk, BookState
+from reader_new import BOOK_LAZY, BOOK_WORKERS, Book, Chunk, BookState, Stage, open_book
 from audio_module import Audio, AudioLoop, AudioTest, AudioTestLoop
+from scheduler_module import (
+    AsyncStageScheduler,
+    BaseStageScheduler,
+    StageScheduler,
+    chunk_key,
+    run_workers,
+)
+from ratelimit_module import RateLimiter, get_limiter, retry_metrics
+from budget_module import TokenBudget
+from context_module import RollingContext
+from cache_module import cache_key, get_cache
+from cassette_module import chat_key, get_cassette, image_key, recorded, recording
+from repair_module import repair_json, repair_metrics
+from stream_module import CompletionStream
+from provider_module import (
+    detect_provider,
+    get_output_mode,
+    response_format,
+    supported_modes,
+)
+from state_module import get_store
 from logger_module import logger
 import requests
 import time
@@ -18,6 +51,7 @@ from prompts import (
     SUMMARY_ROLE,
     SUMMARY_VALIDATION_RESOLVE_ROLE,
     PROMPT_ROLE,
+    PROMPT_BATCH_ROLE,
     PROMPT_VALIDATION_RESOLVE_ROLE,
     STYLE_TAG,
 )
@@ -28,6 +62,14 @@ from dotenv import load_dotenv
 load_dotenv()
 summary_role = ""
 
+# Stream summaries, so the stages that only need the summary text start before the rest is generated
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
+
+# Input tokens of chunks packed into one prompt request, 0 sends one chunk per request
+PROMPT_BATCH_TOKENS = int(os.getenv("PROMPT_BATCH_TOKENS", 0))
+# Most chunks in one prompt request, so their prompts fit max_completion_tokens
+PROMPT_BATCH_SIZE = int(os.getenv("PROMPT_BATCH_SIZE", 4))
+
 
 ## HeadersSchema
 class HeadersSchema(BaseModel):
@@ -54,7 +96,7 @@ class SummaryPayloadSchema(BaseModel):
     temperature: float
     stream: bool
     max_completion_tokens: int = 2048
-    response_format: Dict[str, str] = {"type": "json_object"}
+    response_format: Optional[Dict[str, Any]] = {"type": "json_object"}
     top_p: float = 0.8
     frequency_penalty: float = 1.0
     presence_penalty: float = 1.5
@@ -84,7 +126,7 @@ class PromptPayloadSchema(BaseModel):
     temperature: float
     stream: bool
     max_completion_tokens: int = 2048
-    response_format: Dict[str, str] = {"type": "json_object"}
+    response_format: Optional[Dict[str, Any]] = {"type": "json_object"}
     top_p: float = 0.8
     frequency_penalty: float = 1.0
     presence_penalty: float = 1.5
@@ -105,6 +147,18 @@ class PromptContentSchema(BaseModel):
     places_list: Dict[str, str]
 
 
+class PromptBatchItemSchema(PromptContentSchema):
+    id: str
+
+
+class PromptBatchContentSchema(BaseModel):
+    chunks: List[PromptBatchItemSchema]
+
+
+class PromptBatchResponseSchema(BaseModel):
+    prompts: List[PromptOutputSchema]
+
+
 ##Image Schemas
 
 
@@ -147,98 +201,259 @@ class ImageResponseSchema(BaseModel):
     data: List[ImageItem]
 
 
-# SUMMARY###############################################################################################################################################################################
-@dataclass
-class Summary:
+def load_json(raw_data: str) -> Tuple[Any, bool]:
+    """The JSON value of `raw_data` and whether it had to be repaired"""
+    try:
+        return json.loads(raw_data), False
+    except JSONDecodeError:
+        # Fixed locally when possible, instead of a repair round-trip to the model
+        return repair_json(raw_data), True
+
+
+def holds_to(raw_data: str, schema: Type[BaseModel]) -> bool:
+    try:
+        schema.model_validate(load_json(raw_data)[0])
+    except ValidationError:
+        return False
+    return True
+
+
+# Chat #################################################################################################################################################################################
+class ChatHandler:
+    """
+    Request logic shared by the Groq chat handlers (Summary, Prompt).
+
+    `get` is the blocking call used by the threaded loops, `aget` is the same
+    call over aiohttp for the asyncio engine. Both answer from the on-disk
+    ResponseCache when the same request was made before, and otherwise go
+    through the RateLimiter shared by every handler on the same API key and
+    host, unless the handler is given its own `limiter`.
+    `get_messages` keeps requests inside the model's context window through
+    the handler's TokenBudget. Responses are held to `response_schema` with
+    the strictest structured output mode the provider supports for the model.
+    With `stream`, the response is read as it is generated and `on_field` gets
+    each top-level string field of it as soon as that field is complete.
+    """
+
+    tag: ClassVar[str] = "[Chat]"
+    payload_schema: ClassVar[Type[BaseModel]]
+    response_schema: ClassVar[Type[BaseModel]]
+
     api_key: str
-    url: str = "https://api.groq.com/openai/v1/chat/completions"
-    role: str = f"{SUMMARY_ROLE} follow given schema: {SummaryResponseSchema.model_json_schema()}"
-    validation_role: str = f"{SUMMARY_VALIDATION_RESOLVE_ROLE} Schema :{SummaryResponseSchema.model_json_schema()}"
-    model: str = "llama-3.1-8b-instant"
-    temperature: float = 0.4
-    stream: bool = False
-    repetition_penalty: float = 1.5
-    max_tokens: int = 6000
+    url: str
+    model: str
+    temperature: float
+    stream: bool
+    limiter: Optional[RateLimiter]
 
     def __post_init__(self):
         self.headers = HeadersSchema.create(api_key=self.api_key).model_dump(
             by_alias=True
         )
         self.session = requests.Session()
+        self.async_session: Optional[aiohttp.ClientSession] = None
+        if self.limiter is None:
+            self.limiter = get_limiter(self.api_key, self.url)
+        self.cache = get_cache()
+        self.budget = TokenBudget(
+            model=self.model,
+            max_completion_tokens=self.payload_schema.model_fields[
+                "max_completion_tokens"
+            ].default,
+        )
+        self.provider = detect_provider(self.url)
+        self.output_mode = get_output_mode(
+            self.provider, self.model, self.response_schema
+        )
+        logger.debug(
+            f"{self.tag} : {self.provider} output mode {self.output_mode.value}"
+        )
 
-    def get_messages(
+    def get_payload(
         self,
-        content: str,
-        previous_summary: str,
-        characters: Dict[str, str],
-        places: Dict[str, str],
-    ) -> List[MessageSchema]:
-        return [
-            MessageSchema(role="system", content=self.role),
-            MessageSchema(
-                role="user",
-                content=SummaryContentSchema(
-                    past_context=previous_summary,
-                    current_chapter=content,
-                    character_list=characters,
-                    places_list=places,
-                ).model_dump_json(by_alias=True),
+        messages: List[MessageSchema],
+        response_schema: Optional[Type[BaseModel]] = None,
+    ) -> dict:
+        return self.payload_schema(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=self.stream,
+            response_format=response_format(
+                self.output_mode, response_schema or self.response_schema
             ),
-        ]
+        ).model_dump(by_alias=True, exclude_none=True)
 
-    def validation_messages(self, input_text: str) -> List[MessageSchema]:
-        return [
-            MessageSchema(role="system", content=self.validation_role),
-            MessageSchema(
-                role="user",
-                content=input_text,
-            ),
-        ]
+    def downgrade(self) -> bool:
+        """Falls back to the next stricter-to-looser output mode, False if there is none"""
+        modes = supported_modes(self.provider, self.model)
+        position = modes.index(self.output_mode) if self.output_mode in modes else -1
+        if position + 1 >= len(modes):
+            return False
+        logger.warning(
+            f"{self.tag} : {self.model} rejected {self.output_mode.value}, using {modes[position + 1].value}"
+        )
+        self.output_mode = modes[position + 1]
+        return True
+
+    def read_cache(
+        self, messages: List[MessageSchema], schema: Type[BaseModel]
+    ) -> Tuple[str, Optional[str]]:
+        """Returns the request's cache key and its cached content, if any holds to `schema`"""
+        key = cache_key(self.url, self.model, self.temperature, messages)
+        if self.cache is None or recording():
+            # A recorded call has to reach the provider to record its latency
+            return key, None
+        content = self.cache.get(key)
+        if content is not None and not holds_to(content, schema):
+            # Cached before responses were validated, asked again instead
+            logger.warning(f"{self.tag} : Ignoring invalid cached {key[:12]}")
+            return key, None
+        if content is not None:
+            logger.trace(f"{self.tag} : Cache hit {key[:12]}")
+        return key, content
+
+    def write_cache(
+        self, key: str, output: Tuple[int, str], schema: Type[BaseModel]
+    ) -> None:
+        """
+        Caches a 200 response that holds to `schema`. Any other is left out, a
+        retry of the request would read it back and fail the same way
+        """
+        code, content = output
+        if self.cache is None or code != 200:
+            return
+        if not holds_to(content, schema):
+            logger.trace(f"{self.tag} : Not caching invalid {key[:12]}")
+            return
+        self.cache.put(key, content)
+
+    def count_retry(self, reason: str, attempt: int, max_retries: int) -> None:
+        if attempt < max_retries:
+            retry_metrics.record(self.tag, reason)
+
+    def estimate_tokens(self, messages: List[MessageSchema]) -> int:
+        return self.budget.count(messages)
+
+    def reserved_tokens(self, tokens: int) -> int:
+        """Tokens a request of `tokens` input tokens may use, as rate limits count them"""
+        return tokens + self.budget.max_completion_tokens
+
+    def track_usage(
+        self,
+        code: int,
+        headers: Mapping[str, str],
+        response_data: Optional[dict],
+        tokens: int,
+    ) -> None:
+        self.limiter.update(code, headers)
+        if code == 200 and response_data:
+            usage = response_data.get("usage") or {}
+            self.limiter.settle(self.reserved_tokens(tokens), usage.get("total_tokens"))
+            self.budget.record(tokens, usage.get("prompt_tokens"))
+
+    def read_response(
+        self, code: int, response_data: Optional[dict], attempt: int, max_retries: int
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Maps a chat completion response to (status_code, content).
+        Returns None when the call should be retried.
+        """
+        if code == 200:
+            if response_data is None:
+                logger.warning(
+                    f"{self.tag} : Unreadable response, retrying {attempt}/{max_retries}..."
+                )
+                self.count_retry("unreadable", attempt, max_retries)
+                return None
+            assistant_message = response_data["choices"][0]["message"]["content"]
+            usage = response_data.get("usage", {})
+            logger.info(
+                f"{self.tag} : 200 : Input_Tokens={usage.get('prompt_tokens')} | Output_Tokens={usage.get('completion_tokens')}  | Time={usage.get('total_time')}"
+            )
+            return code, assistant_message
+
+        elif code == 429:  # The limiter already holds the next try back
+            logger.warning(
+                f"{self.tag} : Rate limited, retrying {attempt}/{max_retries}..."
+            )
+            self.count_retry(str(code), attempt, max_retries)
+            return None
+
+        elif code in [500, 502, 503, 504]:  # Retry for server errors
+            logger.warning(
+                f"{self.tag} : Server error ({code}), retrying {attempt}/{max_retries}..."
+            )
+            self.count_retry(str(code), attempt, max_retries)
+            return None
 
+        try:
+            error = (response_data or {}).get("error", {})
+            if error.get("code") == "json_validate_failed":
+                return 422, error["failed_generation"]
+            if (
+                code == 400
+                and "response format"
+                in str(error.get("message", "")).replace("_", " ").lower()
+                and self.downgrade()
+            ):
+                self.count_retry(str(code), attempt, max_retries)
+                return None
+        except Exception as e:
+            logger.warning(f"{self.tag} : Error parsing API response: {e}")
+        return code, "ERROR_API_CALL"
+
+    @recorded("chat", chat_key)
     def get(
         self,
         messages: List[MessageSchema],
         max_retries=3,
+        response_schema: Optional[Type[BaseModel]] = None,
+        on_field: Optional[Callable[[str, str], None]] = None,
     ) -> Tuple[int, str]:
-        payload = SummaryPayloadSchema(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            stream=self.stream,
-        ).model_dump(by_alias=True)
+        schema = response_schema or self.response_schema
+        key, cached = self.read_cache(messages, schema)
+        if cached is not None:
+            return 200, cached
+        payload = self.get_payload(messages, response_schema)
+        tokens = self.estimate_tokens(messages)
+        rate_limited = False
 
         for attempt in range(1, max_retries + 1):
+            self.limiter.acquire(self.reserved_tokens(tokens))
+            rate_limited = False
             try:
                 response = self.session.post(
-                    url=self.url, headers=self.headers, json=payload, timeout=10
+                    url=self.url,
+                    headers=self.headers,
+                    json=payload,
+                    timeout=10,
+                    stream=self.stream,
                 )
-
-                code = response.status_code
-                if code == 200:
-                    response_data = response.json()
-                    assistant_message = response_data["choices"][0]["message"][
-                        "content"
-                    ]
-                    logger.info(
-                        f"[Summary] 200 : Input_Tokens={response_data['usage']['prompt_tokens']} | Output_Tokens={response_data['usage']['completion_tokens']}  | Time={response_data['usage']['total_time']}"
-                    )
-                    return code, assistant_message
-
-                elif code in [500, 502, 503, 504]:  # Retry for server errors
-                    logger.warning(
-                        f"[Summary] Server error ({code}), retrying {attempt}/{max_retries}..."
-                    )
-
+                if self.stream and response.status_code == 200:
+                    stream = CompletionStream(on_field=on_field)
+                    for line in response.iter_lines(decode_unicode=True):
+                        stream.feed_line(line)
+                    response_data = stream.response_data()
                 else:
                     try:
-                        if (
-                            response.json().get("error", {}).get("code")
-                            == "json_validate_failed"
-                        ):
-                            return 422, response.json()["error"]["failed_generation"]
-                    except Exception as e:
-                        logger.warning(f"[Summary] Error parsing API response: {e}")
-                    return code, "ERROR_API_CALL"
+                        response_data = response.json()
+                    except ValueError:
+                        response_data = None
+                self.track_usage(
+                    response.status_code, response.headers, response_data, tokens
+                )
+                output = self.read_response(
+                    response.status_code, response_data, attempt, max_retries
+                )
+                if output:
+                    self.write_cache(key, output, schema)
+                    return output
+                if response.status_code == 400:  # The output mode was downgraded
+                    payload = self.get_payload(messages, response_schema)
+                rate_limited = response.status_code == 429
+                if response.status_code in [400, 429]:
+                    continue
 
             except (
                 requests.ConnectionError,
@@ -246,16 +461,91 @@ class Summary:
                 requests.exceptions.RequestException,
             ) as e:
                 logger.warning(
-                    f"[Summary] Connection error: {e}, retrying {attempt}/{max_retries}..."
+                    f"{self.tag} : Connection error: {e}, retrying {attempt}/{max_retries}..."
                 )
+                self.count_retry("connection", attempt, max_retries)
 
             time.sleep(2**attempt)  # Exponential backoff: 2s, 4s, 8s
 
+        if rate_limited:
+            # Not an answer, callers leave the chunk for a later run
+            return 429, "ERROR_RATE_LIMITED"
         return 500, "ERROR_MAX_RETRIES"
 
+    def get_async_session(self) -> aiohttp.ClientSession:
+        if self.async_session is None or self.async_session.closed:
+            self.async_session = aiohttp.ClientSession(
+                headers=self.headers, timeout=aiohttp.ClientTimeout(total=10)
+            )
+        return self.async_session
+
+    @recorded("chat", chat_key)
+    async def aget(
+        self,
+        messages: List[MessageSchema],
+        max_retries=3,
+        response_schema: Optional[Type[BaseModel]] = None,
+        on_field: Optional[Callable[[str, str], None]] = None,
+    ) -> Tuple[int, str]:
+        schema = response_schema or self.response_schema
+        key, cached = self.read_cache(messages, schema)
+        if cached is not None:
+            return 200, cached
+        payload = self.get_payload(messages, response_schema)
+        tokens = self.estimate_tokens(messages)
+        session = self.get_async_session()
+        rate_limited = False
+
+        for attempt in range(1, max_retries + 1):
+            await self.limiter.aacquire(self.reserved_tokens(tokens))
+            rate_limited = False
+            try:
+                async with session.post(url=self.url, json=payload) as response:
+                    if self.stream and response.status == 200:
+                        stream = CompletionStream(on_field=on_field)
+                        async for line in response.content:
+                            stream.feed_line(line.decode("utf-8"))
+                        response_data = stream.response_data()
+                    else:
+                        try:
+                            response_data = await response.json(content_type=None)
+                        except ValueError:
+                            response_data = None
+                    self.track_usage(
+                        response.status, response.headers, response_data, tokens
+                    )
+                    output = self.read_response(
+                        response.status, response_data, attempt, max_retries
+                    )
+                if output:
+                    self.write_cache(key, output, schema)
+                    return output
+                if response.status == 400:  # The output mode was downgraded
+                    payload = self.get_payload(messages, response_schema)
+                rate_limited = response.status == 429
+                if response.status in [400, 429]:
+                    continue
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(
+                    f"{self.tag} : Connection error: {e}, retrying {attempt}/{max_retries}..."
+                )
+                self.count_retry("connection", attempt, max_retries)
+
+            await asyncio.sleep(2**attempt)  # Exponential backoff: 2s, 4s, 8s
+
+        if rate_limited:
+            # Not an answer, callers leave the chunk for a later run
+            return 429, "ERROR_RATE_LIMITED"
+        return 500, "ERROR_MAX_RETRIES"
+
+    async def aclose(self) -> None:
+        if self.async_session and not self.async_session.closed:
+            await self.async_session.close()
+
     def validate_json(
-        self, raw_data: str, schema: Type[SummaryResponseSchema]
-    ) -> Union[SummaryResponseSchema, bool]:
+        self, raw_data: str, schema: Type[BaseModel]
+    ) -> Union[BaseModel, bool]:
         """
         Validates JSON data against a provided Pydantic schema.
 
@@ -264,13 +554,123 @@ class Summary:
         :return: A tuple where the first element is a boolean indicating if there was an error,
                  and the second element is either the validated data or a list of error details.
         """
+        parsed_data, repaired = load_json(raw_data)
+        outcome = "repaired" if repaired else "valid"
         try:
-            parsed_data = json.loads(raw_data)
             validated_data = schema.model_validate(parsed_data)
-            return validated_data
-        except (ValidationError, JSONDecodeError):
-            logger.warning("[Summary] ValidationError")
+        except ValidationError:
+            repair_metrics.record(
+                f"{schema.__name__}:{self.output_mode.value}", "failed"
+            )
+            logger.warning(f"{self.tag} : ValidationError")
             return False
+        repair_metrics.record(f"{schema.__name__}:{self.output_mode.value}", outcome)
+        return validated_data
+
+
+# SUMMARY###############################################################################################################################################################################
+@dataclass
+class Summary(ChatHandler):
+    tag: ClassVar[str] = "[Summary]"
+    payload_schema: ClassVar[Type[BaseModel]] = SummaryPayloadSchema
+    response_schema: ClassVar[Type[BaseModel]] = SummaryResponseSchema
+
+    api_key: str
+    url: str = "https://api.groq.com/openai/v1/chat/completions"
+    role: str = f"{SUMMARY_ROLE} follow given schema: {SummaryResponseSchema.model_json_schema()}"
+    validation_role: str = f"{SUMMARY_VALIDATION_RESOLVE_ROLE} Schema :{SummaryResponseSchema.model_json_schema()}"
+    model: str = "llama-3.1-8b-instant"
+    temperature: float = 0.4
+    stream: bool = LLM_STREAM
+    repetition_penalty: float = 1.5
+    max_tokens: int = 6000
+    limiter: Optional[RateLimiter] = None
+
+    def get_messages(
+        self,
+        content: str,
+        previous_summary: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+    ) -> List[MessageSchema]:
+        return self.budget.fit(
+            lambda previous_summary, characters, places: self.build_messages(
+                content, previous_summary, characters, places
+            ),
+            previous_summary,
+            characters,
+            places,
+        )
+
+    def build_messages(
+        self,
+        content: str,
+        previous_summary: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+    ) -> List[MessageSchema]:
+        return [
+            MessageSchema(role="system", content=self.role),
+            MessageSchema(
+                role="user",
+                content=SummaryContentSchema(
+                    past_context=previous_summary,
+                    current_chapter=content,
+                    character_list=characters,
+                    places_list=places,
+                ).model_dump_json(by_alias=True),
+            ),
+        ]
+
+    def validation_messages(self, input_text: str) -> List[MessageSchema]:
+        return [
+            MessageSchema(role="system", content=self.validation_role),
+            MessageSchema(
+                role="user",
+                content=input_text,
+            ),
+        ]
+
+
+def stream_summary(
+    chunk: Chunk, characters: Dict[str, str], places: Dict[str, str]
+) -> Callable[[str, str], None]:
+    """
+    `on_field` of a streamed summary request: hands the summary text to the
+    chunk as soon as it is generated, with the characters/places sent along
+    with the request standing in until the full response is in
+    """
+
+    def on_field(name: str, value: str) -> None:
+        # Dependents start on the first text streamed, a retried request keeps it
+        if name == "summary" and value and not chunk.summary:
+            chunk.set_streamed_sum(value, characters, places)
+
+    return on_field
+
+
+def keep_streamed(
+    chunk: Chunk,
+    output: Optional[SummaryResponseSchema],
+    characters: Dict[str, str],
+    places: Dict[str, str],
+) -> Optional[SummaryResponseSchema]:
+    """
+    The summary to save for `chunk` once its request is over. Prompt and audio
+    may already have started on a streamed summary text, so that text is kept,
+    even if the full response then failed validation or was repaired into
+    another summary
+    """
+    if not chunk.summary:
+        return output
+    if output is None:
+        logger.warning(
+            f"[Summary] : Keeping the streamed summary of {chunk.chapter_id}/{chunk.chunk_id}"
+        )
+        return SummaryResponseSchema(
+            summary=chunk.summary, characters=characters, places=places
+        )
+    return output.model_copy(update={"summary": chunk.summary})
 
 
 @dataclass
@@ -278,6 +678,7 @@ class SummaryLoop:
     book: Book
     summary_handler: Summary
     init_chunk: Optional[Chunk] = None
+    scheduler: Optional[BaseStageScheduler] = None
 
     def __post_init__(self) -> None:
         self.init_chunk = Chunk(
@@ -291,57 +692,69 @@ class SummaryLoop:
 
     def run(self) -> None:
         """
-        Assuming book comes in the form of ((id,title_chapter,chapter_content),..)
+        Summarizes the chunks in book order, each one with the context carried
+        over from the chunks before it, bounded by a RollingContext. A chunk
+        still rate limited stops the chain, it and the chunks after it are left
+        pending for the next run
         """
-        past_context = self.init_chunk
-        assert past_context
-        for chunk in self.book.get_chunks():
-            if chunk.summary:
-                continue
-            message = self.summary_handler.get_messages(
-                content=chunk.chunk,
-                previous_summary=past_context.summary,
-                characters=past_context.characters,
-                places=past_context.places,
-            )
-            status_code, response = self.summary_handler.get(messages=message)
-
-            if status_code == 200:
-                validated_response = self.summary_handler.validate_json(
-                    response, SummaryResponseSchema
-                )
+        assert self.init_chunk
+        context = RollingContext(
+            budget=self.summary_handler.budget, summary=self.init_chunk.summary
+        )
+        for chunk in self.book.iter_chunks():
+            if not chunk.summary and not self.summarize(chunk, context):
+                break
+            context.update(chunk.chunk, chunk.summary, chunk.characters, chunk.places)
+
+        if self.scheduler:
+            self.scheduler.finish(Stage.SUMMARY)
+
+    def summarize(self, chunk: Chunk, context: RollingContext) -> bool:
+        """Summarizes `chunk`, False if it is left pending"""
+        previous_summary, characters, places = context.for_chunk(chunk.chunk)
+        message = self.summary_handler.get_messages(
+            content=chunk.chunk,
+            previous_summary=previous_summary,
+            characters=characters,
+            places=places,
+        )
+        status_code, response = self.summary_handler.get(
+            messages=message,
+            on_field=stream_summary(chunk, characters, places),
+        )
 
-                if isinstance(validated_response, SummaryResponseSchema):
-                    logger.trace(f"[Summary] : Chunk_{chunk.chunk_id=} Done")
-                    chunk.set_sum(
-                        summary=validated_response.summary,
-                        characters=validated_response.characters,
-                        places=validated_response.places,
-                    )
-                    continue
-                else:
-                    output = self.handle_validation_error(response)
-                    if output:
-                        past_context = output
-            elif status_code == 422:
-                output = self.handle_validation_error(response)
-                if output:
-                    past_context = output
-                else:
-                    chunk.set_sum(
-                        summary=past_context.summary,
-                        characters=past_context.characters,
-                        places=past_context.places,
-                    )
+        output = None
+        # A 422 carries the generation that failed Groq's JSON check, it may still be repairable
+        if status_code in [200, 422]:
+            output = self.summary_handler.validate_json(response, SummaryResponseSchema)
+            if isinstance(output, SummaryResponseSchema):
+                logger.trace(f"[Summary] : Chunk_{chunk.chunk_id=} Done")
             else:
-                chunk.set_sum(
-                    summary=past_context.summary,
-                    characters=past_context.characters,
-                    places=past_context.places,
-                )
+                output = self.handle_validation_error(response)
+        output = keep_streamed(chunk, output, characters, places)
 
-            past_context = chunk
-            logger.warning(f"[Summary] : {status_code=} error getting{id=}")
+        if output:
+            chunk.set_sum(
+                summary=output.summary,
+                characters=output.characters,
+                places=output.places,
+            )
+            return True
+        if status_code == 429:
+            logger.warning(
+                f"[Summary] : Still rate limited, leaving {chunk.chapter_id}/{chunk.chunk_id} pending"
+            )
+            return False
+        logger.warning(
+            f"[Summary] : {status_code=} error getting {chunk.chapter_id}/{chunk.chunk_id}"
+        )
+        # Carry the previous context over, so the chain and later stages go on
+        chunk.set_sum(
+            summary=context.summary,
+            characters=characters,
+            places=places,
+        )
+        return True
 
     def handle_validation_error(self, input_text):
         message = self.summary_handler.validation_messages(input_text)
@@ -349,7 +762,7 @@ class SummaryLoop:
             status_code, response = self.summary_handler.get(messages=message)
             if status_code == 200:
                 validated_response = self.summary_handler.validate_json(
-                    response, SummaryOutputSchema
+                    response, SummaryResponseSchema
                 )
                 if validated_response:
                     logger.info("[Summary] : Validation error resolved")
@@ -367,26 +780,41 @@ class SummaryLoop:
 
 # Prompt ###############################################################################################################################################################################
 @dataclass
-class Prompt:
+class Prompt(ChatHandler):
+    tag: ClassVar[str] = "[Prompt]"
+    payload_schema: ClassVar[Type[BaseModel]] = PromptPayloadSchema
+    response_schema: ClassVar[Type[BaseModel]] = PromptResponseSchema
+
     api_key: str
     url: str = "https://api.groq.com/openai/v1/chat/completions"
     role: str = (
         f"{PROMPT_ROLE} follow given schema: {PromptResponseSchema.model_json_schema()}"
     )
     validation_role: str = f"{PROMPT_VALIDATION_RESOLVE_ROLE} Schema :{PromptResponseSchema.model_json_schema()}"
+    batch_role: str = f"{PROMPT_BATCH_ROLE} follow given schema: {PromptBatchResponseSchema.model_json_schema()}"
     model: str = "llama-3.1-8b-instant"
     temperature: float = 0.4
     stream: bool = False
     repetition_penalty: float = 1.5
     max_tokens: int = 6000
+    limiter: Optional[RateLimiter] = None
 
-    def __post_init__(self):
-        self.headers = HeadersSchema.create(api_key=self.api_key).model_dump(
-            by_alias=True
+    def get_messages(
+        self,
+        input_text: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+    ) -> List[MessageSchema]:
+        return self.budget.fit(
+            lambda _, characters, places: self.build_messages(
+                input_text, characters, places
+            ),
+            "",
+            characters,
+            places,
         )
-        self.session = requests.Session()
 
-    def get_messages(
+    def build_messages(
         self,
         input_text: str,
         characters: Dict[str, str],
@@ -413,138 +841,205 @@ class Prompt:
             ),
         ]
 
-    def get(
-        self,
-        messages: List[MessageSchema],
-        max_retries=3,
-    ) -> Tuple[int, str]:
-        payload = PromptPayloadSchema(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            stream=self.stream,
-        ).model_dump(by_alias=True)
-
-        for attempt in range(1, max_retries + 1):
-            try:
-                response = self.session.post(
-                    url=self.url, headers=self.headers, json=payload, timeout=10
-                )
+    def get_batch_messages(
+        self, items: List[PromptBatchItemSchema]
+    ) -> List[MessageSchema]:
+        return [
+            MessageSchema(role="system", content=self.batch_role),
+            MessageSchema(
+                role="user",
+                content=PromptBatchContentSchema(chunks=items).model_dump_json(
+                    by_alias=True
+                ),
+            ),
+        ]
 
-                code = response.status_code
-                if code == 200:
-                    response_data = response.json()
-                    assistant_message = response_data["choices"][0]["message"][
-                        "content"
-                    ]
-                    logger.info(
-                        f"[Prompt] : 200 : Input_Tokens={response_data['usage']['prompt_tokens']} | Output_Tokens={response_data['usage']['completion_tokens']}  | Time={response_data['usage']['total_time']}"
-                    )
-                    return code, assistant_message
 
-                elif code in [500, 502, 503, 504]:  # Retry for server errors
-                    logger.warning(
-                        f"[Prompt] : Server error ({code}), retrying {attempt}/{max_retries}..."
-                    )
+class PromptLoop(BaseModel):
+    book: Book
+    prompt_handler: Prompt
+    scheduler: BaseStageScheduler
+    concurrency: int = 4
+    batch_tokens: int = PROMPT_BATCH_TOKENS
+    batch_size: int = PROMPT_BATCH_SIZE
 
-                else:
-                    try:
-                        if (
-                            response.json().get("error", {}).get("code")
-                            == "json_validate_failed"
-                        ):
-                            return 422, response.json()["error"]["failed_generation"]
-                    except Exception as e:
-                        logger.warning(f"[Prompt] : Error parsing API response: {e}")
-                return code, "ERROR_API_CALL"
+    def run(self) -> None:
+        """
+        Takes chunks from the scheduler as soon as their summary is done, in
+        `concurrency` worker threads. With `batch_tokens`, the chunks already
+        waiting are packed into the same request, up to `batch_tokens` input
+        tokens and `batch_size` chunks
+        """
+        run_workers(self.worker, self.concurrency)
+        logger.info("[Prompt] : Prompts Done for ALL Chunks")
 
-            except (
-                requests.ConnectionError,
-                requests.Timeout,
-                requests.exceptions.RequestException,
-            ) as e:
-                logger.warning(
-                    f"[Prompt] : Connection error: {e}, retrying {attempt}/{max_retries}..."
+    def worker(self) -> None:
+        assert isinstance(self.scheduler, StageScheduler)
+        while True:
+            chunk = self.scheduler.get(Stage.PROMPT)
+            if chunk is None:
+                break
+            chunks = self.fill_batch(chunk)
+            if len(chunks) > 1:
+                status_code, response = self.prompt_handler.get(
+                    messages=self.get_batch_messages(chunks),
+                    response_schema=PromptBatchResponseSchema,
                 )
+                self.handle_batch_response(chunks, status_code, response)
+                continue
+            status_code, response = self.prompt_handler.get(
+                messages=self.get_messages(chunk)
+            )
+            self.handle_response(chunk, status_code, response)
 
-            time.sleep(2**attempt)  # Exponential backoff: 2s, 4s, 8s
-
-        return 500, "ERROR_MAX_RETRIES"
-
-    def validate_json(
-        self, raw_data: str, schema: Type[PromptResponseSchema]
-    ) -> Union[PromptResponseSchema, bool]:
+    async def arun(self) -> None:
         """
-        Validates JSON data against a provided Pydantic schema.
-
-        :param data: JSON string to be validated.
-        :param schema: A Pydantic model class to validate against.
-        :return: A tuple where the first element is a boolean indicating if there was an error,
-                 and the second element is either the validated data or a list of error details.
+        asyncio version of `run`, keeps up to `concurrency` calls in flight
         """
-        try:
-            parsed_data = json.loads(raw_data)
-            validated_data = schema.model_validate(parsed_data)
-            return validated_data
-        except (ValidationError, JSONDecodeError):
-            logger.warning("[Prompt] : ValidationError")
-            return False
-
+        await asyncio.gather(*(self.aworker() for _ in range(self.concurrency)))
+        logger.info("[Prompt] : Prompts Done for ALL Chunks")
 
-class PromptLoop(BaseModel):
-    book: Book
-    prompt_handler: Prompt
+    async def aworker(self) -> None:
+        assert isinstance(self.scheduler, AsyncStageScheduler)
+        while True:
+            chunk = await self.scheduler.aget(Stage.PROMPT)
+            if chunk is None:
+                break
+            chunks = self.fill_batch(chunk)
+            if len(chunks) > 1:
+                status_code, response = await self.prompt_handler.aget(
+                    messages=self.get_batch_messages(chunks),
+                    response_schema=PromptBatchResponseSchema,
+                )
+                # set_prompt saves the chunk state, keep it off the event loop
+                await asyncio.to_thread(
+                    self.handle_batch_response, chunks, status_code, response
+                )
+                continue
+            status_code, response = await self.prompt_handler.aget(
+                messages=self.get_messages(chunk)
+            )
+            await asyncio.to_thread(self.handle_response, chunk, status_code, response)
 
-    def run(self) -> None:
+    def fill_batch(self, chunk: Chunk) -> List[Chunk]:
         """
-        Assuming book comes in the form of ((id,title_chapter,chapter_content),..)
+        `chunk` plus the chunks already waiting for a prompt that fit in the
+        same request. Packed requests stay within the prompt handler's
+        TokenBudget too, a chunk that does not fit with any other goes alone
+        through `get_messages`, which trims its entities
         """
-        is_done = False
-        while not is_done:
-            for idx, chunk in enumerate(self.book.get_chunks()):
-                if chunk.prompt:
-                    continue
+        if not self.batch_tokens:
+            return [chunk]
+        budget = self.prompt_handler.budget
+        # The system message and schema of the request, without any chunk
+        overhead = budget.count(self.get_batch_messages([]))
+        limit = min(self.batch_tokens, budget.limit - overhead)
+        chunks = [chunk]
+        tokens = self.item_tokens(chunk)
+        while len(chunks) < self.batch_size:
+            waiting = self.scheduler.get_nowait(Stage.PROMPT)
+            if waiting is None:
+                break
+            waiting_tokens = self.item_tokens(waiting)
+            if tokens + waiting_tokens > limit:
+                # Opens the next request instead
+                self.scheduler.put(Stage.PROMPT, waiting)
+                break
+            chunks.append(waiting)
+            tokens += waiting_tokens
+        return chunks
+
+    def batch_item(self, chunk: Chunk) -> PromptBatchItemSchema:
+        return PromptBatchItemSchema(
+            id=chunk_key(chunk),
+            input_text=chunk.chunk,
+            character_list=chunk.characters,
+            places_list=chunk.places,
+        )
 
-                message = self.prompt_handler.get_messages(
-                    input_text=chunk.chunk,
-                    characters=chunk.characters,
-                    places=chunk.places,
-                )
+    def item_tokens(self, chunk: Chunk) -> int:
+        return self.prompt_handler.budget.count_text(
+            self.batch_item(chunk).model_dump_json()
+        )
 
-                status_code, response = self.prompt_handler.get(messages=message)
+    def get_batch_messages(self, chunks: List[Chunk]) -> List[MessageSchema]:
+        return self.prompt_handler.get_batch_messages(
+            [self.batch_item(chunk) for chunk in chunks]
+        )
 
-                if status_code == 200:
-                    validated_response = self.prompt_handler.validate_json(
-                        response, PromptResponseSchema
-                    )
+    def handle_batch_response(
+        self, chunks: List[Chunk], status_code: int, response: str
+    ) -> None:
+        prompts: Dict[str, PromptOutputSchema] = {}
+        if status_code in [200, 422]:
+            validated_response = self.prompt_handler.validate_json(
+                response, PromptBatchResponseSchema
+            )
+            if isinstance(validated_response, PromptBatchResponseSchema):
+                prompts = {
+                    item.id: item
+                    for item in validated_response.prompts
+                    if item.id and item.prompt
+                }
+
+        for chunk in chunks:
+            item = prompts.get(chunk_key(chunk))
+            if item:
+                logger.trace(f"[Prompt] : Chunk_{chunk.chunk_id=} Done")
+                chunk.set_prompt(scene_title=item.scene_title, prompt=item.prompt)
+                continue
+            logger.warning(
+                f"[Prompt] : {status_code=} no prompt for {chunk_key(chunk)} in batch of {len(chunks)}"
+            )
+            self.scheduler.retry(chunk, Stage.PROMPT)
 
-                    if isinstance(validated_response, PromptResponseSchema):
-                        logger.trace(f"[Prompt] : Chunk_{chunk.chunk_id=} Done")
-                        chunk.set_prompt(
-                            scene_title=validated_response.scene_title,
-                            prompt=validated_response.prompt,
-                        )
-                        continue
+    def get_messages(self, chunk: Chunk) -> List[MessageSchema]:
+        return self.prompt_handler.get_messages(
+            input_text=chunk.chunk,
+            characters=chunk.characters,
+            places=chunk.places,
+        )
 
-                logger.warning(f"[Prompt] : {status_code=} error getting{idx=}")
-            is_done = self.book.is_prompt_done()
-        logger.info("[Prompt] : Prompts Done for ALL Chunks")
+    def handle_response(self, chunk: Chunk, status_code: int, response: str) -> None:
+        # A 422 carries the generation that failed Groq's JSON check, it may still be repairable
+        if status_code in [200, 422]:
+            validated_response = self.prompt_handler.validate_json(
+                response, PromptResponseSchema
+            )
+            if not isinstance(validated_response, PromptResponseSchema):
+                validated_response = self.handle_validation_error(response)
+
+            if isinstance(validated_response, PromptResponseSchema):
+                logger.trace(f"[Prompt] : Chunk_{chunk.chunk_id=} Done")
+                chunk.set_prompt(
+                    scene_title=validated_response.scene_title,
+                    prompt=validated_response.prompt,
+                )
+                return
 
-    def handle_validation_error(self, input_text):
+        logger.warning(
+            f"[Prompt] : {status_code=} error getting {chunk.chapter_id}/{chunk.chunk_id}"
+        )
+        self.scheduler.retry(chunk, Stage.PROMPT)
+
+    def handle_validation_error(
+        self, input_text: str
+    ) -> Optional[PromptResponseSchema]:
+        """Asks the model to fix a response that failed validation, None if it could not"""
         message = self.prompt_handler.validation_messages(input_text)
         for idx in range(MAX_VALIDATION_ERROR_TRY):
             status_code, response = self.prompt_handler.get(messages=message)
             if status_code == 200:
                 validated_response = self.prompt_handler.validate_json(
-                    response, PromptOutputSchema
+                    response, PromptResponseSchema
                 )
-                if validated_response:
-                    logger.info("[Summary] : Validation error resolved")
+                if isinstance(validated_response, PromptResponseSchema):
+                    logger.info("[Prompt] : Validation error resolved")
                     return validated_response
             elif status_code == 422:
                 message = self.prompt_handler.validation_messages(response)
             logger.warning(f"[Prompt] : Validation Unresolved on try {idx + 1}")
-        logger.error("[Prompts] : COULDNT VALIDATE THE CHUNK, SKIPPING...")
+        logger.error("[Prompt] : COULDNT VALIDATE THE CHUNK, SKIPPING...")
         return None
 
     @property
@@ -564,7 +1059,9 @@ class Image:
             by_alias=True
         )
         self.session = requests.Session()
+        self.async_session: Optional[aiohttp.ClientSession] = None
 
+    @recorded("image", image_key)
     def get(self, payload, max_retries=3) -> Tuple[int, Optional[ImageResponseSchema]]:
         for attempt in range(1, max_retries + 1):
             try:
@@ -587,6 +1084,8 @@ class Image:
                     logger.warning(
                         f"[Image] : Server error ({code}), retrying {attempt}/{max_retries}..."
                     )
+                if attempt < max_retries:
+                    retry_metrics.record("[Image]", str(code))
 
             except (
                 requests.ConnectionError,
@@ -596,53 +1095,144 @@ class Image:
                 logger.warning(
                     f"[Image] : Connection error: {e}, retrying {attempt}/{max_retries}..."
                 )
+                if attempt < max_retries:
+                    retry_metrics.record("[Image]", "connection")
 
             time.sleep(2**attempt)  # Exponential backoff: 2s, 4s, 8s
 
         return 500, None
 
+    def get_async_session(self) -> aiohttp.ClientSession:
+        if self.async_session is None or self.async_session.closed:
+            self.async_session = aiohttp.ClientSession(
+                headers=self.headers, timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self.async_session
+
+    @recorded("image", image_key)
+    async def aget(
+        self, payload, max_retries=3
+    ) -> Tuple[int, Optional[ImageResponseSchema]]:
+        session = self.get_async_session()
+        for attempt in range(1, max_retries + 1):
+            try:
+                async with session.post(url=self.url, json=[payload]) as response:
+                    code = response.status
+                    logger.debug(f"status_code : {code}")
+                    if code == 200:
+                        response_data = await response.json(content_type=None)
+                        response_model = ImageResponseSchema.model_validate(
+                            response_data
+                        )
+                        logger.info(
+                            f"[Image] : 200 : | task={response_model.data[0].taskUUID} | cost = {response_model.data[0].cost}$ | NSFW = {response_model.data[0].NSFWContent}"
+                        )
+                        return code, response_model
+
+                    elif code in [500, 502, 503, 504]:  # Retry for server errors
+                        logger.warning(
+                            f"[Image] : Server error ({code}), retrying {attempt}/{max_retries}..."
+                        )
+                    if attempt < max_retries:
+                        retry_metrics.record("[Image]", str(code))
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning(
+                    f"[Image] : Connection error: {e}, retrying {attempt}/{max_retries}..."
+                )
+                if attempt < max_retries:
+                    retry_metrics.record("[Image]", "connection")
+
+            await asyncio.sleep(2**attempt)  # Exponential backoff: 2s, 4s, 8s
+
+        return 500, None
+
+    async def aclose(self) -> None:
+        if self.async_session and not self.async_session.closed:
+            await self.async_session.close()
+
 
 class ImageLoop(BaseModel):
     book: Book
     image_handler: Image
+    scheduler: BaseStageScheduler
+    concurrency: int = 4
 
     def run(self) -> None:
         """
-        Assuming book comes in the form of ((id,title_chapter,chapter_content),..)
+        Takes chunks from the scheduler as soon as their prompt is done, in
+        `concurrency` worker threads
         """
-        is_prompt_done = False
-        response: Optional[ImageResponseSchema]
-        while not is_prompt_done:
-            for idx, chunk in enumerate(self.book.get_chunks()):
-                if chunk.image_url or not chunk.prompt:
-                    continue
-                payload = ImageRequestSchema(positivePrompt=STYLE_TAG + chunk.prompt)
-
-                status_code, response = self.image_handler.get(
-                    payload=payload.model_dump(mode="json")
-                )
-
-                if status_code == 200:
-                    if response:
-                        chunk.set_img(
-                            url=response.data[0].imageURL,
-                            task_id=response.data[0].taskType,
-                        )
-                        continue
+        run_workers(self.worker, self.concurrency)
+        logger.info("[Image] : Images Done for ALL Chunks")
+
+    def worker(self) -> None:
+        assert isinstance(self.scheduler, StageScheduler)
+        while True:
+            chunk = self.scheduler.get(Stage.IMAGE)
+            if chunk is None:
+                break
+            status_code, response = self.image_handler.get(
+                payload=self.get_payload(chunk)
+            )
+            self.handle_response(chunk, status_code, response)
 
-                logger.warning(f"[Image] : {status_code=} error getting{idx=}")
+    async def arun(self) -> None:
+        """
+        asyncio version of `run`, keeps up to `concurrency` calls in flight
+        """
+        await asyncio.gather(*(self.aworker() for _ in range(self.concurrency)))
+        logger.info("[Image] : Images Done for ALL Chunks")
+
+    async def aworker(self) -> None:
+        assert isinstance(self.scheduler, AsyncStageScheduler)
+        while True:
+            chunk = await self.scheduler.aget(Stage.IMAGE)
+            if chunk is None:
+                break
+            status_code, response = await self.image_handler.aget(
+                payload=self.get_payload(chunk)
+            )
+            # set_img downloads the image, keep it off the event loop
+            await asyncio.to_thread(self.handle_response, chunk, status_code, response)
 
-            is_prompt_done = self.book.is_img_done()
+    def get_payload(self, chunk: Chunk) -> dict:
+        payload = ImageRequestSchema(positivePrompt=STYLE_TAG + chunk.prompt)
+        return payload.model_dump(mode="json")
 
-        while not self.book.is_done():
-            for i in self.book.get_chunks():
-                if i.prompt and i.summary and i.image_url and i.audio:
-                    i.is_done = True
-            time.sleep(1)
-        logger.info("[Image] : Prompts Done for ALL Chunks")
+    def handle_response(
+        self,
+        chunk: Chunk,
+        status_code: int,
+        response: Optional[ImageResponseSchema],
+    ) -> None:
+        if status_code == 200:
+            if response:
+                chunk.set_img(
+                    url=response.data[0].imageURL,
+                    task_id=response.data[0].taskType,
+                )
+                return
 
+        logger.warning(
+            f"[Image] : {status_code=} error getting {chunk.chapter_id}/{chunk.chunk_id}"
+        )
+        self.scheduler.retry(chunk, Stage.IMAGE)
+
+
+def process_book(
+    book: Union[Book, str],
+    summary_mode: str = "SERIAL",
+    lazy: bool = BOOK_LAZY,
+    workers: int = BOOK_WORKERS,
+) -> Optional[BookState]:
+    """
+    Runs every stage on `book`. Given a path, the book is loaded with `lazy`
+    and `workers` (see Book)
+    """
+    # summary_module builds on this module, so it is imported here
+    from summary_module import SummaryMode, get_summary_loop
 
-def process_book(book: Book) -> Optional[BookState]:
     groq_api = os.environ.get("GROQ_API")
     img_api = os.environ.get("IMAGE_API")
     service_account_json = "./fine-loader-455404-j7-fb57bc0fa16b.json"
@@ -651,6 +1241,7 @@ def process_book(book: Book) -> Optional[BookState]:
     if not img_api:
         raise Exception("IMAGE_API NOT SET IN .env")
 
+    book = open_book(book, lazy=lazy, workers=workers)
     book_state = book.book_state
     assert book_state
     if book_state.is_done:
@@ -660,10 +1251,13 @@ def process_book(book: Book) -> Optional[BookState]:
     image = Image(api_key=img_api)
     auido = Audio(service_acc_path=service_account_json)
 
-    looper_sum = SummaryLoop(book=book, summary_handler=sum)
-    looper_prompt = PromptLoop(book=book, prompt_handler=prompt)
-    looper_img = ImageLoop(book=book, image_handler=image)
-    audio_loop = AudioLoop(book=book, audio_handler=auido)
+    scheduler = StageScheduler(book=book)
+    looper_sum = get_summary_loop(
+        SummaryMode(summary_mode), book=book, summary_handler=sum, scheduler=scheduler
+    )
+    looper_prompt = PromptLoop(book=book, prompt_handler=prompt, scheduler=scheduler)
+    looper_img = ImageLoop(book=book, image_handler=image, scheduler=scheduler)
+    audio_loop = AudioLoop(book=book, audio_handler=auido, scheduler=scheduler)
 
     thread_img = threading.Thread(target=looper_img.run)
     thread_prompt = threading.Thread(target=looper_prompt.run)
@@ -680,25 +1274,142 @@ def process_book(book: Book) -> Optional[BookState]:
     thread_prompt.join()
     thread_sum.join()
     thread_audio.join()
+    scheduler.close()
+    book.is_done()
+    get_store().flush()
+    logger.info(f"[Repair] : {repair_metrics.stats()}")
+    cassette = get_cassette()
+    if cassette:
+        logger.info(f"[Cassette] : {cassette.stats()}")
 
     return book.book_state
 
 
-def test_process_book(book: Book) -> Optional[BookState]:
-    url = "http://127.0.0.1:8000/"
+async def async_process_book(
+    book: Union[Book, str],
+    prompt_concurrency: int = 4,
+    image_concurrency: int = 4,
+    audio_concurrency: int = 4,
+    summary_mode: str = "SERIAL",
+    lazy: bool = BOOK_LAZY,
+    workers: int = BOOK_WORKERS,
+) -> Optional[BookState]:
+    """
+    asyncio version of `process_book`.
+
+    Prompt, image and audio have no chunk to chunk dependency, so each of them
+    keeps up to `<stage>_concurrency` requests in flight. The serial summary
+    chain runs in a worker thread next to them.
+    """
+    from summary_module import SummaryMode, get_summary_loop
+
+    groq_api = os.environ.get("GROQ_API")
+    img_api = os.environ.get("IMAGE_API")
+    service_account_json = "./fine-loader-455404-j7-fb57bc0fa16b.json"
+    if not groq_api:
+        raise Exception("GROQ_API NOT SET IN .env")
+    if not img_api:
+        raise Exception("IMAGE_API NOT SET IN .env")
+
+    book = await asyncio.to_thread(open_book, book, lazy=lazy, workers=workers)
     book_state = book.book_state
     assert book_state
     if book_state.is_done:
         return book.book_state
-    sum = Summary(api_key="", url=f"{url}/sum")
-    prompt = Prompt(api_key="", url=f"{url}/prompt")
-    image = Image(api_key="", url=f"{url}/image")
-    audio = AudioTest(test_url=Path(url))
+    sum = Summary(api_key=groq_api)
+    prompt = Prompt(api_key=groq_api)
+    image = Image(api_key=img_api)
+    auido = Audio(service_acc_path=service_account_json)
+
+    scheduler = AsyncStageScheduler(book=book)
+    looper_sum = get_summary_loop(
+        SummaryMode(summary_mode), book=book, summary_handler=sum, scheduler=scheduler
+    )
+    looper_prompt = PromptLoop(
+        book=book,
+        prompt_handler=prompt,
+        scheduler=scheduler,
+        concurrency=prompt_concurrency,
+    )
+    looper_img = ImageLoop(
+        book=book,
+        image_handler=image,
+        scheduler=scheduler,
+        concurrency=image_concurrency,
+    )
+    audio_loop = AudioLoop(
+        book=book,
+        audio_handler=auido,
+        scheduler=scheduler,
+        concurrency=audio_concurrency,
+    )
+
+    try:
+        await asyncio.gather(
+            (
+                looper_sum.arun()
+                if hasattr(looper_sum, "arun")
+                else asyncio.to_thread(looper_sum.run)
+            ),
+            looper_prompt.arun(),
+            looper_img.arun(),
+            audio_loop.arun(),
+        )
+    finally:
+        await prompt.aclose()
+        await image.aclose()
+        await sum.aclose()
+    scheduler.close()
+    book.is_done()
+    get_store().flush()
+    logger.info(f"[Repair] : {repair_metrics.stats()}")
+    cassette = get_cassette()
+    if cassette:
+        logger.info(f"[Cassette] : {cassette.stats()}")
+
+    return book.book_state
+
 
-    looper_sum = SummaryLoop(book=book, summary_handler=sum)
-    looper_prompt = PromptLoop(book=book, prompt_handler=prompt)
-    looper_img = ImageLoop(book=book, image_handler=image)
-    audio_loop = AudioTestLoop(book=book, audio_handler=audio)
+def test_process_book(
+    book: Union[Book, str],
+    url: str = "http://127.0.0.1:8000/",
+    summary_mode: str = "SERIAL",
+    use_cache: bool = True,
+    limiter: Optional[RateLimiter] = None,
+    lazy: bool = BOOK_LAZY,
+    workers: int = BOOK_WORKERS,
+) -> Optional[BookState]:
+    """
+    `process_book` against a local server with /sum, /prompt, /image and
+    /audio routes, e.g. simulator_module. Without `use_cache` every request
+    reaches the server, as benchmarks need. The chat handlers share `limiter`,
+    by default one that only follows the limits the server reports.
+    """
+    from summary_module import SummaryMode, get_summary_loop
+
+    url = url.rstrip("/")
+    book = open_book(book, lazy=lazy, workers=workers)
+    book_state = book.book_state
+    assert book_state
+    if book_state.is_done:
+        return book.book_state
+    if limiter is None:
+        limiter = RateLimiter.unlimited()
+    sum = Summary(api_key="", url=f"{url}/sum", limiter=limiter)
+    prompt = Prompt(api_key="", url=f"{url}/prompt", limiter=limiter)
+    image = Image(api_key="", url=f"{url}/image")
+    audio = AudioTest(test_url=url)
+    if not use_cache:
+        sum.cache = None
+        prompt.cache = None
+
+    scheduler = StageScheduler(book=book)
+    looper_sum = get_summary_loop(
+        SummaryMode(summary_mode), book=book, summary_handler=sum, scheduler=scheduler
+    )
+    looper_prompt = PromptLoop(book=book, prompt_handler=prompt, scheduler=scheduler)
+    looper_img = ImageLoop(book=book, image_handler=image, scheduler=scheduler)
+    audio_loop = AudioTestLoop(book=book, audio_handler=audio, scheduler=scheduler)
 
     thread_img = threading.Thread(target=looper_img.run)
     thread_prompt = threading.Thread(target=looper_prompt.run)
@@ -715,6 +1426,13 @@ def test_process_book(book: Book) -> Optional[BookState]:
     thread_prompt.join()
     thread_sum.join()
     thread_audio.join()
+    scheduler.close()
+    book.is_done()
+    get_store().flush()
+    logger.info(f"[Repair] : {repair_metrics.stats()}")
+    cassette = get_cassette()
+    if cassette:
+        logger.info(f"[Cassette] : {cassette.stats()}")
 
     return book.book_state
 
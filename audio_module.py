@@ -1,16 +1,24 @@
 from dataclasses import dataclass, field
+import asyncio
 from google.cloud import texttospeech
 import os
+import aiohttp
 import requests
-from pathlib import Path
 from requests import HTTPError, request
 from dotenv import load_dotenv
 from typing import Any, Optional
 
 from pydantic import BaseModel, Field
 from logger_module import logger
+from cassette_module import audio_key, recorded
 
-from reader_new import Book
+from reader_new import Book, Stage
+from scheduler_module import (
+    AsyncStageScheduler,
+    BaseStageScheduler,
+    StageScheduler,
+    run_workers,
+)
 
 load_dotenv()
 
@@ -33,7 +41,9 @@ class Audio:
         self.audio_config = texttospeech.AudioConfig(
             audio_encoding=texttospeech.AudioEncoding.MP3
         )
+        self.async_client: Any = None
 
+    @recorded("audio", audio_key)
     def synthesize_speech(self, text: str, id: str) -> Optional[bytes]:
         input_text = texttospeech.SynthesisInput(text=text)
         try:
@@ -47,33 +57,72 @@ class Audio:
             logger.warning(f"[Audio] Error getting audio, error : {e}")
             return None
 
+    @recorded("audio", audio_key)
+    async def asynthesize_speech(self, text: str, id: str) -> Optional[bytes]:
+        # The async client binds to the running loop, so it is created on first use
+        if self.async_client is None:
+            self.async_client = texttospeech.TextToSpeechAsyncClient()
+        input_text = texttospeech.SynthesisInput(text=text)
+        try:
+            response = await self.async_client.synthesize_speech(
+                input=input_text, voice=self.voice, audio_config=self.audio_config
+            )
+            logger.info(f"[Audio] Chunk:{id} is done")
+            return response.audio_content
+
+        except Exception as e:
+            logger.warning(f"[Audio] Error getting audio, error : {e}")
+            return None
+
 
 class AudioLoop(BaseModel):
     book: Book
     audio_handler: Audio
+    scheduler: BaseStageScheduler
+    concurrency: int = 4
 
     def run(self) -> None:
-        count = 0
-        is_audio_done = False
-        while not is_audio_done:
-            for chunk in self.book.get_chunks():
-                if chunk.audio or not chunk.summary:
-                    continue
-                audio_bytes = self.audio_handler.synthesize_speech(
-                    chunk.summary, id=f"{chunk.chapter_id}/{chunk.chunk_id}"
-                )
-                if audio_bytes:
-                    chunk.set_audio(audio_bytes)
-            if self.book.is_sum_done():
-                count += 1
-                if count == 3:
-                    break
-            is_audio_done = self.book.is_audio_done()
+        """Takes chunks as soon as their summary is done, in `concurrency` worker threads"""
+        run_workers(self.worker, self.concurrency)
+
+    def worker(self) -> None:
+        assert isinstance(self.scheduler, StageScheduler)
+        while True:
+            chunk = self.scheduler.get(Stage.AUDIO)
+            if chunk is None:
+                break
+            audio_bytes = self.audio_handler.synthesize_speech(
+                chunk.summary, id=f"{chunk.chapter_id}/{chunk.chunk_id}"
+            )
+            if audio_bytes:
+                chunk.set_audio(audio_bytes)
+            else:
+                self.scheduler.retry(chunk, Stage.AUDIO)
+
+    async def arun(self) -> None:
+        """
+        asyncio version of `run`, keeps up to `concurrency` calls in flight
+        """
+        await asyncio.gather(*(self.aworker() for _ in range(self.concurrency)))
+
+    async def aworker(self) -> None:
+        assert isinstance(self.scheduler, AsyncStageScheduler)
+        while True:
+            chunk = await self.scheduler.aget(Stage.AUDIO)
+            if chunk is None:
+                break
+            audio_bytes = await self.audio_handler.asynthesize_speech(
+                chunk.summary, id=f"{chunk.chapter_id}/{chunk.chunk_id}"
+            )
+            if audio_bytes:
+                await asyncio.to_thread(chunk.set_audio, audio_bytes)
+            else:
+                self.scheduler.retry(chunk, Stage.AUDIO)
 
 
 @dataclass
 class AudioTest:
-    test_url: Path = Path("http://localhost:8000/")
+    test_url: str = "http://localhost:8000/"
 
     def test(
         self,
@@ -81,33 +130,61 @@ class AudioTest:
         if not self.test_url:
             ValueError("set up test url in .env file")
         response = requests.get(
-            str(self.test_url / "audio"),
+            f"{self.test_url.rstrip('/')}/audio",
         )
         if response.ok:
             return response.content
         else:
             HTTPError("Error with test server, Failed to recieve audio")
 
+    async def atest(self, session: aiohttp.ClientSession) -> Optional[bytes]:
+        try:
+            async with session.get(f"{self.test_url.rstrip('/')}/audio") as response:
+                if response.ok:
+                    return await response.read()
+        except aiohttp.ClientError as e:
+            logger.warning(f"[Audio] Error with test server, error : {e}")
+        return None
+
 
 class AudioTestLoop(BaseModel):
     book: Book
     audio_handler: AudioTest
+    scheduler: BaseStageScheduler
+    concurrency: int = 4
 
     def run(self) -> None:
-        count = 0
-        is_audio_done = False
-        while not is_audio_done:
-            for chunk in self.book.get_chunks():
-                if chunk.audio or not chunk.summary:
-                    continue
-                audio_bytes = self.audio_handler.test()
-                if audio_bytes:
-                    chunk.set_audio(audio_bytes)
-            if self.book.is_sum_done():
-                count += 1
-                if count == 3:
-                    break
-            is_audio_done = self.book.is_audio_done()
+        run_workers(self.worker, self.concurrency)
+
+    def worker(self) -> None:
+        assert isinstance(self.scheduler, StageScheduler)
+        while True:
+            chunk = self.scheduler.get(Stage.AUDIO)
+            if chunk is None:
+                break
+            audio_bytes = self.audio_handler.test()
+            if audio_bytes:
+                chunk.set_audio(audio_bytes)
+            else:
+                self.scheduler.retry(chunk, Stage.AUDIO)
+
+    async def arun(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(
+                *(self.aworker(session) for _ in range(self.concurrency))
+            )
+
+    async def aworker(self, session: aiohttp.ClientSession) -> None:
+        assert isinstance(self.scheduler, AsyncStageScheduler)
+        while True:
+            chunk = await self.scheduler.aget(Stage.AUDIO)
+            if chunk is None:
+                break
+            audio_bytes = await self.audio_handler.atest(session)
+            if audio_bytes:
+                await asyncio.to_thread(chunk.set_audio, audio_bytes)
+            else:
+                self.scheduler.retry(chunk, Stage.AUDIO)
 
 
 def test():
@@ -121,6 +198,7 @@ def test():
     audio_loop = AudioLoop(
         book=book,
         audio_handler=auido_handler,
+        scheduler=StageScheduler(book=book),
     )
     audio_loop.run()
 
@@ -10,6 +10,7 @@ from html.parser import HTMLParser
 from html import unescape
 import textwrap
 import mobi
+from collections import deque
 
 
 try:
@@ -18,6 +19,33 @@ except ImportError:
     import markupbase as _markupbase
 
 
+def resolve_spine(spine, manifest):
+    """
+    Returns the manifest hrefs of the spine idrefs, in spine order, and the
+    manifest items no spine entry took. Each item fills one spine entry at
+    most, items sharing an id are taken in manifest order.
+    """
+    items = {}
+    for item in manifest:
+        items.setdefault(item[0], deque()).append(item)
+    hrefs, taken = [], set()
+    for idref in spine:
+        matches = items.get(idref)
+        if matches:
+            item = matches.popleft()
+            taken.add(id(item))
+            hrefs.append(item[1])
+    return hrefs, [item for item in manifest if id(item) not in taken]
+
+
+def first_index(values):
+    """value -> index of its first occurrence in values"""
+    index = {}
+    for idx, value in enumerate(values):
+        index.setdefault(value, idx)
+    return index
+
+
 class Epub:
     NS = {
         "DAISY": "http://www.daisy.org/z3986/2005/ncx/",
@@ -88,17 +116,13 @@ class Epub:
             ):
                 self.manifest.append([i.get("id"), i.get("href")])
 
-        self.spine, contents = [], []
+        self.spine = []
         for i in cont.findall("OPF:spine/*", self.NS):
             self.spine.append(i.get("idref"))
-        for i in self.spine:
-            for j in self.manifest:
-                if i == j[0]:
-                    self.contents.append(self.rootdir + unquote(j[1]))
-                    contents.append(unquote(j[1]))
-                    self.manifest.remove(j)
-                    # TODO: test is break necessary
-                    break
+        hrefs, self.manifest = resolve_spine(self.spine, self.manifest)
+        contents = [unquote(href) for href in hrefs]
+        self.contents = [self.rootdir + href for href in contents]
+        content_index = first_index(contents)
 
         try:
             toc = ET.parse(self.file.open(self.toc)).getroot()
@@ -117,9 +141,8 @@ class Epub:
                     src = i.get("href")
                     name = "".join(list(i.itertext()))
                 src = src.split("#")
-                try:
-                    idx = contents.index(unquote(src[0]))
-                except ValueError:
+                idx = content_index.get(unquote(src[0]))
+                if idx is None:
                     continue
                 self.toc_entries[0].append(name)
                 self.toc_entries[1].append(idx)
@@ -185,17 +208,13 @@ class Mobi(Epub):
             ):
                 self.manifest.append([i.get("id"), i.get("href")])
 
-        self.spine, contents = [], []
+        self.spine = []
         for i in cont.findall("OPF:spine/*", self.NS):
             self.spine.append(i.get("idref"))
-        for i in self.spine:
-            for j in self.manifest:
-                if i == j[0]:
-                    self.contents.append(os.path.join(self.rootdir, unquote(j[1])))
-                    contents.append(unquote(j[1]))
-                    self.manifest.remove(j)
-                    # TODO: test is break necessary
-                    break
+        hrefs, self.manifest = resolve_spine(self.spine, self.manifest)
+        contents = [unquote(href) for href in hrefs]
+        self.contents = [os.path.join(self.rootdir, href) for href in contents]
+        content_index = first_index(contents)
 
         with open(self.toc) as f:
             toc = ET.parse(f).getroot()
@@ -214,9 +233,8 @@ class Mobi(Epub):
                 src = i.get("href")
                 name = "".join(list(i.itertext()))
             src = src.split("#")
-            try:
-                idx = contents.index(unquote(src[0]))
-            except ValueError:
+            idx = content_index.get(unquote(src[0]))
+            if idx is None:
                 continue
             self.toc_entries[0].append(name)
             self.toc_entries[1].append(idx)
@@ -0,0 +1,309 @@
+"""
+Bulk mode for books nobody is waiting on: the pending requests of a stage
+are written as a Groq Batch API input file, run as one batch (cheaper, and
+outside the per-minute limits), and the results file is applied back to the
+chunks. `LocalBatchRunner` plays the batch service against any OpenAI
+compatible endpoint (e.g. a provider stub), so the flow runs offline.
+"""
+
+from dataclasses import dataclass
+import json
+import os
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from api_module import (
+    Prompt,
+    PromptResponseSchema,
+    Summary,
+    SummaryResponseSchema,
+)
+from logger_module import logger
+from prompts import SUMMARY_MAP_CONTEXT
+from reader_new import Book, Chunk, Stage
+from scheduler_module import chunk_key
+from summary_module import MapReduceSummaryLoop
+
+BATCH_URL = "https://api.groq.com/openai/v1"
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_WINDOW = os.getenv("GROQ_BATCH_WINDOW", "24h")
+
+# Seconds between two status checks of a running batch
+BATCH_POLL_INTERVAL = 30
+
+# Batch states after which nothing changes anymore
+BATCH_FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def batch_path(book: Book, stage: Stage, kind: str) -> str:
+    """<book>/batch/<stage>_<kind>.jsonl, kind is requests or results"""
+    folder = os.path.join(book.path_content, "batch")
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{stage.name.lower()}_{kind}.jsonl")
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_requests(
+    book: Book, stage: Stage, summary_handler: Summary, prompt_handler: Prompt
+) -> Tuple[str, int]:
+    """
+    Writes one batch line per chunk still pending `stage`, with
+    custom_id=<chapter>/<chunk>. Prompts need the chunk's summary first.
+    Summaries are requested as in the map step of the MAP_REDUCE mode, each
+    chunk on its own, since a batch has no order between its requests.
+    """
+    path = batch_path(book, stage, "requests")
+    count = 0
+    with open(path, "w") as file:
+        for chunk in book.get_chunks():
+            if stage == Stage.SUMMARY and not chunk.summary:
+                payload = summary_handler.get_payload(
+                    summary_handler.get_messages(
+                        content=chunk.chunk,
+                        previous_summary=SUMMARY_MAP_CONTEXT,
+                        characters={},
+                        places={},
+                    )
+                )
+            elif stage == Stage.PROMPT and chunk.summary and not chunk.prompt:
+                payload = prompt_handler.get_payload(
+                    prompt_handler.get_messages(
+                        input_text=chunk.chunk,
+                        characters=chunk.characters,
+                        places=chunk.places,
+                    )
+                )
+            else:
+                continue
+            payload["stream"] = False
+            line = {
+                "custom_id": chunk_key(chunk),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": payload,
+            }
+            file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            count += 1
+    logger.info(f"[Batch] : {count} {stage.name} requests written to {path}")
+    return path, count
+
+
+def read_results(path: str) -> Dict[str, Optional[str]]:
+    """custom_id -> generated content, None for the requests that failed"""
+    results: Dict[str, Optional[str]] = {}
+    for line in read_jsonl(path):
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        content = None
+        if response.get("status_code") == 200 and body.get("choices"):
+            content = body["choices"][0]["message"]["content"]
+        else:
+            logger.warning(
+                f"[Batch] : {line.get('custom_id')} failed, {line.get('error') or response.get('status_code')}"
+            )
+        results[line["custom_id"]] = content
+    return results
+
+
+def apply_results(
+    book: Book,
+    stage: Stage,
+    path: str,
+    summary_handler: Summary,
+    prompt_handler: Prompt,
+) -> Tuple[int, int]:
+    """
+    Applies a results file to the chunks through `set_prompt`/`set_sum`,
+    returns (applied, failed). Failed chunks stay pending for the next run.
+    """
+    results = read_results(path)
+    chunks = {chunk_key(chunk): chunk for chunk in book.get_chunks()}
+    applied = 0
+
+    if stage == Stage.PROMPT:
+        for key, content in results.items():
+            chunk = chunks.get(key)
+            if chunk is None or content is None or chunk.prompt:
+                continue
+            output = prompt_handler.validate_json(content, PromptResponseSchema)
+            if isinstance(output, PromptResponseSchema) and output.prompt:
+                chunk.set_prompt(scene_title=output.scene_title, prompt=output.prompt)
+                applied += 1
+        return applied, len(results) - applied
+
+    # Summaries come back as map outputs, the reduce step chains their entities
+    # and summaries in book order like the MAP_REDUCE mode (without stitch calls)
+    mapped: List[Optional[SummaryResponseSchema]] = []
+    ordered: List[Chunk] = []
+    for chunk in book.get_chunks():
+        if chunk.summary:
+            output = SummaryResponseSchema(
+                summary=chunk.summary, characters=chunk.characters, places=chunk.places
+            )
+        else:
+            content = results.get(chunk_key(chunk))
+            output = (
+                summary_handler.validate_json(content, SummaryResponseSchema)
+                if content is not None
+                else None
+            )
+            if not isinstance(output, SummaryResponseSchema):
+                continue
+            applied += 1
+        mapped.append(output)
+        ordered.append(chunk)
+    loop = MapReduceSummaryLoop(
+        book=book, summary_handler=summary_handler, stitch=False
+    )
+    loop.reduce_local(ordered, mapped)
+    return applied, len(results) - applied
+
+
+@dataclass
+class GroqBatchClient:
+    """Files and batches endpoints of the Groq Batch API"""
+
+    api_key: str
+    url: str = BATCH_URL
+    window: str = BATCH_WINDOW
+
+    def __post_init__(self) -> None:
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {self.api_key}"
+
+    def submit(self, requests_path: str) -> str:
+        with open(requests_path, "rb") as file:
+            response = self.session.post(
+                f"{self.url}/files",
+                files={"file": (os.path.basename(requests_path), file)},
+                data={"purpose": "batch"},
+                timeout=60,
+            )
+        response.raise_for_status()
+        response = self.session.post(
+            f"{self.url}/batches",
+            json={
+                "input_file_id": response.json()["id"],
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": self.window,
+            },
+            timeout=60,
+        )
+        response.raise_for_status()
+        batch_id = response.json()["id"]
+        logger.info(f"[Batch] : Submitted {requests_path} as {batch_id}")
+        return batch_id
+
+    def status(self, batch_id: str) -> dict:
+        response = self.session.get(f"{self.url}/batches/{batch_id}", timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def wait(self, batch_id: str, poll_interval: float = BATCH_POLL_INTERVAL) -> dict:
+        while True:
+            batch = self.status(batch_id)
+            if batch["status"] in BATCH_FINAL_STATES:
+                logger.info(f"[Batch] : {batch_id} {batch['status']}")
+                return batch
+            logger.trace(f"[Batch] : {batch_id} {batch['status']}")
+            time.sleep(poll_interval)
+
+    def download(self, batch: dict, results_path: str) -> None:
+        """Writes the output (and error) file of a finished batch to `results_path`"""
+        with open(results_path, "wb") as results:
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if not file_id:
+                    continue
+                response = self.session.get(
+                    f"{self.url}/files/{file_id}/content", timeout=300
+                )
+                response.raise_for_status()
+                results.write(response.content)
+
+    def run(self, requests_path: str, results_path: str) -> None:
+        self.download(self.wait(self.submit(requests_path)), results_path)
+
+
+@dataclass
+class LocalBatchRunner:
+    """
+    Stand-in for the batch service: sends every request of the input file to
+    `url` (any chat completions endpoint, e.g. a provider stub) and writes the
+    results file in the Groq Batch API format.
+    """
+
+    url: str
+    api_key: str = ""
+
+    def run(self, requests_path: str, results_path: str) -> None:
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {self.api_key}"
+        with open(results_path, "w") as results:
+            for line in read_jsonl(requests_path):
+                result: dict = {
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": line["custom_id"],
+                    "response": None,
+                    "error": None,
+                }
+                try:
+                    response = session.post(self.url, json=line["body"], timeout=60)
+                    result["response"] = {
+                        "status_code": response.status_code,
+                        "request_id": response.headers.get("x-request-id", ""),
+                        "body": response.json(),
+                    }
+                except (requests.RequestException, ValueError) as e:
+                    result["error"] = {"code": "request_failed", "message": str(e)}
+                results.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def run_batch(
+    book: Book,
+    stage: Stage,
+    runner,
+    summary_handler: Summary,
+    prompt_handler: Prompt,
+) -> Tuple[int, int]:
+    """Writes, runs (GroqBatchClient or LocalBatchRunner) and applies one batch of `stage`"""
+    requests_path, count = write_requests(book, stage, summary_handler, prompt_handler)
+    if not count:
+        return 0, 0
+    results_path = batch_path(book, stage, "results")
+    runner.run(requests_path, results_path)
+    applied, failed = apply_results(
+        book, stage, results_path, summary_handler, prompt_handler
+    )
+    logger.info(f"[Batch] : {stage.name} applied={applied} failed={failed}")
+    return applied, failed
+
+
+def main() -> None:
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "./test_books/AF.epub"
+    url = sys.argv[2] if len(sys.argv) > 2 else ""
+    groq_api = os.environ.get("GROQ_API", "")
+    book = Book(path, user_id="batch")
+    summary_handler = Summary(api_key=groq_api)
+    prompt_handler = Prompt(api_key=groq_api)
+    runner = LocalBatchRunner(url=url) if url else GroqBatchClient(api_key=groq_api)
+    for stage in (Stage.SUMMARY, Stage.PROMPT):
+        print(
+            stage.name, run_batch(book, stage, runner, summary_handler, prompt_handler)
+        )
+    book.is_done()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Ingestion micro-benchmarks: times each step an upload goes through before
+the first request can be made, on every book in test_books/, and reports
+time and peak memory per step as JSON, so runs on two commits can be compared
+with `compare`.
+"""
+
+from dataclasses import asdict, dataclass
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from typing import Any, Callable, Dict, List, Optional
+
+from base_reader import get_ebook_cls
+from reader_new import chapter_text
+from utils import get_chunker, normalize_text
+
+# Timed runs of each step, the median and the fastest are reported
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", 5))
+
+# Same chunk size as Book
+BENCH_CHUNK_TOKENS = 7500
+
+# A step this much slower than the baseline is flagged by `compare`
+REGRESSION_RATIO = 1.1
+
+# Spine items (and TOC entries) of the generated omnibus epub, 0 to skip it
+BENCH_SYNTHETIC_ITEMS = int(os.getenv("BENCH_SYNTHETIC_ITEMS", 5000))
+
+# Steps run on the generated epub, the rest would mostly time its filler text
+SYNTHETIC_STEPS = ["get_ebook_cls", "initialize"]
+
+
+def write_synthetic_epub(path: str, items: int, version: str = "2.0") -> str:
+    """
+    Writes an omnibus-like epub with `items` tiny chapters, each in the
+    spine and the TOC (every other entry pointing at an anchor). Manifest
+    order is shuffled against the spine, as in books assembled from parts.
+    """
+    ids = [f"ch{idx:05d}" for idx in range(items)]
+    manifest_order = ids[1::2] + ids[::2]
+    manifest = "\n".join(
+        f'<item id="{item}" href="text/{item}.xhtml" media-type="application/xhtml+xml"/>'
+        for item in manifest_order
+    )
+    spine = "\n".join(f'<itemref idref="{item}"/>' for item in ids)
+    if version == "2.0":
+        nav_item = (
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+        )
+        nav_points = "\n".join(
+            f'<navPoint id="n{idx}" playOrder="{idx + 1}"><navLabel><text>Chapter {idx}</text></navLabel>'
+            f'<content src="text/{item}.xhtml{"#start" if idx % 2 else ""}"/></navPoint>'
+            for idx, item in enumerate(ids)
+        )
+        toc_name = "toc.ncx"
+        toc = (
+            '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f"<navMap>{nav_points}</navMap></ncx>"
+        )
+    else:
+        nav_item = '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        links = "\n".join(
+            f'<li><a href="text/{item}.xhtml{"#start" if idx % 2 else ""}">Chapter {idx}</a></li>'
+            for idx, item in enumerate(ids)
+        )
+        toc_name = "nav.xhtml"
+        toc = (
+            '<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<body><nav epub:type="toc"><ol>{links}</ol></nav></body></html>'
+        )
+    opf = (
+        f'<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="{version}">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Omnibus</dc:title></metadata>'
+        f"<manifest>{nav_item}\n{manifest}</manifest><spine>{spine}</spine></package>"
+    )
+    container = (
+        '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>'
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", container)
+        epub.writestr("OEBPS/content.opf", opf)
+        epub.writestr(f"OEBPS/{toc_name}", toc)
+        for idx, item in enumerate(ids):
+            epub.writestr(
+                f"OEBPS/text/{item}.xhtml",
+                f'<html xmlns="http://www.w3.org/1999/xhtml"><body><h1 id="start">Chapter {idx}</h1>'
+                f"<p>Part {idx} of the omnibus.</p></body></html>",
+            )
+    return path
+
+
+@dataclass
+class StepResult:
+    seconds_min: float
+    seconds_median: float
+    peak_bytes: int
+
+
+def measure(step: Callable[[], Any], repeat: int = BENCH_REPEAT) -> StepResult:
+    """
+    Times `repeat` runs of `step`, then runs it once more under tracemalloc for
+    its peak memory (separately, tracing slows Python code down several times).
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        step()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return StepResult(
+        seconds_min=min(timings),
+        seconds_median=statistics.median(timings),
+        peak_bytes=peak,
+    )
+
+
+def bench_book(
+    path: str, repeat: int = BENCH_REPEAT, only: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    Every ingestion step (or the `only` ones) on `path`, each one fed the
+    output of the previous one
+    """
+    chunker = get_chunker(max_len=BENCH_CHUNK_TOKENS)
+    ebook = get_ebook_cls(path)
+    ebook_cls = type(ebook)
+    html_chapters = [ebook.get_raw_text(content) for content in ebook.contents]
+    texts = [chapter_text(html_data) for html_data in html_chapters]
+
+    steps: Dict[str, Callable[[], Any]] = {
+        "get_ebook_cls": lambda: get_ebook_cls(path),
+        "initialize": lambda: ebook_cls(path).initialize(),
+        "get_raw_text": lambda: [
+            ebook.get_raw_text(content) for content in ebook.contents
+        ],
+        # HTMLtoLines feed and get_lines
+        "html_to_lines": lambda: [
+            chapter_text(html_data) for html_data in html_chapters
+        ],
+        "normalize_text": lambda: [normalize_text(text) for text in texts],
+        "chunk": lambda: [chunker.chunk(text) for text in texts],
+    }
+    results = {
+        name: asdict(measure(step, repeat))
+        for name, step in steps.items()
+        if only is None or name in only
+    }
+    return {
+        "book": os.path.basename(path),
+        "bytes": os.path.getsize(path),
+        "spine_items": len(ebook.contents),
+        "toc_entries": len(ebook.toc_entries[0]),
+        "chunks": sum(len(chunker.chunk(text)) for text in texts),
+        "steps": results,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(paths: List[str], repeat: int = BENCH_REPEAT) -> Dict[str, Any]:
+    books = [bench_book(path, repeat) for path in paths]
+    if BENCH_SYNTHETIC_ITEMS:
+        with tempfile.TemporaryDirectory() as folder:
+            path = write_synthetic_epub(
+                os.path.join(folder, f"synthetic_{BENCH_SYNTHETIC_ITEMS}.epub"),
+                BENCH_SYNTHETIC_ITEMS,
+            )
+            books.append(bench_book(path, repeat, only=SYNTHETIC_STEPS))
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "books": books,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """One line per book and step, median time against the baseline's"""
+    lines = []
+    before = {book["book"]: book["steps"] for book in baseline["books"]}
+    for book in current["books"]:
+        for step, result in book["steps"].items():
+            old = before.get(book["book"], {}).get(step)
+            if not old:
+                continue
+            ratio = result["seconds_median"] / max(old["seconds_median"], 1e-9)
+            flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+            lines.append(
+                f"{book['book']:<14} {step:<15} "
+                f"{old['seconds_median'] * 1000:9.2f}ms -> {result['seconds_median'] * 1000:9.2f}ms "
+                f"({ratio:.2f}x){flag}"
+            )
+    return lines
+
+
+def main() -> None:
+    import sys
+
+    output = sys.argv[1] if len(sys.argv) > 1 else ""
+    baseline = sys.argv[2] if len(sys.argv) > 2 else ""
+    results = run(sorted(glob.glob("./test_books/*.epub")))
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if baseline:
+        with open(baseline) as file:
+            print("\n".join(compare(json.load(file), results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+from dataclasses import dataclass
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from logger_module import logger
+from utils import SENTENCE_END, Tokenizer
+
+# Context windows of the Groq chat models, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "llama-3.1-8b-instant": 131072,
+    "llama-3.3-70b-versatile": 131072,
+    "llama3-8b-8192": 8192,
+    "llama3-70b-8192": 8192,
+    "gemma2-9b-it": 8192,
+    "mixtral-8x7b-32768": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Optional tighter cap on the input of a request, 0 keeps the context window as the cap
+MAX_INPUT_TOKENS = int(os.getenv("LLM_MAX_INPUT_TOKENS", 0))
+
+# The chat template wraps every message in header and end of turn tokens, and
+# the request itself gets a begin of text, the assistant header and Groq's
+# default system preamble
+MESSAGE_OVERHEAD = 5
+REQUEST_OVERHEAD = 30
+
+# Per entity cost of the dict syntax around it ('"name": "description", ')
+ENTITY_OVERHEAD = 4
+
+# Called with the (past summary, characters, places) to send, returns the messages
+Build = Callable[[str, Dict[str, str], Dict[str, str]], List[Any]]
+
+
+@dataclass
+class TokenBudget:
+    """
+    Counts the tokens of a chat request before it is sent and keeps it inside
+    the model's context window, minus the room reserved for the completion.
+
+    `fit` rebuilds an oversized request with less carried context: the oldest
+    characters and places go first, then the start of the past summary. The
+    chunk text itself is never cut. `record` compares each count with the
+    `prompt_tokens` Groq reports back, so the estimate can be checked.
+    """
+
+    model: str
+    max_completion_tokens: int
+    max_input_tokens: int = MAX_INPUT_TOKENS
+
+    def __post_init__(self) -> None:
+        self.tokenizer = Tokenizer(os.environ.get("HF_API"))
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.estimated = 0
+        self.used = 0
+        self.trimmed = 0
+
+    @property
+    def limit(self) -> int:
+        window = MODEL_CONTEXT_WINDOWS.get(self.model, DEFAULT_CONTEXT_WINDOW)
+        limit = window - self.max_completion_tokens
+        if self.max_input_tokens:
+            limit = min(limit, self.max_input_tokens)
+        return limit
+
+    def count_text(self, text: str) -> int:
+        num_tokens, _ = self.tokenizer.tokenize(text)
+        return num_tokens
+
+    def count(self, messages: List[Any]) -> int:
+        """Input tokens of `messages` (MessageSchema) as the model will see them"""
+        return REQUEST_OVERHEAD + sum(
+            MESSAGE_OVERHEAD + self.count_text(message.content) for message in messages
+        )
+
+    def fit(
+        self,
+        build: Build,
+        summary: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+    ) -> List[Any]:
+        """Messages from `build`, with the carried context trimmed until they fit `limit`"""
+        messages = build(summary, characters, places)
+        tokens = self.count(messages)
+        if tokens <= self.limit:
+            return messages
+
+        initial = tokens
+        characters, places = dict(characters), dict(places)
+        while tokens > self.limit:
+            over = tokens - self.limit
+            if characters or places:
+                over = self.drop_entities(characters, places, over)
+            if over > 0 and summary:
+                summary = self.keep_tail(summary, self.count_text(summary) - over)
+            elif over > 0:
+                logger.warning(
+                    f"[Budget] : {tokens} input tokens left after trimming, over the limit of {self.limit}"
+                )
+                break
+            messages = build(summary, characters, places)
+            tokens = self.count(messages)
+
+        with self.lock:
+            self.trimmed += 1
+        logger.info(
+            f"[Budget] : Trimmed request from {initial} to {tokens} tokens (limit {self.limit})"
+        )
+        return messages
+
+    def drop_entities(
+        self, characters: Dict[str, str], places: Dict[str, str], over: int
+    ) -> int:
+        """Removes the oldest entities until `over` tokens are freed, returns what is left of `over`"""
+        while over > 0 and (characters or places):
+            # Dicts keep insertion order, the first entries are the oldest ones
+            entities = characters if len(characters) >= len(places) else places
+            name = next(iter(entities))
+            description = entities.pop(name)
+            over -= (
+                self.count_text(name) + self.count_text(description) + ENTITY_OVERHEAD
+            )
+        return over
+
+    def keep_tail(self, text: str, tokens: int) -> str:
+        """The last `tokens` tokens of `text`, starting on a sentence where possible"""
+        if tokens <= 0:
+            return ""
+        num_tokens, offsets = self.tokenizer.tokenize_offsets(text)
+        if not num_tokens:
+            return text[-tokens * 4 :]
+        if tokens >= num_tokens:
+            return text
+        tail = text[offsets[-tokens][0] :]
+        sentence_end = SENTENCE_END.search(tail)
+        if sentence_end and sentence_end.end() < len(tail):
+            tail = tail[sentence_end.end() :]
+        return tail.strip()
+
+    def record(self, estimated: int, used: Optional[int]) -> None:
+        """Tracks an estimate against the `prompt_tokens` of the response"""
+        if used is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.estimated += estimated
+            self.used += used
+        if abs(estimated - used) > 0.1 * used:
+            logger.debug(f"[Budget] : Estimated {estimated} input tokens, used {used}")
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "trimmed": self.trimmed,
+                "estimated_tokens": self.estimated,
+                "used_tokens": self.used,
+                "error": (
+                    (self.estimated - self.used) / self.used if self.used else 0.0
+                ),
+            }
+
+
+def test():
+    from api_module import Summary
+
+    budget = TokenBudget(
+        model="llama-3.1-8b-instant", max_completion_tokens=2048, max_input_tokens=1500
+    )
+    summary = Summary(api_key="")
+    characters = {f"Character {i}": "A farm animal. " * 10 for i in range(30)}
+    places: Dict[str, str] = {"Manor Farm": "The farm the animals take over."}
+
+    messages = budget.fit(
+        lambda previous_summary, characters, places: summary.build_messages(
+            "Old Major calls a meeting.", previous_summary, characters, places
+        ),
+        "Mr. Jones is drunk. " * 100,
+        characters,
+        places,
+    )
+    print(budget.count(messages), budget.limit, budget.stats())
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,187 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from logger_module import logger
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./uploaded_books/llm_cache.db")
+
+# Total size of the cached responses before the least recently used are evicted
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+
+def cache_key(url: str, model: str, temperature: float, messages: List[Any]) -> str:
+    """Content address of a chat request, `messages` are MessageSchema or dicts"""
+    request = {
+        "url": url,
+        "model": model,
+        "temperature": temperature,
+        "messages": [
+            message if isinstance(message, dict) else message.model_dump()
+            for message in messages
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+@dataclass
+class ResponseCache:
+    """
+    On-disk cache of LLM responses, keyed by `cache_key`.
+
+    Backed by SQLite in WAL mode, so it survives restarts and can be shared by
+    every thread (one connection per thread) and process using the same file.
+    Once the stored responses grow past `max_bytes`, the least recently used
+    ones are evicted.
+    """
+
+    path: str = CACHE_PATH
+    max_bytes: int = CACHE_MAX_BYTES
+
+    def __post_init__(self) -> None:
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+            # Running total of `size`, so a write does not have to sum the table
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO usage (id, total) "
+                "SELECT 0, COALESCE(SUM(size), 0) FROM responses"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # Autocommit, transactions are opened explicitly where they matter
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        connection = self.connect()
+        try:
+            with connection:
+                row = connection.execute(
+                    "SELECT content FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    connection.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+        except sqlite3.Error as e:
+            logger.warning(f"[Cache] : Read failed, {e}")
+            row = None
+
+        with self.lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, key: str, content: str) -> None:
+        size = len(content.encode("utf-8"))
+        connection = self.connect()
+        try:
+            with connection:
+                # Take the write lock first, the size update must not interleave
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, content, size, accessed) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, content, size, time.time()),
+                )
+                connection.execute(
+                    "UPDATE usage SET total = total + ? WHERE id = 0",
+                    (size - (row[0] if row else 0),),
+                )
+                self.evict(connection)
+        except sqlite3.Error as e:
+            logger.warning(f"[Cache] : Write failed, {e}")
+
+    def evict(self, connection: sqlite3.Connection) -> None:
+        (total,) = connection.execute("SELECT total FROM usage").fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        connection.execute("UPDATE usage SET total = ? WHERE id = 0", (total,))
+        logger.info(f"[Cache] : Evicted {evicted} responses")
+
+    def stats(self) -> Dict[str, int]:
+        connection = self.connect()
+        (entries,) = connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        (size,) = connection.execute("SELECT total FROM usage").fetchone()
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": size,
+            }
+
+
+_caches: Dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path: str = CACHE_PATH) -> Optional[ResponseCache]:
+    """Returns the ResponseCache shared by every handler, None if LLM_CACHE_PATH is empty"""
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path=path)
+        return _caches[path]
+
+
+def test():
+    cache = ResponseCache(path="./uploaded_books/Temp/llm_cache_test.db", max_bytes=64)
+    key = cache_key("url", "model", 0.4, [{"role": "user", "content": "hi"}])
+    print(cache.get(key))
+    cache.put(key, '{"summary": "hello"}')
+    print(cache.get(key))
+    for i in range(10):
+        cache.put(f"key-{i}", "x" * 16)
+    print(cache.get(key), cache.stats())
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,299 @@
+from collections import Counter
+from dataclasses import dataclass
+import asyncio
+import base64
+import functools
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from cache_module import cache_key
+from logger_module import logger
+from stream_module import FieldStream
+
+# Cassette provider calls are recorded to or replayed from, none when empty
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "")
+
+# "record" or "replay"
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "replay")
+
+# Replay speed against the recorded latencies, 0 answers right away
+CASSETTE_SPEED = float(os.getenv("CASSETTE_SPEED", 1.0))
+
+
+def chat_key(handler: Any, messages: list, *args, **kwargs) -> str:
+    return cache_key(handler.url, handler.model, handler.temperature, messages)
+
+
+def image_key(handler: Any, payload: dict, *args, **kwargs) -> str:
+    # taskUUID is new on every request, the prompt and settings identify it
+    return str(sorted((k, str(v)) for k, v in payload.items() if k != "taskUUID"))
+
+
+def audio_key(handler: Any, text: str, *args, **kwargs) -> str:
+    return text
+
+
+def file_key(url: str, *args, **kwargs) -> str:
+    return url
+
+
+def encode_result(value: Any) -> Any:
+    """
+    `value` as plain JSON, with the tuples, bytes and pydantic models the
+    recorded calls return tagged so `decode_result` can rebuild them
+    """
+    if isinstance(value, tuple):
+        return {"__tuple__": [encode_result(item) for item in value]}
+    if isinstance(value, list):
+        return [encode_result(item) for item in value]
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, BaseModel):
+        model = type(value)
+        return {
+            "__model__": f"{model.__module__}.{model.__qualname__}",
+            "data": value.model_dump(mode="json"),
+        }
+    return value
+
+
+def decode_result(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decode_result(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__tuple__" in value:
+        return tuple(decode_result(item) for item in value["__tuple__"])
+    if "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    if "__model__" in value:
+        module, _, name = value["__model__"].rpartition(".")
+        model = getattr(importlib.import_module(module), name)
+        if not (isinstance(model, type) and issubclass(model, BaseModel)):
+            raise ValueError(f"{value['__model__']} is not a pydantic model")
+        return model.model_validate(value["data"])
+    return value
+
+
+@dataclass
+class Cassette:
+    """
+    Provider traffic of a run on disk, to benchmark scheduler and concurrency
+    changes against real response sizes and timing without calling the APIs.
+
+    In "record" mode every call to a `recorded` entry point is stored with its
+    result and how long it took, retries and backoff included. In "replay"
+    mode the same call returns the stored result after the stored latency
+    (divided by `speed`). Identical calls replay in the order they were
+    recorded, the last one repeating once they run out, calls that were never
+    recorded go through to the provider. Results are stored as zlib-compressed
+    JSON in one SQLite file.
+
+    Handlers bypass their response caches while recording (see `recording`),
+    so every recorded call carries the provider's latency.
+    """
+
+    path: str
+    mode: str = CASSETTE_MODE
+    speed: float = CASSETTE_SPEED
+
+    def __post_init__(self) -> None:
+        if self.mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {self.mode}")
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Next seq of each (kind, key), to record or replay
+        self.positions: Dict[Tuple[str, str], int] = {}
+        self.counts: Counter = Counter()
+
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS calls ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "latency REAL NOT NULL, result BLOB NOT NULL, "
+                "PRIMARY KEY (kind, key, seq))"
+            )
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def next_seq(self, kind: str, key: str) -> int:
+        with self.lock:
+            if (kind, key) not in self.positions and not self.replaying:
+                (seq,) = (
+                    self.connect()
+                    .execute(
+                        "SELECT COUNT(*) FROM calls WHERE kind = ? AND key = ?",
+                        (kind, key),
+                    )
+                    .fetchone()
+                )
+                self.positions[(kind, key)] = seq
+            seq = self.positions.get((kind, key), 0)
+            self.positions[(kind, key)] = seq + 1
+            return seq
+
+    def record(self, kind: str, key: str, latency: float, result: Any) -> None:
+        key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        seq = self.next_seq(kind, key)
+        blob = zlib.compress(json.dumps(encode_result(result)).encode("utf-8"))
+        try:
+            with self.connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO calls (kind, key, seq, latency, result) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (kind, key, seq, latency, blob),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"[Cassette] : Write failed, {e}")
+            return
+        with self.lock:
+            self.counts[f"{kind}:recorded"] += 1
+
+    def replay(self, kind: str, key: str) -> Optional[Tuple[float, Any]]:
+        """The (latency, result) of the next recorded call, None if it was never recorded"""
+        key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        seq = self.next_seq(kind, key)
+        row = (
+            self.connect()
+            .execute(
+                "SELECT latency, result FROM calls WHERE kind = ? AND key = ? "
+                "AND seq <= ? ORDER BY seq DESC LIMIT 1",
+                (kind, key, seq),
+            )
+            .fetchone()
+        )
+        with self.lock:
+            self.counts[f"{kind}:{'hits' if row else 'misses'}"] += 1
+        if row is None:
+            logger.warning(f"[Cassette] : No recorded {kind} call {key[:12]}")
+            return None
+        latency, blob = row
+        try:
+            result = decode_result(json.loads(zlib.decompress(blob)))
+        except (zlib.error, ValueError, ImportError, AttributeError) as e:
+            # Cassettes recorded before results were stored as JSON
+            logger.warning(f"[Cassette] : Unreadable {kind} call {key[:12]}, {e}")
+            return None
+        delay = latency / self.speed if self.speed else 0.0
+        return delay, result
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+
+_cassette: Optional[Cassette] = None
+_cassette_lock = threading.Lock()
+_cassette_loaded = False
+
+
+def get_cassette() -> Optional[Cassette]:
+    """The cassette of this process, from CASSETTE_PATH unless `set_cassette` was called"""
+    global _cassette, _cassette_loaded
+    with _cassette_lock:
+        if not _cassette_loaded:
+            _cassette = Cassette(path=CASSETTE_PATH) if CASSETTE_PATH else None
+            _cassette_loaded = True
+        return _cassette
+
+
+def set_cassette(cassette: Optional[Cassette]) -> None:
+    global _cassette, _cassette_loaded
+    with _cassette_lock:
+        _cassette = cassette
+        _cassette_loaded = True
+
+
+def recording() -> bool:
+    """Whether provider calls are being recorded, handlers then skip their caches"""
+    cassette = get_cassette()
+    return cassette is not None and not cassette.replaying
+
+
+def replay_fields(
+    handler: Any, result: Any, on_field: Optional[Callable[[str, str], None]]
+) -> None:
+    """Hands a replayed chat completion to `on_field` like its stream would"""
+    if not getattr(handler, "stream", False) or on_field is None:
+        return
+    if not isinstance(result, tuple) or result[0] != 200:
+        return
+    for name, value in FieldStream().feed(result[1]):
+        on_field(name, value)
+
+
+def recorded(kind: str, key: Callable[..., str]):
+    """
+    Records or replays calls to the decorated function or handler method
+    (sync or async) through the active cassette. `key` gets the call's
+    arguments and identifies it.
+    """
+
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                cassette = get_cassette()
+                if cassette is None:
+                    return await method(*args, **kwargs)
+                call = key(*args, **kwargs)
+                if cassette.replaying:
+                    replayed = cassette.replay(kind, call)
+                    if replayed is not None:
+                        delay, result = replayed
+                        await asyncio.sleep(delay)
+                        replay_fields(args[0], result, kwargs.get("on_field"))
+                        return result
+                start = time.perf_counter()
+                result = await method(*args, **kwargs)
+                if not cassette.replaying:
+                    cassette.record(kind, call, time.perf_counter() - start, result)
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            cassette = get_cassette()
+            if cassette is None:
+                return method(*args, **kwargs)
+            call = key(*args, **kwargs)
+            if cassette.replaying:
+                replayed = cassette.replay(kind, call)
+                if replayed is not None:
+                    delay, result = replayed
+                    time.sleep(delay)
+                    replay_fields(args[0], result, kwargs.get("on_field"))
+                    return result
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            if not cassette.replaying:
+                cassette.record(kind, call, time.perf_counter() - start, result)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,147 @@
+from dataclasses import dataclass, field
+import os
+import re
+from typing import Dict, Tuple
+
+from budget_module import ENTITY_OVERHEAD, TokenBudget
+from logger_module import logger
+
+# Tokens of carried context (past summary + characters + places) sent with a chunk
+CONTEXT_TOKENS = int(os.getenv("SUMMARY_CONTEXT_TOKENS", 3000))
+
+# Share of CONTEXT_TOKENS the past summary may take, the rest goes to entities
+SUMMARY_SHARE = 2 / 3
+
+# Every this many chunks, entities not mentioned since the last pass are shortened
+COMPRESS_EVERY = int(os.getenv("SUMMARY_COMPRESS_EVERY", 8))
+
+# Parts of a name too common to tell whether a character is mentioned
+NAME_STOPWORDS = {"the", "and", "of", "mr", "mrs", "ms", "dr", "sir", "old", "young"}
+
+_WORD = re.compile(r"\w+")
+_FIRST_SENTENCE = re.compile(r"^.*?[.!?](?=\s|$)", re.DOTALL)
+
+
+def merge_entities(known: Dict[str, str], new: Dict[str, str]) -> Dict[str, str]:
+    """
+    Merges two name -> description dicts, names are matched case-insensitively
+    and the more detailed (longer) description wins.
+    """
+    merged = dict(known)
+    names = {name.strip().lower(): name for name in merged}
+    for name, description in new.items():
+        key = name.strip().lower()
+        if key not in names:
+            names[key] = name
+            merged[name] = description
+        elif len(description) > len(merged[names[key]]):
+            merged[names[key]] = description
+    return merged
+
+
+def name_words(name: str) -> set:
+    return {
+        word
+        for word in _WORD.findall(name.lower())
+        if len(word) > 2 and word not in NAME_STOPWORDS
+    }
+
+
+@dataclass
+class RollingContext:
+    """
+    The context a summary chain carries from chunk to chunk, kept at a fixed
+    token budget however far into the book the chain is.
+
+    Every character and place found so far is remembered, but `for_chunk` only
+    sends the ones named in the upcoming chunk, then the most recently named
+    ones while they fit. The past summary keeps its latest `SUMMARY_SHARE` of
+    the budget. Every `compress_every` chunks, entities that were not named
+    since the previous pass are cut down to their first sentence.
+    """
+
+    budget: TokenBudget
+    summary: str
+    characters: Dict[str, str] = field(default_factory=dict)
+    places: Dict[str, str] = field(default_factory=dict)
+    max_tokens: int = CONTEXT_TOKENS
+    compress_every: int = COMPRESS_EVERY
+
+    def __post_init__(self) -> None:
+        self.characters = dict(self.characters)
+        self.places = dict(self.places)
+        self.step = 0
+        # Step each entity was last named in a chunk
+        self.last_seen: Dict[str, int] = {}
+
+    @property
+    def summary_tokens(self) -> int:
+        return int(self.max_tokens * SUMMARY_SHARE)
+
+    def update(
+        self,
+        text: str,
+        summary: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+    ) -> None:
+        """Takes in the summary output of the chunk `text`"""
+        self.step += 1
+        self.summary = summary
+        self.characters = merge_entities(self.characters, characters)
+        self.places = merge_entities(self.places, places)
+        words = set(_WORD.findall(text.lower()))
+        for name in (*characters, *places):
+            if name_words(name) & words:
+                self.last_seen[name.strip().lower()] = self.step
+        if self.step % self.compress_every == 0:
+            self.compress()
+
+    def for_chunk(self, text: str) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+        """(past summary, characters, places) to send along with the chunk `text`"""
+        summary = self.summary
+        if self.budget.count_text(summary) > self.summary_tokens:
+            summary = self.budget.keep_tail(summary, self.summary_tokens)
+        remaining = self.max_tokens - self.budget.count_text(summary)
+
+        words = set(_WORD.findall(text.lower()))
+        entities = [
+            (name, description, known is self.characters)
+            for known in (self.characters, self.places)
+            for name, description in known.items()
+        ]
+        # Named in the chunk first, then the most recently named ones
+        entities.sort(
+            key=lambda entity: (
+                not name_words(entity[0]) & words,
+                -self.last_seen.get(entity[0].strip().lower(), 0),
+            )
+        )
+
+        characters: Dict[str, str] = {}
+        places: Dict[str, str] = {}
+        for name, description, is_character in entities:
+            tokens = (
+                self.budget.count_text(name)
+                + self.budget.count_text(description)
+                + ENTITY_OVERHEAD
+            )
+            if tokens > remaining:
+                continue
+            remaining -= tokens
+            (characters if is_character else places)[name] = description
+        return summary, characters, places
+
+    def compress(self) -> None:
+        stale = self.step - self.compress_every
+        shortened = 0
+        for entities in (self.characters, self.places):
+            for name, description in entities.items():
+                if self.last_seen.get(name.strip().lower(), 0) > stale:
+                    continue
+                first_sentence = _FIRST_SENTENCE.match(description)
+                if first_sentence and first_sentence.end() < len(description):
+                    entities[name] = first_sentence.group()
+                    shortened += 1
+        if shortened:
+            logger.trace(f"[Context] : Shortened {shortened} stale entities")
@@ -0,0 +1,186 @@
+"""
+End to end load test: runs `test_process_book` over the test books against
+the local provider simulator and reports chunks/s, p50/p99 latency of every
+stage and the retries each route took. Configure the simulator through its
+SIM_* variables, e.g. SIM_RATE_429=0.05 SIM_LATENCY_SCALE=0.2.
+"""
+
+from dataclasses import dataclass
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from api_module import test_process_book
+from logger_module import logger
+from ratelimit_module import RateLimiter, retry_metrics
+from reader_new import BOOK_LAZY, BOOK_WORKERS, Book, Chapter, Chunk, Stage
+from scheduler_module import UPSTREAM, chunk_key
+from simulator_module import ProviderSimulator
+
+# Simulator route each stage calls
+STAGE_ROUTES = {
+    Stage.SUMMARY: "sum",
+    Stage.PROMPT: "prompt",
+    Stage.IMAGE: "image",
+    Stage.AUDIO: "audio",
+}
+
+# Handler whose retries each stage reports, the audio test handler does not retry
+STAGE_HANDLERS = {
+    Stage.SUMMARY: "[Summary]",
+    Stage.PROMPT: "[Prompt]",
+    Stage.IMAGE: "[Image]",
+}
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+@dataclass
+class StageTimer:
+    """
+    Records when each stage finished on each chunk of `book`, through the
+    same chunk listeners the stage scheduler uses.
+    """
+
+    book: Book
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.done: Dict[Tuple[str, Stage], float] = {}
+        with self.book.load_lock:
+            for chunk in self.book.get_loaded_chunks():
+                chunk.add_listener(self.on_stage_done)
+            self.book.add_listener(self.on_chapter_loaded)
+
+    def on_chapter_loaded(self, chapter: Optional[Chapter]) -> None:
+        if chapter is None:
+            return
+        for chunk in chapter.get_chunks():
+            chunk.add_listener(self.on_stage_done)
+
+    def on_stage_done(self, chunk: Chunk, stage: Stage, partial: bool = False) -> None:
+        if partial:
+            return
+        with self.lock:
+            self.done.setdefault((chunk_key(chunk), stage), time.perf_counter())
+
+    def latencies(self) -> Dict[Stage, List[float]]:
+        """
+        Seconds each stage took on each chunk, from the time the chunk was
+        ready for it (its upstream stages done) until it was done. The summary
+        of a chunk is ready once the previous chunk's summary is done, the
+        chain order of the serial mode.
+        """
+        keys = [chunk_key(chunk) for chunk in self.book.get_chunks()]
+        latencies: Dict[Stage, List[float]] = {stage: [] for stage in Stage}
+        with self.lock:
+            previous = self.start
+            for key in keys:
+                done = self.done.get((key, Stage.SUMMARY))
+                if done is not None:
+                    latencies[Stage.SUMMARY].append(done - previous)
+                    previous = max(previous, done)
+            for stage in Stage:
+                if not UPSTREAM[stage]:
+                    continue
+                for key in keys:
+                    done = self.done.get((key, stage))
+                    ready = [self.done.get((key, up)) for up in UPSTREAM[stage]]
+                    if done is None or None in ready:
+                        continue
+                    latencies[stage].append(done - max(ready))
+        return latencies
+
+
+def run_load_test(
+    path: str,
+    simulator: ProviderSimulator,
+    summary_mode: str = "SERIAL",
+    limiter: Optional[RateLimiter] = None,
+    lazy: bool = BOOK_LAZY,
+    workers: int = BOOK_WORKERS,
+) -> dict:
+    """
+    Processes `path` against `simulator` from scratch and reports how it went.
+    Without `limiter` the handlers only follow the limits the simulator
+    reports (SIM_REQUESTS_PER_MINUTE), so the run times the pipeline. `lazy`
+    and `workers` pick how the book is loaded (see Book), the timed run
+    includes the loading, which a lazy book overlaps with the stages.
+    """
+    simulator.stats.reset()
+    retry_metrics.reset()
+
+    start = time.perf_counter()
+    book = Book(path, user_id=f"loadtest-{uuid.uuid4()}", lazy=lazy, workers=workers)
+    timer = StageTimer(book)
+    test_process_book(
+        book,
+        url=simulator.url,
+        summary_mode=summary_mode,
+        use_cache=False,
+        limiter=limiter,
+    )
+    elapsed = time.perf_counter() - start
+    # Counted after the run, a lazy book only has them all once it is processed
+    chunks = len(book.get_chunks())
+
+    outcomes = simulator.stats.snapshot()
+    retries = retry_metrics.stats()
+    latencies = timer.latencies()
+    stages = {}
+    for stage, route in STAGE_ROUTES.items():
+        stage_retries = retries.get(STAGE_HANDLERS.get(stage, ""), {})
+        stages[stage.name] = {
+            "p50": percentile(latencies[stage], 0.5),
+            "p99": percentile(latencies[stage], 0.99),
+            "done": sum(chunk.is_stage_done(stage) for chunk in book.get_chunks()),
+            "requests": sum(outcomes.get(route, {}).values()),
+            # Requests the handler sent again, by status code (or connection)
+            "retries": sum(stage_retries.values()),
+            "retry_reasons": stage_retries,
+            "outcomes": outcomes.get(route, {}),
+        }
+    return {
+        "book": os.path.basename(path),
+        "summary_mode": summary_mode,
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_second": chunks / elapsed if elapsed else None,
+        "stages": stages,
+    }
+
+
+def main() -> None:
+    import glob
+    import sys
+
+    summary_mode = sys.argv[1] if len(sys.argv) > 1 else "SERIAL"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else BOOK_WORKERS
+    simulator = ProviderSimulator()
+    simulator.start()
+    reports = []
+    try:
+        for path in sorted(glob.glob("./test_books/*.epub")):
+            report = run_load_test(path, simulator, summary_mode, workers=workers)
+            logger.info(
+                f"[LoadTest] : {report['book']} {report['chunks_per_second']:.2f} chunks/s"
+            )
+            reports.append(report)
+    finally:
+        simulator.stop()
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@ from typing import Any, Dict, Optional, Type, Union, Tuple, List
 from dataclasses import dataclass
 from config import API_KEY, MAX_VALIDATION_ERROR_TRY
 from reader_new import Book
+from ratelimit_module import RateLimiter, estimate_tokens, get_limiter
 import requests
 
 # TODO: ADD GROQ Handler
@@ -27,10 +28,16 @@ class LanguageAPICall:
     url: str
     headers: Dict[str, str]
     output_schema: ResponseSchema
+    limiter: Optional[RateLimiter] = None
 
     def post(self, payload: BaseModel) -> Tuple[int, dict]:
         """Handling Groq validation error as code 422"""
+        tokens = estimate_tokens(json.dumps(payload, default=str))
+        if self.limiter:
+            self.limiter.acquire(tokens)
         response = requests.post(url=self.url, headers=self.headers, json=payload)
+        if self.limiter:
+            self.limiter.update(response.status_code, response.headers)
 
         if response.ok:
             try:
@@ -43,6 +50,9 @@ class LanguageAPICall:
                 raise ValueError("[call_api] Response is not valid JSON.") from e
 
             logger.info(f"[call_api] Code : {response.status_code}")
+            if self.limiter:
+                usage = json_response.get("usage") or {}
+                self.limiter.settle(tokens, usage.get("total_tokens"))
             return response.status_code, json_response
 
             # try:
@@ -141,7 +151,10 @@ class GroqHandler(IHandlerLLM):
     def __post_init__(self):
         self.headers = HeaderSchema().create(self.api)
         self.llm_api = LanguageAPICall(
-            url=self.url, headers=self.headers, output_schema=self.response_model
+            url=self.url,
+            headers=self.headers,
+            output_schema=self.response_model,
+            limiter=get_limiter(self.api, self.url),
         )
 
     def feed_input(
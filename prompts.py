@@ -50,6 +50,28 @@ format->
 
 """
 
+SUMMARY_MAP_CONTEXT = "This part of the book is summarized on its own, There is No context"
+
+SUMMARY_CHAPTER_CONTEXT = "This is the opening of a chapter, earlier chapters are summarized separately"
+
+SUMMARY_STITCH_ROLE = """
+NOTE: Only output in JSON. Ensure the JSON format is valid, well-formed, and ready to parse. Nothing should appear before or after the JSON output.
+
+You are a book editor. Two consecutive parts of a book were summarized independently.
+Rewrite the **current summary** so it reads as a continuation of the **previous summary**.
+
+### Rules:
+- Keep every event and detail of the current summary, do not add events that are not in it.
+- Add the links to earlier developments needed to follow the story.
+- Do not repeat the previous summary.
+- End with **"To be continued."**
+
+### Output Format:
+{
+  "summary": "..."
+}
+"""
+
 
 PROMPT_ROLE = """ 
 IMPORTANT: OUTPUT ONLY IN JSON FORMAT—NO ADDITIONAL TEXT.  
@@ -82,6 +104,44 @@ You are a text-to-image prompt generator. Your task is to analyze the provided i
 
 """
 
+PROMPT_BATCH_ROLE = """
+IMPORTANT: OUTPUT ONLY IN JSON FORMAT—NO ADDITIONAL TEXT.  
+
+You are a text-to-image prompt generator. You are given several blocks of narrative text, each with an `id`. For **every** block, analyze its text and generate a highly detailed, descriptive prompt suitable for image generation. Focus on visual details, atmosphere, and composition.  
+
+### Guidelines:
+- Treat every block on its own, do not mix details between blocks.
+- Do not refer to characters or places by their names. Instead, use the descriptions provided in the `characters` and `places` lists of that block.  
+- Emphasize sensory details, colors, lighting, mood, and environmental elements.  
+- Return exactly one entry per block, with the block's `id` copied as is.
+
+### **Input Format (JSON):**
+```json
+{
+  "chunks": [
+    {
+      "id": "Block id",
+      "input_text": "A block of narrative text.",
+      "character_list": { "Character Name": "Character appearance, clothing, posture, expressions, etc." },
+      "places_list": { "Place Name": "Visual and atmospheric details of the location." }
+    }
+  ]
+}
+
+### **Output Format (JSON):**
+```json
+{
+  "prompts": [
+    {
+      "id": "Block id",
+      "scene_title": "Descriptive title summarizing the scene",
+      "prompt": "A richly detailed prompt suitable for text-to-image generation."
+    }
+  ]
+}
+
+"""
+
 PROMPT_VALIDATION_RESOLVE_ROLE = """
 Given output doesnt follow the mentioned schema
 Only return a ready to parse json with no aditional string 
@@ -0,0 +1,162 @@
+from enum import Enum
+import copy
+import os
+from typing import Any, Dict, List, Optional, Type
+from urllib.parse import urlparse
+
+from pydantic import BaseModel
+
+
+class OutputMode(Enum):
+    """How the response is held to the JSON schema, strictest first"""
+
+    JSON_SCHEMA_STRICT = "json_schema_strict"  # Decoding constrained to the schema
+    JSON_SCHEMA = "json_schema"  # Schema given to the provider, best effort
+    GRAMMAR = "grammar"  # HuggingFace TGI grammar
+    JSON_OBJECT = "json_object"  # Valid JSON, any shape
+    NONE = "none"  # Only the prompt asks for JSON
+
+
+# Output modes each provider supports, strictest first
+PROVIDER_MODES: Dict[str, List[OutputMode]] = {
+    "groq": [
+        OutputMode.JSON_SCHEMA_STRICT,
+        OutputMode.JSON_SCHEMA,
+        OutputMode.JSON_OBJECT,
+    ],
+    "openrouter": [
+        OutputMode.JSON_SCHEMA_STRICT,
+        OutputMode.JSON_SCHEMA,
+        OutputMode.JSON_OBJECT,
+    ],
+    "huggingface": [OutputMode.GRAMMAR, OutputMode.JSON_OBJECT],
+    "ollama": [OutputMode.JSON_SCHEMA, OutputMode.JSON_OBJECT],
+    "local": [OutputMode.JSON_OBJECT],
+}
+
+# Groq only accepts json_schema on some models, and strict decoding on fewer
+GROQ_JSON_SCHEMA_MODELS = {
+    "openai/gpt-oss-20b",
+    "openai/gpt-oss-120b",
+    "moonshotai/kimi-k2-instruct",
+    "moonshotai/kimi-k2-instruct-0905",
+    "meta-llama/llama-4-maverick-17b-128e-instruct",
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+}
+GROQ_STRICT_MODELS = {"openai/gpt-oss-20b", "openai/gpt-oss-120b"}
+
+# Forces the provider of every handler, e.g. "local" for a provider stub
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "")
+
+
+def detect_provider(url: str) -> str:
+    if LLM_PROVIDER:
+        return LLM_PROVIDER
+    host = urlparse(url).netloc
+    if "groq.com" in host:
+        return "groq"
+    if "openrouter.ai" in host:
+        return "openrouter"
+    if "huggingface" in host or "hf.space" in host:
+        return "huggingface"
+    if "ollama" in host or host.endswith(":11434"):
+        return "ollama"
+    return "local"
+
+
+def supported_modes(provider: str, model: str) -> List[OutputMode]:
+    """Modes `model` accepts on `provider`, strictest first"""
+    modes = PROVIDER_MODES.get(provider, [OutputMode.JSON_OBJECT])
+    if provider == "groq":
+        modes = [
+            mode
+            for mode in modes
+            if (mode != OutputMode.JSON_SCHEMA_STRICT or model in GROQ_STRICT_MODELS)
+            and (mode != OutputMode.JSON_SCHEMA or model in GROQ_JSON_SCHEMA_MODELS)
+        ]
+    return modes + [OutputMode.NONE]
+
+
+def strict_schema(schema: Type[BaseModel]) -> Optional[Dict[str, Any]]:
+    """
+    The JSON schema of `schema` in the form strict decoding takes (every
+    property required, no additional properties), None when the schema has
+    free-form objects such as Dict[str, str] that strict mode cannot express.
+    """
+    json_schema = copy.deepcopy(schema.model_json_schema())
+
+    def visit(node: Any) -> bool:
+        if isinstance(node, dict):
+            if node.get("type") == "object":
+                if node.get("additionalProperties", False) is not False:
+                    return False
+                node["additionalProperties"] = False
+                node["required"] = list(node.get("properties", {}))
+                for value in node.get("properties", {}).values():
+                    value.pop("default", None)
+            return all(visit(value) for value in node.values())
+        if isinstance(node, list):
+            return all(visit(value) for value in node)
+        return True
+
+    return json_schema if visit(json_schema) else None
+
+
+def response_format(
+    mode: OutputMode, schema: Type[BaseModel]
+) -> Optional[Dict[str, Any]]:
+    """The `response_format` of a chat completion request in `mode`, None to send none"""
+    if mode == OutputMode.JSON_SCHEMA_STRICT and strict_schema(schema) is None:
+        mode = OutputMode.JSON_SCHEMA
+    if mode == OutputMode.JSON_SCHEMA_STRICT:
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": schema.__name__,
+                "strict": True,
+                "schema": strict_schema(schema),
+            },
+        }
+    if mode == OutputMode.JSON_SCHEMA:
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": schema.__name__,
+                "strict": False,
+                "schema": schema.model_json_schema(),
+            },
+        }
+    if mode == OutputMode.GRAMMAR:
+        return {"type": "json", "value": schema.model_json_schema()}
+    if mode == OutputMode.JSON_OBJECT:
+        return {"type": "json_object"}
+    return None
+
+
+def get_output_mode(provider: str, model: str, schema: Type[BaseModel]) -> OutputMode:
+    """The strictest mode `model` on `provider` supports for `schema`"""
+    for mode in supported_modes(provider, model):
+        if mode == OutputMode.JSON_SCHEMA_STRICT and strict_schema(schema) is None:
+            continue
+        return mode
+    return OutputMode.NONE
+
+
+def test():
+    from api_module import PromptResponseSchema, SummaryResponseSchema
+
+    for url, model in [
+        ("https://api.groq.com/openai/v1/chat/completions", "llama-3.1-8b-instant"),
+        ("https://api.groq.com/openai/v1/chat/completions", "openai/gpt-oss-20b"),
+        ("https://openrouter.ai/api/v1/chat/completions", "google/gemini-2.0-flash"),
+        ("http://127.0.0.1:8000/sum", "llama-3.1-8b-instant"),
+    ]:
+        provider = detect_provider(url)
+        for schema in [SummaryResponseSchema, PromptResponseSchema]:
+            mode = get_output_mode(provider, model, schema)
+            print(provider, model, schema.__name__, mode.value)
+    print(response_format(OutputMode.JSON_SCHEMA_STRICT, PromptResponseSchema))
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,261 @@
+from collections import Counter
+from dataclasses import dataclass
+import asyncio
+import os
+import re
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+from logger_module import logger
+
+# Groq limits for the chat models we use, per API key, 0 for no limit until
+# the x-ratelimit-limit-* headers report one. The free tier's 6000 tokens per
+# minute do not fit one full chunk request (7500 input tokens plus the
+# completion), so the token budget is taken from the headers by default
+REQUESTS_PER_MINUTE = int(os.getenv("GROQ_REQUESTS_PER_MINUTE", 30))
+TOKENS_PER_MINUTE = int(os.getenv("GROQ_TOKENS_PER_MINUTE", 0))
+
+# Seconds the x-ratelimit-*-requests headers cover, per host. Groq reports its
+# daily request budget there, other OpenAI compatible servers the minute's
+REQUEST_HEADER_WINDOW = {"api.groq.com": 86400.0}
+
+# Fraction of the limits we schedule against, so we stay just under them
+HEADROOM = 0.9
+
+# Rough size of a token, used to budget a request before it is sent
+CHARS_PER_TOKEN = 4
+
+_DURATION = re.compile(r"(?P<value>\d+(?:\.\d+)?)(?P<unit>ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parses the reset headers ("7.66s", "2m59.56s", "120ms") and retry-after ("12") to seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+@dataclass
+class RateLimiter:
+    """
+    Token buckets for the requests-per-minute and tokens-per-minute budgets of
+    one API key.
+
+    `reserve` books a request against both buckets and returns how long the
+    caller has to wait before sending it, so concurrent callers are spaced out
+    instead of all hitting a 429 together. Balances may go negative, which
+    books capacity that has not refilled yet. Responses feed back through
+    `update` (x-ratelimit-* / retry-after headers) and `settle` (real usage).
+    A budget of 0 is not limited until the headers report one.
+    """
+
+    requests_per_minute: int = REQUESTS_PER_MINUTE
+    tokens_per_minute: int = TOKENS_PER_MINUTE
+    headroom: float = HEADROOM
+    request_window: float = 60.0  # Seconds x-ratelimit-limit-requests covers
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.request_capacity = self.requests_per_minute * self.headroom
+        self.token_capacity = self.tokens_per_minute * self.headroom
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    @classmethod
+    def unlimited(cls) -> "RateLimiter":
+        """No budget of its own, follows the limits the server reports"""
+        return cls(requests_per_minute=0, tokens_per_minute=0)
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(
+            self.request_capacity,
+            self.requests + elapsed * self.request_capacity / 60,
+        )
+        self.tokens = min(
+            self.token_capacity, self.tokens + elapsed * self.token_capacity / 60
+        )
+
+    def reserve(self, tokens: int) -> float:
+        """
+        Books one request of `tokens` tokens (input plus completion), returns
+        the seconds to wait before sending it
+        """
+        with self.lock:
+            if self.token_capacity and tokens > self.token_capacity:
+                logger.warning(
+                    f"[RateLimit] : A request of {tokens} tokens is over the {self.token_capacity:.0f} tokens per minute budget"
+                )
+            now = time.monotonic()
+            self.refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.request_capacity:
+                wait = max(wait, (1 - self.requests) * 60 / self.request_capacity)
+            if self.token_capacity:
+                wait = max(wait, (tokens - self.tokens) * 60 / self.token_capacity)
+            self.requests -= 1
+            self.tokens -= tokens
+        return wait
+
+    def acquire(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.trace(f"[RateLimit] : Waiting {wait:.2f}s")
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.trace(f"[RateLimit] : Waiting {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+    def settle(self, reserved: int, used: Optional[int]) -> None:
+        """Corrects the token bucket once the response reports the real usage"""
+        if used is None:
+            return
+        with self.lock:
+            self.tokens -= used - reserved
+
+    def resize(
+        self, capacity: float, balance: float, limit: int
+    ) -> Tuple[float, float]:
+        """The (capacity, balance) of a bucket once the server reports `limit`"""
+        new_capacity = limit * self.headroom
+        if not capacity:
+            # Was unlimited, starts full
+            return new_capacity, new_capacity
+        return new_capacity, min(balance, new_capacity)
+
+    def update(self, status_code: int, headers: Mapping[str, str]) -> None:
+        """Syncs the buckets with the rate limit headers of a response"""
+        now = time.monotonic()
+        with self.lock:
+            self.refill(now)
+
+            limit_tokens = headers.get("x-ratelimit-limit-tokens")
+            if limit_tokens and limit_tokens.isdigit():
+                self.token_capacity, self.tokens = self.resize(
+                    self.token_capacity, self.tokens, int(limit_tokens)
+                )
+
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if remaining_tokens and remaining_tokens.isdigit():
+                self.tokens = min(self.tokens, int(remaining_tokens) * self.headroom)
+
+            # A daily request budget (Groq) does not size the per-minute bucket,
+            # it only blocks once it runs out
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if self.request_window <= 60:
+                limit_requests = headers.get("x-ratelimit-limit-requests")
+                if limit_requests and limit_requests.isdigit():
+                    self.request_capacity, self.requests = self.resize(
+                        self.request_capacity,
+                        self.requests,
+                        round(int(limit_requests) * 60 / self.request_window),
+                    )
+                if remaining_requests and remaining_requests.isdigit():
+                    self.requests = min(
+                        self.requests, int(remaining_requests) * self.headroom
+                    )
+
+            if remaining_requests == "0":
+                reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+            if status_code == 429:
+                retry_after = parse_duration(headers.get("retry-after"))
+                if retry_after is None:
+                    retry_after = parse_duration(
+                        headers.get("x-ratelimit-reset-tokens")
+                    )
+                retry_after = retry_after if retry_after is not None else 1.0
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                # Empty the bucket until then, so the waiting calls are spaced out
+                # at the refill rate instead of all being released together
+                self.requests = min(
+                    self.requests, -retry_after * self.request_capacity / 60
+                )
+                logger.warning(f"[RateLimit] : 429, pausing for {retry_after:.2f}s")
+
+
+@dataclass
+class RetryMetrics:
+    """
+    Counts the requests the handlers sent again, per handler and reason: the
+    status code (429, 400 for a downgraded output mode, 5xx), `unreadable`
+    for a 200 without a usable body, or `connection`.
+    """
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts: Dict[str, Counter] = {}
+
+    def record(self, handler: str, reason: str) -> None:
+        with self.lock:
+            self.counts.setdefault(handler, Counter())[reason] += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {handler: dict(counts) for handler, counts in self.counts.items()}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counts = {}
+
+
+retry_metrics = RetryMetrics()
+
+_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api_key: str, url: str = "", **kwargs) -> RateLimiter:
+    """
+    Returns the RateLimiter shared by every handler using `api_key` on the
+    host of `url`, so local servers and keyless test handlers do not share
+    the provider's budget
+    """
+    host = urlparse(url).netloc
+    with _limiters_lock:
+        if (host, api_key) not in _limiters:
+            kwargs.setdefault("request_window", REQUEST_HEADER_WINDOW.get(host, 60.0))
+            _limiters[(host, api_key)] = RateLimiter(**kwargs)
+        return _limiters[(host, api_key)]
+
+
+def test():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100000)
+    start = time.monotonic()
+    for _ in range(60):
+        limiter.acquire(100)
+    print(f"60 requests at 60 RPM took {time.monotonic() - start:.2f}s")
+    limiter.update(429, {"retry-after": "2"})
+    print(f"after 429: wait={limiter.reserve(100):.2f}s")
+    limiter = RateLimiter.unlimited()
+    print(f"unlimited: wait={limiter.reserve(100):.2f}s")
+    limiter.update(200, {"x-ratelimit-limit-requests": "120"})
+    print(f"synced to 120 RPM: capacity={limiter.request_capacity:.0f}")
+    print(parse_duration("2m59.56s"), parse_duration("120ms"), parse_duration("7.66s"))
+
+
+if __name__ == "__main__":
+    test()
@@ -1,8 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
+from enum import Enum
+import hashlib
 import json
+import multiprocessing
 import os
 from os.path import exists
-from typing import List, Optional, Dict, Union
+import threading
+from typing import Callable, Iterator, List, Optional, Dict, Tuple, Union
 from PIL import Image as pil_img
 from io import BytesIO
 import uuid
@@ -10,13 +15,22 @@ import requests
 import time
 
 from logger_module import logger
+from cassette_module import file_key, recorded
 
 # from .api_module import SummaryContentSchema
 from base_reader import HTMLtoLines, get_ebook_cls, Epub, Azw3, Mobi
 from utils import Chunker, get_chunker
+from state_module import chunk_book_path, get_store
 from pydantic import BaseModel, ValidationError
 
+# Parse chapters as the pipeline reaches them instead of all up front
+BOOK_LAZY = os.getenv("BOOK_LAZY", "0") == "1"
 
+# Processes parsing and chunking the chapters, 0 or 1 parses in this process
+BOOK_WORKERS = int(os.getenv("BOOK_WORKERS", 0))
+
+
+@recorded("file", file_key)
 def fetch_image_with_retries(
     url: str, retries: int = 3, delay: int = 2
 ) -> Optional[bytes]:
@@ -68,6 +82,44 @@ def save_audio(content: bytes, path: str) -> None:
         logger.error(f"Failed to save audio at {path}: {e}")
 
 
+# Chunker of a chapter parsing worker process, see `init_parse_worker`
+_worker_chunker: Optional[Chunker] = None
+
+
+def init_parse_worker(max_len: int, overlap: int, snap: bool) -> None:
+    global _worker_chunker
+    _worker_chunker = get_chunker(max_len=max_len, overlap=overlap, snap=snap)
+
+
+def parse_chapter(
+    html_data: str, chunker: Optional[Chunker] = None
+) -> Tuple[str, List[str]]:
+    """
+    Turns a chapter's html into its text and chunk texts.
+    Uses a parser of its own, so it can run in a worker process.
+    """
+    str_data = chapter_text(html_data)
+    chunker = chunker or _worker_chunker
+    assert chunker, "init_parse_worker was not called"
+    return str_data, chunker.chunk(str_data)
+
+
+def parse_chapters(
+    html_chapters: List[str], chunker: Chunker
+) -> List[Tuple[str, List[str]]]:
+    """parse_chapter for every chapter of a book, tokenizing them all in one batch"""
+    str_chapters = [chapter_text(html_data) for html_data in html_chapters]
+    return list(zip(str_chapters, chunker.chunk_batch(str_chapters)))
+
+
+def chapter_text(html_data: str) -> str:
+    parser = HTMLtoLines()
+    parser.feed(html_data)
+    str_data = "\n".join(parser.get_lines())
+    parser.close()
+    return str_data
+
+
 class BookArchivedState(BaseModel):
     name: str
     chunks: List[Optional[dict]]
@@ -87,28 +139,48 @@ def archive_reader(path) -> dict:
 
 def load_archived(user, name):
     book_path = f"./uploaded_books/{user}/{name}"
-    state_path = book_path + "/book_state.json"
-    if not os.path.exists(state_path):
+    store = get_store()
+    json_data = store.load_book(book_path)
+    if json_data is None:
         return False
-    with open(state_path, "r") as file:
-        data = file.read()
-    json_data = json.loads(data)
     book_state = BookState.model_validate(json_data)
+    states = store.load_book_chunks(book_path)
     chunks = book_state.chunks
     return BookArchivedState(
         name=name,
         chunks=[
-            archive_reader(
-                f"{book_path}{os.sep}{chunk.split('/')[0]}{os.sep}{chunk.split('/')[1]}/state.json"
+            (
+                ChunkState.model_validate(states[chunk]).model_dump(
+                    exclude={"prompt", "characters", "places"}
+                )
+                if chunk in states
+                else archive_reader(
+                    f"{book_path}{os.sep}{chunk.split('/')[0]}{os.sep}{chunk.split('/')[1]}/state.json"
+                )
             )
             for chunk in chunks
         ],
     )
 
 
+class Stage(Enum):
+    SUMMARY = "SUM"
+    PROMPT = "PROMPT"
+    IMAGE = "IMAGE"
+    AUDIO = "AUDIO"
+
+
+def chunk_hash(text: str) -> str:
+    """Identifies the text a ChunkState was made from"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
 class ChunkState(BaseModel):
     chunk_id: str
     chapter_id: str
+    # chunk_hash of the chunk's text, states of other text are dropped on load,
+    # "" for states saved before it was recorded
+    text_hash: str = ""
     summary: str = ""
     characters: Dict[str, str] = field(default_factory=dict)
     places: Dict[str, str] = field(default_factory=dict)
@@ -145,7 +217,14 @@ class Chunk:
     image_id: str = ""
     audio: bool = False
     chunk_state: Optional[ChunkState] = None
+    # `chunk_state` came from the book's saved states, None means there is none
+    preloaded: bool = False
     is_done: bool = False
+    # A saved state of other text was dropped, see `is_current`
+    state_dropped: bool = field(default=False, init=False)
+    listeners: List[Callable[["Chunk", Stage, bool], None]] = field(
+        default_factory=list, init=False
+    )
 
     def __post_init__(self):
         self.path = f"{self.path}/{self.chunk_id}"
@@ -156,10 +235,14 @@ class Chunk:
         logger.trace(f"Chunk : {self.chunk_id} set")
 
     def init(self):
-        if not self.load_it():
+        self.text_hash = chunk_hash(self.chunk)
+        if self.chunk_state is not None and not self.is_current(self.chunk_state):
+            self.chunk_state = None
+        if self.chunk_state is None and (self.preloaded or not self.load_it()):
             self.chunk_state = ChunkState(
                 chunk_id=self.chunk_id,
                 chapter_id=self.chapter_id,
+                text_hash=self.text_hash,
                 summary=self.summary,
                 characters=self.characters,
                 places=self.places,
@@ -191,6 +274,41 @@ class Chunk:
         self.chunk_state.places = self.places
         self.chunk_state.summary = self.summary
         self.dump_it()
+        self.notify(Stage.SUMMARY)
+
+    def set_streamed_sum(
+        self, summary: str, characters: Dict[str, str], places: Dict[str, str]
+    ):
+        """
+        Summary text streamed ahead of the full response, so the stages that
+        only need it can start. Not saved, `set_sum` follows with the result
+        """
+        self.summary = summary
+        self.characters = characters
+        self.places = places
+        self.notify(Stage.SUMMARY, partial=True)
+
+    def clear_sum(self) -> None:
+        """Drops the summary and entities, so the chunk is summarized again"""
+        self.summary = ""
+        self.characters = {}
+        self.places = {}
+
+        assert self.chunk_state
+        self.chunk_state.summary = ""
+        self.chunk_state.characters = {}
+        self.chunk_state.places = {}
+        self.dump_it()
+
+    def set_entities(self, characters: Dict[str, str], places: Dict[str, str]):
+        """Updates characters/places of an already summarized chunk, without notifying"""
+        self.characters = characters
+        self.places = places
+
+        assert self.chunk_state
+        self.chunk_state.characters = self.characters
+        self.chunk_state.places = self.places
+        self.dump_it()
 
     def set_prompt(self, scene_title: str, prompt: str):
         self.scene_title = scene_title
@@ -200,6 +318,7 @@ class Chunk:
         self.chunk_state.prompt = self.prompt
         self.chunk_state.scene_title = self.scene_title
         self.dump_it()
+        self.notify(Stage.PROMPT)
 
     def set_img(self, url: str, task_id: str):
         self.image_url = url
@@ -212,6 +331,7 @@ class Chunk:
         except Exception as e:
             print("error saving image : ", e)
         self.dump_it()
+        self.notify(Stage.IMAGE)
 
     def set_audio(self, content: bytes):
         temp_path = f"{self.path}/audio.mp3"
@@ -220,6 +340,31 @@ class Chunk:
         self.chunk_state.audio = True
         save_audio(content=content, path=temp_path)
         self.dump_it()
+        self.notify(Stage.AUDIO)
+
+    def is_stage_done(self, stage: Stage) -> bool:
+        if stage == Stage.SUMMARY:
+            return self.summary != ""
+        elif stage == Stage.PROMPT:
+            return self.prompt != ""
+        elif stage == Stage.IMAGE:
+            return self.image_url != ""
+        return self.audio
+
+    def add_listener(self, listener: Callable[["Chunk", Stage, bool], None]) -> None:
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[["Chunk", Stage, bool], None]) -> None:
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, stage: Stage, partial: bool = False) -> None:
+        """
+        Tells listeners (the stage scheduler) that `stage` finished on this
+        chunk, or with `partial` that its output is streaming in
+        """
+        for listener in list(self.listeners):
+            listener(self, stage, partial)
 
     def get_sum(self):
         return SummaryContentSchema(
@@ -237,21 +382,42 @@ class Chunk:
 
     def dump_it(self):
         assert self.chunk_state is not None
-        json_state = self.chunk_state.model_dump_json(indent=4)
-
-        with open(f"{self.path}/state.json", "w") as file:
-            file.write(json_state)
+        get_store().save_chunk(
+            chunk_book_path(self.path), self.path, self.chunk_state.model_dump()
+        )
 
     def load_it(self):
-        state_path = f"{self.path}/state.json"
-        if os.path.exists(state_path):
-            with open(state_path, "r") as file:
-                try:
-                    self.chunk_state = ChunkState.model_validate_json(file.read())
-                except ValidationError:
-                    return False
-                logger.info("Loading chunk from state")
-                return True
+        state = get_store().load_chunk(
+            chunk_book_path(self.path), self.path, self.chapter_id, self.chunk_id
+        )
+        if state is None:
+            return False
+        try:
+            chunk_state = ChunkState.model_validate(state)
+        except ValidationError:
+            return False
+        if not self.is_current(chunk_state):
+            return False
+        self.chunk_state = chunk_state
+        logger.info("Loading chunk from state")
+        return True
+
+    def is_current(self, chunk_state: ChunkState) -> bool:
+        """
+        False for a state saved for other text under this chunk's id, e.g.
+        before the chunker changed its boundaries. States saved before they
+        recorded their text are kept, and get the hash on their next save
+        """
+        if chunk_state.text_hash == self.text_hash:
+            return True
+        if not chunk_state.text_hash:
+            chunk_state.text_hash = self.text_hash
+            return True
+        self.state_dropped = True
+        logger.warning(
+            f"Chunk : {self.chapter_id}/{self.chunk_id} text changed, dropping its saved state"
+        )
+        return False
 
     def __repr__(self) -> str:
         return f"{self.chapter_id}:{self.scene_title}"
@@ -268,6 +434,9 @@ class Chapter:
     str_data: str
     html_data: str
     chapter_path: str
+    # Every saved chunk state of the book, None to have each chunk read its own
+    chunk_states: Optional[Dict[str, ChunkState]] = None
+    chunk_texts: Optional[List[str]] = None
     chunks: List[Chunk] = field(init=False)
 
     def __post_init__(self) -> None:
@@ -278,6 +447,8 @@ class Chapter:
         logger.trace(f"Chapter : {self.chapter_id} set")
 
     def set_chunks(self) -> None:
+        if self.chunk_texts is None:
+            self.chunk_texts = self.chunker.chunk(self.str_data)
         self.chunks = [
             Chunk(
                 chunk_id=f"{idx + 1}",
@@ -285,8 +456,12 @@ class Chapter:
                 user_id=self.user_id,
                 chunk=chunk,
                 path=self.chapter_path,
+                chunk_state=(self.chunk_states or {}).get(
+                    f"{self.chapter_id}/{idx + 1}"
+                ),
+                preloaded=self.chunk_states is not None,
             )
-            for idx, chunk in enumerate(self.chunker.chunk(self.str_data))
+            for idx, chunk in enumerate(self.chunk_texts)
         ]
 
     def get_chunks_str(self) -> List[str]:
@@ -328,6 +503,11 @@ class Book:
         },
     )
     book_state: Optional[BookState] = None
+    lazy: bool = BOOK_LAZY
+    workers: int = BOOK_WORKERS
+    listeners: List[Callable[[Optional[Chapter]], None]] = field(
+        default_factory=list, init=False
+    )
 
     def __post_init__(self):
         if not self.name:
@@ -353,14 +533,115 @@ class Book:
         if file_toc:
             self.toc = file_toc
         logger.trace("got toc")
-        self.parser = HTMLtoLines()
-        self.chapters = [
-            self.set_chapters(id=idx + 1, chapter_name=name)
-            for idx, name in enumerate(self.toc)
-        ]
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.parsed: Optional[Iterator[Tuple[str, Tuple[str, List[str]]]]] = None
+        if self.workers > 1:
+            self.start_pool()
+        elif not self.lazy:
+            self.start_batch()
+        # Every saved chunk state of the book in one read, instead of one per
+        # chunk. Final for the book, a chunk missing from it has no state yet
+        self.chunk_states = {
+            key: ChunkState.model_validate(state)
+            for key, state in get_store().load_book_chunks(self.path_content).items()
+        }
+        self.load_lock = threading.RLock()
+        self.loaded = False
+        if self.lazy:
+            # Chapters are parsed as they are reached, see `iter_chapters`
+            self.load_it()
+            if not self.book_state:
+                self.book_state = BookState(
+                    name=self.name, book_id=self.book_id, chunks=[]
+                )
+        else:
+            self.load_all()
+
+    def load_next_chapter(self) -> Optional[Chapter]:
+        """Parses and chunks the next chapter of the toc, None once every chapter is loaded"""
+        with self.load_lock:
+            if self.loaded:
+                return None
+            chapter = None
+            if len(self.chapters) < len(self.toc):
+                idx = len(self.chapters)
+                chapter = self.set_chapters(id=idx + 1, chapter_name=self.toc[idx])
+                if any(chunk.state_dropped for chunk in chapter.chunks):
+                    self.reset_done()
+                self.chapters.append(chapter)
+                self.notify(chapter)
+            if len(self.chapters) == len(self.toc):
+                self.finish_loading()
+            return chapter
+
+    def start_pool(self) -> None:
+        """
+        Parses and chunks the chapters on `workers` processes, results are
+        taken in toc order by `set_chapters`
+        """
+        assert self.file
+        html_chapters = [self.file.get_raw_text(name) for name in self.toc]
+        # The state writer thread is already running, forking would copy its locks
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_parse_worker,
+            initargs=(self.chunker.max_len, self.chunker.overlap, self.chunker.snap),
+        )
+        self.parsed = zip(
+            html_chapters, self.pool.map(parse_chapter, html_chapters, chunksize=1)
+        )
+
+    def start_batch(self) -> None:
+        """Parses every chapter up front and tokenizes them in one batch"""
+        assert self.file
+        html_chapters = [self.file.get_raw_text(name) for name in self.toc]
+        self.parsed = zip(html_chapters, parse_chapters(html_chapters, self.chunker))
+
+    def finish_loading(self) -> None:
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        self.parsed = None
+        self.loaded = True
         logger.info(f"Total Chunks {len(self.get_chunks())}")
         self.init_state()
         self.load_it()
+        self.notify(None)
+
+    def load_all(self) -> None:
+        while self.load_next_chapter():
+            pass
+
+    def iter_chapters(self) -> Iterator[Chapter]:
+        """Yields chapters in order, parsing each one only when it is reached"""
+        idx = 0
+        while True:
+            with self.load_lock:
+                if idx < len(self.chapters):
+                    chapter = self.chapters[idx]
+                else:
+                    chapter = self.load_next_chapter()
+            if chapter is None:
+                return
+            yield chapter
+            idx += 1
+
+    def iter_chunks(self) -> Iterator[Chunk]:
+        for chapter in self.iter_chapters():
+            yield from chapter.get_chunks()
+
+    def add_listener(self, listener: Callable[[Optional[Chapter]], None]) -> None:
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Optional[Chapter]], None]) -> None:
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, chapter: Optional[Chapter]) -> None:
+        """Tells listeners (the stage scheduler) about a loaded chapter, None once the book is loaded"""
+        for listener in list(self.listeners):
+            listener(chapter)
 
     def init_state(self):
         dump_chunks = [f"{i.chapter_id}/{i.chunk_id}" for i in self.get_chunks()]
@@ -371,10 +652,11 @@ class Book:
 
     def set_chapters(self, id, chapter_name: str) -> Chapter:
         assert self.file
-        html_data: str = self.file.get_raw_text(chapter_name)
-        self.parser.feed(html_data)
-        str_data = "\n".join(self.parser.get_lines())
-        self.parser.close()
+        if self.parsed is not None:
+            html_data, (str_data, chunk_texts) = next(self.parsed)
+        else:
+            html_data = self.file.get_raw_text(chapter_name)
+            str_data, chunk_texts = parse_chapter(html_data, self.chunker)
         return Chapter(
             chapter_id=str(id),
             user_id=self.user_id,
@@ -383,6 +665,8 @@ class Book:
             html_data=html_data,
             chunker=self.chunker,
             chapter_path=self.path_content,
+            chunk_states=self.chunk_states,
+            chunk_texts=chunk_texts,
         )
 
     def get_toc(self) -> list:
@@ -398,9 +682,14 @@ class Book:
         return {i.get_title(): i.get_html_data() for i in self.chapters}
 
     def get_chunks(self) -> List[Chunk]:
+        self.load_all()
+        return self.get_loaded_chunks()
+
+    def get_loaded_chunks(self) -> List[Chunk]:
         return [chunk for chapter in self.chapters for chunk in chapter.chunks]
 
     def get_chapters(self) -> List[Chapter]:
+        self.load_all()
         return self.chapters
 
     def is_sum_done(self) -> bool:
@@ -415,6 +704,10 @@ class Book:
     def is_img_done(self) -> bool:
         return all(i.image_url != "" for i in self.get_chunks())
 
+    def pending(self, stage: Stage) -> List[str]:
+        """Saved chunks ("chapter_id/chunk_id") where `stage` is not done yet"""
+        return get_store().pending(self.path_content, stage.value)
+
     def is_done(self):
         assert self.book_state
         if self.is_sum_done() and self.is_prompt_done() and self.is_img_done():
@@ -424,33 +717,52 @@ class Book:
         else:
             return False
 
+    def reset_done(self) -> None:
+        """Chunk states of the book were dropped, so a done book has to be processed again"""
+        if self.book_state and self.book_state.is_done:
+            logger.info(f"[Book] : {self.name} changed, no longer done")
+            self.book_state.is_done = False
+            self.dump_it()
+
     def dump_it(self):
         assert self.book_state
-        json_state = self.book_state.model_dump_json(indent=4)
-        with open(f"{self.path_content}/book_state.json", "w") as file:
-            file.write(json_state)
+        get_store().save_book(self.path_content, self.book_state.model_dump())
 
     def load_it(self):
-        book_state_path = f"{self.path_content}/book_state.json"
-        if os.path.exists(book_state_path):
-            with open(book_state_path, "r") as file:
-                try:
-                    self.book_state = BookState.model_validate_json(file.read())
-                except ValidationError:
-                    return False
+        state = get_store().load_book(self.path_content)
+        if state is not None:
+            try:
+                self.book_state = BookState.model_validate(state)
+            except ValidationError:
+                return False
 
     def __repr__(self) -> str:
         return f"Name:{self.name} , Chapters:{len(self.chapters)}, Chunks : {len(self.get_chunks())}"
 
 
+def open_book(
+    book: Union[Book, str],
+    lazy: bool = BOOK_LAZY,
+    workers: int = BOOK_WORKERS,
+    **kwargs,
+) -> Book:
+    """`book` itself, or the Book at path `book` loaded with `lazy` and `workers`"""
+    if isinstance(book, Book):
+        return book
+    return Book(book, lazy=lazy, workers=workers, **kwargs)
+
+
 def test():
     state = load_archived(user="b5bfc116-dd81-475a-8425-537a50621706", name="AF")
     print(state)
 
 
 def main() -> None:
+    import sys
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else BOOK_WORKERS
     book: Book = Book(
-        "./test_books/LP.epub"
+        "./test_books/LP.epub", workers=workers
     )  # , user_id="b5bfc116-dd81-475a-8425-537a50621706"
     print(len(book.chapters))
     # for i in book.get_chunks():
@@ -0,0 +1,187 @@
+from collections import Counter
+from dataclasses import dataclass
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from logger_module import logger
+
+_BAREWORD = re.compile(r"[^\s,:\[\]{}\"'`]+")
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_NEXT_KEY = re.compile(r"\"[^\"\n]*\"\s*:")
+_LITERALS = {
+    "true": "true",
+    "false": "false",
+    "null": "null",
+    "True": "true",
+    "False": "false",
+    "None": "null",
+}
+_ESCAPES = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "b": "\b",
+    "f": "\f",
+    "/": "/",
+    "\\": "\\",
+    '"': '"',
+    "'": "'",
+}
+
+
+def read_string(text: str, start: int) -> Tuple[str, int]:
+    """
+    Reads the string opened by the quote at `start`, returns its value and the
+    index after it. A quote only closes the string when what follows it can
+    follow a string (, : } ] or the next "key":), otherwise it is taken as an
+    unescaped quote inside the string. An unterminated string runs to the end.
+    """
+    quote = text[start]
+    chars: List[str] = []
+    idx = start + 1
+    while idx < len(text):
+        char = text[idx]
+        if char == "\\" and idx + 1 < len(text):
+            escaped = text[idx + 1]
+            if escaped == "u" and re.fullmatch(
+                r"[0-9a-fA-F]{4}", text[idx + 2 : idx + 6]
+            ):
+                chars.append(chr(int(text[idx + 2 : idx + 6], 16)))
+                idx += 6
+            else:
+                chars.append(_ESCAPES.get(escaped, escaped))
+                idx += 2
+            continue
+        if char == quote:
+            after = idx + 1
+            while after < len(text) and text[after].isspace():
+                after += 1
+            if (
+                after >= len(text)
+                or text[after] in ",:}]`"
+                or _NEXT_KEY.match(text, after)
+            ):
+                return "".join(chars), idx + 1
+        chars.append(char)
+        idx += 1
+    return "".join(chars), idx
+
+
+def repair_json(text: str) -> Optional[Any]:
+    """
+    Parses the JSON value in `text` the way a model tends to get it wrong:
+    prose or code fences around it, single quoted strings, unescaped quotes
+    and raw newlines inside strings, trailing or missing commas, Python
+    literals, unquoted keys, and output cut off before the end (the open
+    string and containers are closed, a dangling key is dropped).
+    Returns None when nothing parseable is left.
+    """
+    starts = [idx for idx in (text.find("{"), text.find("[")) if idx != -1]
+    if not starts:
+        return None
+
+    out: List[str] = []
+    closers: List[str] = []
+
+    def add_value(token: str) -> None:
+        # Two values in a row inside a container are missing the comma between them
+        if out and out[-1] not in "{[,:":
+            out.append(",")
+        out.append(token)
+
+    idx = min(starts)
+    while idx < len(text):
+        char = text[idx]
+        if char in "\"'":
+            value, idx = read_string(text, idx)
+            add_value(json.dumps(value, ensure_ascii=False))
+            continue
+        if char in "{[":
+            add_value(char)
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not closers:
+                break
+            if out[-1] == ",":
+                out.pop()
+            out.append(closers.pop())
+            if not closers:  # The value is complete, ignore whatever follows
+                break
+        elif char in ",:":
+            if out[-1] not in "{[,:":
+                out.append(char)
+        elif not char.isspace() and char != "`":
+            match = _BAREWORD.match(text, idx)
+            assert match
+            word = match.group()
+            idx = match.end()
+            if word in _LITERALS:
+                add_value(_LITERALS[word])
+            elif _NUMBER.fullmatch(word):
+                add_value(word)
+            else:
+                add_value(json.dumps(word, ensure_ascii=False))
+            continue
+        idx += 1
+
+    # Cut off output: drop what cannot be completed, then close what is open
+    while out and closers:
+        if out[-1] == ",":
+            out.pop()
+        elif out[-1] == ":":
+            del out[-2:]
+        elif closers[-1] == "}" and out[-1].startswith('"') and out[-2] in "{,":
+            out.pop()  # A key without its value
+        else:
+            break
+    out.extend(reversed(closers))
+
+    try:
+        return json.loads("".join(out))
+    except json.JSONDecodeError:
+        return None
+
+
+@dataclass
+class RepairMetrics:
+    """
+    Counts how each schema's model output was parsed: `valid` as is,
+    `repaired` locally by repair_json, or `failed`, which costs an LLM repair
+    round-trip.
+    """
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts: Dict[str, Counter] = {}
+
+    def record(self, schema: str, outcome: str) -> None:
+        with self.lock:
+            self.counts.setdefault(schema, Counter())[outcome] += 1
+        if outcome == "repaired":
+            logger.info(f"[Repair] : {schema} output repaired locally")
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {schema: dict(counts) for schema, counts in self.counts.items()}
+
+
+repair_metrics = RepairMetrics()
+
+
+def test():
+    samples = [
+        '```json\n{"summary": "Old Major\'s dream", "characters": {},}\n```',
+        "Here it is: {'scene_title': 'The barn', 'prompt': 'A barn at night'}",
+        '{"summary": "He said "hello" to them", "places": {"Barn": "Red"}}',
+        '{"summary": "The animals meet", "characters": {"Boxer": "A huge horse',
+        '{"summary": "a"\n"characters": {"Boxer": "strong"}, "places": {"Farm": ',
+        '{"prompt": "line one\nline two", "scene_title": None, count: 3}',
+    ]
+    for sample in samples:
+        print(repair_json(sample))
+
+
+if __name__ == "__main__":
+    test()
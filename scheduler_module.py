@@ -0,0 +1,280 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import asyncio
+import queue
+import threading
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from logger_module import logger
+from reader_new import Book, Chapter, Chunk, Stage
+
+# Times a worker may hand a chunk back before the stage gives up on it
+MAX_STAGE_ATTEMPTS = 3
+
+# Stages that can start on a chunk once the key stage is done on it
+DEPENDENTS: Dict[Stage, List[Stage]] = {
+    Stage.SUMMARY: [Stage.PROMPT, Stage.AUDIO],
+    Stage.PROMPT: [Stage.IMAGE],
+    Stage.IMAGE: [],
+    Stage.AUDIO: [],
+}
+
+# Dependents that can already start while the key stage's output streams in
+# (the summary text is complete, characters/places are still being generated)
+STREAMED: Dict[Stage, List[Stage]] = {
+    Stage.SUMMARY: [Stage.AUDIO, Stage.PROMPT],
+}
+
+# Stages that must be done on a chunk before the key stage can start on it
+UPSTREAM: Dict[Stage, List[Stage]] = {
+    Stage.SUMMARY: [],
+    Stage.PROMPT: [Stage.SUMMARY],
+    Stage.IMAGE: [Stage.PROMPT],
+    Stage.AUDIO: [Stage.SUMMARY],
+}
+
+
+def chunk_key(chunk: Chunk) -> str:
+    return f"{chunk.chapter_id}/{chunk.chunk_id}"
+
+
+def run_workers(worker: Callable[[], None], concurrency: int) -> None:
+    """Runs `worker` in `concurrency` threads, returns once every one of them has"""
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_coroutine(main: Callable[[], Coroutine[Any, Any, None]]) -> None:
+    """
+    asyncio.run(main()), on a thread of its own when this thread already runs
+    an event loop (e.g. an aiohttp handler), where asyncio.run would raise
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(main())
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(lambda: asyncio.run(main())).result()
+
+
+@dataclass
+class BaseStageScheduler:
+    """
+    Hands chunks to stage workers as soon as their upstream stages are done.
+
+    Every chunk of the book reports back through `Chunk.notify` when one of
+    its stages finishes, which queues it for the dependent stages. Workers
+    wait on the scheduler instead of rescanning the book (`get` of the
+    threaded StageScheduler, `aget` of the AsyncStageScheduler), which returns
+    None once every chunk has been resolved (done or given up) for that
+    stage. Chunks of a lazy book are picked up as its chapters get loaded.
+    """
+
+    book: Book
+    max_attempts: int = MAX_STAGE_ATTEMPTS
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.queues = {stage: self.make_queue() for stage in Stage}
+        self.remaining: Dict[Stage, set] = {stage: set() for stage in Stage}
+        self.closed: Dict[Stage, bool] = {stage: False for stage in Stage}
+        self.attempts: Dict[Tuple[Stage, str], int] = {}
+        # (stage, chunk) queued ahead of a streamed upstream, not to be queued again
+        self.started: set = set()
+
+        with self.book.load_lock:
+            for chunk in self.book.get_loaded_chunks():
+                self.track(chunk)
+            self.book.add_listener(self.on_chapter_loaded)
+            loaded = self.book.loaded
+
+        if loaded:
+            self.close_empty_stages()
+        logger.info(
+            f"[Scheduler] : Pending "
+            + " | ".join(f"{s.name}={len(self.remaining[s])}" for s in Stage)
+        )
+
+    def track(self, chunk: Chunk) -> None:
+        chunk.add_listener(self.on_stage_done)
+        for stage in Stage:
+            if chunk.is_stage_done(stage):
+                continue
+            with self.lock:
+                self.remaining[stage].add(chunk_key(chunk))
+            if UPSTREAM[stage] and self.is_ready(chunk, stage):
+                self.put(stage, chunk)
+
+    def on_chapter_loaded(self, chapter: Optional[Chapter]) -> None:
+        if chapter is None:
+            self.close_empty_stages()
+            return
+        for chunk in chapter.get_chunks():
+            self.track(chunk)
+
+    def close_empty_stages(self) -> None:
+        for stage in Stage:
+            with self.lock:
+                empty = not self.remaining[stage]
+            if empty:
+                self.close_stage(stage)
+
+    def make_queue(self) -> queue.Queue:
+        return queue.Queue()
+
+    def put(self, stage: Stage, chunk: Optional[Chunk]) -> None:
+        self.queues[stage].put(chunk)
+
+    def is_ready(self, chunk: Chunk, stage: Stage) -> bool:
+        return all(chunk.is_stage_done(upstream) for upstream in UPSTREAM[stage])
+
+    def get_nowait(self, stage: Stage) -> Optional[Chunk]:
+        """A chunk already waiting for `stage`, None if there is none (or the stage is finished)"""
+        stage_queue = self.queues[stage]
+        while True:
+            try:
+                chunk = stage_queue.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                return None
+            if chunk is None:
+                stage_queue.put_nowait(None)
+                return None
+            if chunk.is_stage_done(stage):
+                continue
+            return chunk
+
+    def on_stage_done(self, chunk: Chunk, stage: Stage, partial: bool = False) -> None:
+        if partial:
+            self.on_stage_streamed(chunk, stage)
+            return
+        self.resolve(chunk, stage)
+        for dependent in DEPENDENTS[stage]:
+            with self.lock:
+                started = (dependent, chunk_key(chunk)) in self.started
+            if started:
+                continue
+            if not chunk.is_stage_done(dependent) and self.is_ready(chunk, dependent):
+                self.put(dependent, chunk)
+
+        if all(chunk.is_stage_done(s) for s in Stage):
+            chunk.is_done = True
+            chunk.set_state()
+            logger.trace(f"[Scheduler] : Chunk {chunk_key(chunk)} Done")
+
+    def on_stage_streamed(self, chunk: Chunk, stage: Stage) -> None:
+        for dependent in STREAMED.get(stage, []):
+            key = (dependent, chunk_key(chunk))
+            with self.lock:
+                if key in self.started:
+                    continue
+                self.started.add(key)
+            if not chunk.is_stage_done(dependent):
+                self.put(dependent, chunk)
+
+    def retry(self, chunk: Chunk, stage: Stage) -> None:
+        """Called by a worker that failed `stage` on `chunk`"""
+        key = (stage, chunk_key(chunk))
+        with self.lock:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            attempts = self.attempts[key]
+        if attempts < self.max_attempts:
+            self.put(stage, chunk)
+            return
+        logger.error(
+            f"[Scheduler] : {stage.name} failed {attempts} times on {chunk_key(chunk)}, SKIPPING..."
+        )
+        self.abandon(chunk, stage)
+
+    def abandon(self, chunk: Chunk, stage: Stage) -> None:
+        """Gives up on `stage` for `chunk`, and on every stage depending on it"""
+        self.resolve(chunk, stage)
+        for dependent in DEPENDENTS[stage]:
+            if not chunk.is_stage_done(dependent):
+                self.abandon(chunk, dependent)
+
+    def finish(self, stage: Stage) -> None:
+        """Called by a producer that will not touch `stage` again"""
+        for chunk in self.book.get_chunks():
+            if chunk_key(chunk) in self.remaining[stage]:
+                logger.warning(
+                    f"[Scheduler] : {stage.name} missing on {chunk_key(chunk)}, skipping its dependents"
+                )
+                self.abandon(chunk, stage)
+
+    def resolve(self, chunk: Chunk, stage: Stage) -> None:
+        with self.lock:
+            self.remaining[stage].discard(chunk_key(chunk))
+            # More chunks may still come while the book is loading
+            if self.remaining[stage] or not self.book.loaded:
+                return
+        self.close_stage(stage)
+
+    def close_stage(self, stage: Stage) -> None:
+        with self.lock:
+            if self.closed[stage]:
+                return
+            self.closed[stage] = True
+        self.put(stage, None)
+        logger.info(f"[Scheduler] : {stage.name} Done for ALL Chunks")
+
+    def close(self) -> None:
+        """Detaches from the book and its chunks once the run is over"""
+        self.book.remove_listener(self.on_chapter_loaded)
+        for chunk in self.book.get_chunks():
+            chunk.remove_listener(self.on_stage_done)
+
+
+@dataclass
+class StageScheduler(BaseStageScheduler):
+    """Scheduler of the threaded engine, workers block on `get`"""
+
+    def get(self, stage: Stage) -> Optional[Chunk]:
+        """Blocks until a chunk is ready for `stage`, None when the stage is finished"""
+        stage_queue = self.queues[stage]
+        while True:
+            chunk = stage_queue.get()
+            if chunk is None:
+                # Put the sentinel back so every worker of this stage stops
+                stage_queue.put(None)
+                return None
+            if chunk.is_stage_done(stage):
+                continue
+            return chunk
+
+
+@dataclass
+class AsyncStageScheduler(BaseStageScheduler):
+    """
+    Scheduler of the asyncio engine, workers await `aget` on the event loop.
+
+    Stage updates may still come from worker threads (the summary chain, image
+    downloads), so chunks are handed to the loop with `call_soon_threadsafe`.
+    Must be created from inside the running loop.
+    """
+
+    def __post_init__(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        super().__post_init__()
+
+    def make_queue(self) -> asyncio.Queue:
+        return asyncio.Queue()
+
+    def put(self, stage: Stage, chunk: Optional[Chunk]) -> None:
+        self.loop.call_soon_threadsafe(self.queues[stage].put_nowait, chunk)
+
+    async def aget(self, stage: Stage) -> Optional[Chunk]:
+        """Waits until a chunk is ready for `stage`, None when the stage is finished"""
+        stage_queue = self.queues[stage]
+        while True:
+            chunk = await stage_queue.get()
+            if chunk is None:
+                # Put the sentinel back so every worker of this stage stops
+                stage_queue.put_nowait(None)
+                return None
+            if chunk.is_stage_done(stage):
+                continue
+            return chunk
@@ -0,0 +1,425 @@
+"""
+Local stand-in for the providers behind `test_process_book`: `/sum` and
+`/prompt` (Groq chat completions, streamed too), `/image` (Runware) and
+`/audio` (TTS). Responses are schema-valid and sized after the request, each
+route has its own latency distribution, and 429s, 5xx, json_validate_failed
+errors and a requests-per-minute limit can be injected, so benchmarks run
+reproducibly without API credits.
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+from PIL import Image as pil_img
+
+from logger_module import logger
+
+SIMULATOR_HOST = os.getenv("SIM_HOST", "127.0.0.1")
+SIMULATOR_PORT = int(os.getenv("SIM_PORT", 8000))
+
+# Latency of each route as <distribution>:<a>:<b>, see `Latency`
+ROUTE_LATENCY = {
+    "sum": os.getenv("SIM_SUM_LATENCY", "lognormal:1.2:0.4"),
+    "prompt": os.getenv("SIM_PROMPT_LATENCY", "lognormal:0.8:0.4"),
+    "image": os.getenv("SIM_IMAGE_LATENCY", "lognormal:3.0:0.3"),
+    "audio": os.getenv("SIM_AUDIO_LATENCY", "lognormal:1.0:0.3"),
+}
+
+# Multiplies every latency, e.g. 0.1 for a quick run with the same shape
+LATENCY_SCALE = float(os.getenv("SIM_LATENCY_SCALE", 1.0))
+
+# Share of requests answered with an injected error, on every route
+RATE_429 = float(os.getenv("SIM_RATE_429", 0))
+RATE_5XX = float(os.getenv("SIM_RATE_5XX", 0))
+RATE_JSON_ERROR = float(os.getenv("SIM_RATE_JSON_ERROR", 0))  # Chat routes only
+
+# Requests per minute each route accepts before answering 429, 0 for no limit
+REQUESTS_PER_MINUTE = int(os.getenv("SIM_REQUESTS_PER_MINUTE", 0))
+TOKENS_PER_MINUTE = int(os.getenv("SIM_TOKENS_PER_MINUTE", 1_000_000))
+
+SEED = int(os.getenv("SIM_SEED", 0))
+
+# Size of the generated audio, about a minute of 32kbps MP3
+AUDIO_BYTES = int(os.getenv("SIM_AUDIO_BYTES", 240_000))
+
+_WORD = re.compile(r"[A-Za-z][\w'-]*")
+_PLACE = re.compile(r"\b(?:in|at|to|from) (?:the )?([A-Z][a-z]+(?: [A-Z][a-z]+)?)")
+
+
+@dataclass
+class Latency:
+    """
+    A latency distribution in seconds:
+        fixed:<seconds>
+        uniform:<low>:<high>
+        lognormal:<median>:<sigma>  (long right tail, like real providers)
+    """
+
+    distribution: str = "fixed"
+    a: float = 0.0
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        distribution, *values = spec.split(":")
+        numbers = [float(value) for value in values] + [0.0, 0.0]
+        return cls(distribution=distribution, a=numbers[0], b=numbers[1])
+
+    def sample(self, rng: random.Random) -> float:
+        if self.distribution == "uniform":
+            return rng.uniform(self.a, self.b)
+        if self.distribution == "lognormal":
+            return rng.lognormvariate(0, self.b) * self.a
+        return self.a
+
+
+@dataclass
+class RouteConfig:
+    latency: Latency
+    rate_429: float = RATE_429
+    rate_5xx: float = RATE_5XX
+    rate_json_error: float = RATE_JSON_ERROR
+    requests_per_minute: int = REQUESTS_PER_MINUTE
+
+
+def default_routes() -> Dict[str, RouteConfig]:
+    return {
+        route: RouteConfig(latency=Latency.parse(spec))
+        for route, spec in ROUTE_LATENCY.items()
+    }
+
+
+def words(text: str, count: int) -> str:
+    return " ".join(text.split()[:count])
+
+
+def summary_output(text: str) -> dict:
+    """A SummaryResponseSchema shaped answer built from the chunk text"""
+    names = Counter(
+        word
+        for idx, word in enumerate(_WORD.findall(text))
+        if idx and word[0].isupper() and len(word) > 2
+    )
+    characters = {
+        name: f"{name} appears {count} times in this part of the story."
+        for name, count in names.most_common(4)
+    }
+    places = {
+        place: f"A place the story passes through, {place}."
+        for place in dict.fromkeys(_PLACE.findall(text))
+        if place not in characters
+    }
+    return {
+        "summary": words(text, 120),
+        "characters": characters,
+        "places": dict(list(places.items())[:2]),
+    }
+
+
+def prompt_output(text: str) -> dict:
+    return {
+        "scene_title": words(text, 5),
+        "prompt": f"A detailed illustration of {words(text, 45)}",
+    }
+
+
+def chat_output(route: str, messages: List[dict]) -> dict:
+    """The JSON the model would generate for the last user message on `route`"""
+    content = messages[-1]["content"] if messages else ""
+    try:
+        request = json.loads(content)
+    except json.JSONDecodeError:
+        request = {}
+    if not isinstance(request, dict):
+        request = {}
+
+    if "chunks" in request:  # PromptBatchContentSchema
+        return {
+            "prompts": [
+                {**prompt_output(item.get("input_text", "")), "id": item.get("id")}
+                for item in request["chunks"]
+            ]
+        }
+    if "current_summary" in request:  # SummaryStitchContentSchema
+        return {"summary": request["current_summary"]}
+    if route == "sum":
+        return summary_output(request.get("current_chapter", content))
+    return prompt_output(request.get("input_text", content))
+
+
+@dataclass
+class SimulatorStats:
+    """Requests, outcomes and served latencies of each route"""
+
+    def __post_init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.outcomes: Dict[str, Counter] = {}
+            self.latencies: Dict[str, List[float]] = {}
+
+    def record(self, route: str, outcome: str, latency: float) -> None:
+        with self.lock:
+            self.outcomes.setdefault(route, Counter())[outcome] += 1
+            self.latencies.setdefault(route, []).append(latency)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {route: dict(counts) for route, counts in self.outcomes.items()}
+
+
+@dataclass
+class ProviderSimulator:
+    host: str = SIMULATOR_HOST
+    port: int = SIMULATOR_PORT
+    routes: Dict[str, RouteConfig] = field(default_factory=default_routes)
+    latency_scale: float = LATENCY_SCALE
+    tokens_per_minute: int = TOKENS_PER_MINUTE
+    seed: int = SEED
+
+    def __post_init__(self) -> None:
+        self.rng = random.Random(self.seed)
+        self.stats = SimulatorStats()
+        # Accepted request times of each route, for the requests-per-minute limit
+        self.windows: Dict[str, List[float]] = {route: [] for route in self.routes}
+        self.image_bytes = self.make_image()
+        self.audio_bytes = self.make_audio()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def make_image(self) -> bytes:
+        buffer = io.BytesIO()
+        pil_img.new("RGB", (512, 512), (96, 128, 160)).save(buffer, format="WEBP")
+        return buffer.getvalue()
+
+    def make_audio(self) -> bytes:
+        # MPEG-1 layer III frame header, the rest is silence for the players
+        return b"\xff\xfb\x90\x64" + bytes(max(0, AUDIO_BYTES - 4))
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/sum", self.chat)
+        app.router.add_post("/prompt", self.chat)
+        app.router.add_post("/image", self.image)
+        app.router.add_get("/images/{name}", self.image_file)
+        app.router.add_get("/audio", self.audio)
+        return app
+
+    def rate_limited(self, route: str) -> Optional[float]:
+        """Seconds until `route` accepts a request again, None when it accepts one now"""
+        limit = self.routes[route].requests_per_minute
+        if not limit:
+            return None
+        now = time.monotonic()
+        window = self.windows[route]
+        while window and window[0] <= now - 60:
+            window.pop(0)
+        if len(window) >= limit:
+            return window[0] + 60 - now
+        window.append(now)
+        return None
+
+    def limit_headers(self, route: str) -> Dict[str, str]:
+        limit = self.routes[route].requests_per_minute
+        headers = {"x-ratelimit-limit-tokens": str(self.tokens_per_minute)}
+        if limit:
+            headers["x-ratelimit-limit-requests"] = str(limit)
+            headers["x-ratelimit-remaining-requests"] = str(
+                max(0, limit - len(self.windows[route]))
+            )
+        return headers
+
+    async def serve_fault(self, route: str) -> Tuple[Optional[web.Response], float]:
+        """
+        Spends the route's latency, then returns an injected fault (rate limit,
+        429 or 5xx) or None, along with the latency spent.
+        """
+        config = self.routes[route]
+        latency = config.latency.sample(self.rng) * self.latency_scale
+        wait = self.rate_limited(route)
+        if wait is not None:
+            self.stats.record(route, "rate_limited", 0.0)
+            return (
+                web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status=429,
+                    headers={**self.limit_headers(route), "retry-after": f"{wait:.2f}"},
+                ),
+                0.0,
+            )
+
+        draw = self.rng.random()
+        if draw < config.rate_429:
+            latency *= 0.1
+            await asyncio.sleep(latency)
+            self.stats.record(route, "429", latency)
+            return (
+                web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "tokens"}},
+                    status=429,
+                    headers={**self.limit_headers(route), "retry-after": "1"},
+                ),
+                latency,
+            )
+        if draw < config.rate_429 + config.rate_5xx:
+            status = self.rng.choice([500, 502, 503])
+            await asyncio.sleep(latency)
+            self.stats.record(route, str(status), latency)
+            return (
+                web.json_response(
+                    {"error": {"message": "Internal server error"}}, status=status
+                ),
+                latency,
+            )
+        await asyncio.sleep(latency)
+        return None, latency
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        route = request.path.strip("/")
+        body = await request.json()
+        fault, latency = await self.serve_fault(route)
+        if fault is not None:
+            return fault
+
+        output = json.dumps(chat_output(route, body.get("messages", [])))
+        prompt_tokens = (
+            sum(len(message.get("content", "")) for message in body.get("messages", []))
+            // 4
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(output) // 4,
+            "total_tokens": prompt_tokens + len(output) // 4,
+            "total_time": 0.0,
+        }
+        if self.rng.random() < self.routes[route].rate_json_error:
+            self.stats.record(route, "json_validate_failed", latency)
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Failed to generate JSON. Please adjust your prompt.",
+                        "type": "invalid_request_error",
+                        "code": "json_validate_failed",
+                        # Cut off, like a generation that ran out of tokens
+                        "failed_generation": output[: len(output) * 2 // 3],
+                    }
+                },
+                status=400,
+            )
+        self.stats.record(route, "200", latency)
+
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "model": body.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": output},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+                headers=self.limit_headers(route),
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **self.limit_headers(route)}
+        )
+        await response.prepare(request)
+        for idx in range(0, len(output), 24):
+            event = {
+                "choices": [{"index": 0, "delta": {"content": output[idx : idx + 24]}}]
+            }
+            await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            await asyncio.sleep(0)
+        event = {"choices": [], "x_groq": {"usage": usage}}
+        await response.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def image(self, request: web.Request) -> web.Response:
+        tasks = await request.json()
+        fault, latency = await self.serve_fault("image")
+        if fault is not None:
+            return fault
+        self.stats.record("image", "200", latency)
+        data = []
+        for task in tasks:
+            image_id = str(uuid.uuid4())
+            data.append(
+                {
+                    "taskType": task.get("taskType", "imageInference"),
+                    "imageUUID": image_id,
+                    "taskUUID": task.get("taskUUID", image_id),
+                    "cost": 0.0013,
+                    "seed": self.rng.randrange(2**31),
+                    "imageURL": f"{self.url}/images/{image_id}.webp",
+                    "NSFWContent": False,
+                }
+            )
+        return web.json_response({"data": data})
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.image_bytes, content_type="image/webp")
+
+    async def audio(self, request: web.Request) -> web.Response:
+        fault, latency = await self.serve_fault("audio")
+        if fault is not None:
+            return fault
+        self.stats.record("audio", "200", latency)
+        return web.Response(body=self.audio_bytes, content_type="audio/mpeg")
+
+    def start(self) -> None:
+        """Serves in a background thread, returns once the server is listening"""
+        started = threading.Event()
+
+        def serve() -> None:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app(), access_log=None)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, self.host, self.port)
+            self.loop.run_until_complete(site.start())
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        logger.info(f"[Simulator] : Serving on {self.url}")
+
+    def stop(self) -> None:
+        if self.loop is None or self.runner is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main() -> None:
+    simulator = ProviderSimulator()
+    logger.info(f"[Simulator] : Serving on {simulator.url}")
+    web.run_app(simulator.app(), host=simulator.host, port=simulator.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+from abc import ABC, abstractmethod
+import atexit
+from contextlib import contextmanager
+from dataclasses import dataclass
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from logger_module import logger
+
+# "sqlite" keeps every book's state in one database, "json" keeps the
+# per-chunk state.json / book_state.json files
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_PATH = os.getenv("STATE_DB_PATH", "./uploaded_books/state.db")
+
+# Seconds chunk updates are held back, so several updates of a chunk are written once
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 0.5))
+
+# Column that is empty until the stage (reader_new.Stage value) is done
+STAGE_COLUMNS = {
+    "SUM": "summary",
+    "PROMPT": "prompt",
+    "IMAGE": "image",
+    "AUDIO": "audio",
+}
+
+CHUNK_COLUMNS = [
+    "chunk_id",
+    "chapter_id",
+    "summary",
+    "characters",
+    "places",
+    "scene_title",
+    "prompt",
+    "image",
+    "audio",
+    "is_done",
+    "text_hash",
+]
+
+
+def book_key(book_path: str) -> str:
+    return os.path.normpath(book_path)
+
+
+def chunk_book_path(chunk_path: str) -> str:
+    """Chunks live at <book>/<chapter>/<chunk>"""
+    return os.path.dirname(os.path.dirname(os.path.normpath(chunk_path)))
+
+
+def write_json(path: str, data: dict) -> None:
+    """Writes to a temp file next to `path` and renames it over, so a crash never leaves half a file"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(json.dumps(data))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def read_json(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as file:
+            return json.loads(file.read())
+    except (OSError, ValueError) as e:
+        logger.warning(f"[State] : Unreadable {path}, {e}")
+        return None
+
+
+class StateStore(ABC):
+    """
+    Where Book and Chunk keep their state (BookState / ChunkState as dicts).
+
+    Books are addressed by their content folder (`Book.path_content`), chunks
+    by their book plus chapter_id/chunk_id; `chunk_path` is the chunk folder.
+    """
+
+    @abstractmethod
+    def load_chunk(
+        self, book_path: str, chunk_path: str, chapter_id: str, chunk_id: str
+    ) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save_chunk(self, book_path: str, chunk_path: str, state: dict) -> None:
+        pass
+
+    def save_chunks(self, items: List[Tuple[str, str, dict]]) -> None:
+        """Saves (book_path, chunk_path, state) items"""
+        for book_path, chunk_path, state in items:
+            self.save_chunk(book_path, chunk_path, state)
+
+    @abstractmethod
+    def load_book_chunks(self, book_path: str) -> Dict[str, dict]:
+        """Every stored chunk state of the book, keyed "chapter_id/chunk_id" """
+        pass
+
+    @abstractmethod
+    def load_book(self, book_path: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save_book(self, book_path: str, state: dict) -> None:
+        pass
+
+    @abstractmethod
+    def pending(self, book_path: str, stage: str) -> List[str]:
+        """Keys ("chapter_id/chunk_id") of the book's chunks where `stage` is not done"""
+        pass
+
+    def flush(self) -> None:
+        """Blocks until every saved state is on disk"""
+        pass
+
+
+@dataclass
+class JsonStateStore(StateStore):
+    """One state.json per chunk folder and a book_state.json per book"""
+
+    def load_chunk(
+        self, book_path: str, chunk_path: str, chapter_id: str, chunk_id: str
+    ) -> Optional[dict]:
+        return read_json(f"{chunk_path}/state.json")
+
+    def save_chunk(self, book_path: str, chunk_path: str, state: dict) -> None:
+        write_json(f"{chunk_path}/state.json", state)
+
+    def load_book_chunks(self, book_path: str) -> Dict[str, dict]:
+        book = self.load_book(book_path) or {}
+        states = {}
+        for key in book.get("chunks", []):
+            state = read_json(f"{book_path}/{key}/state.json")
+            if state:
+                states[key] = state
+        return states
+
+    def load_book(self, book_path: str) -> Optional[dict]:
+        return read_json(f"{book_path}/book_state.json")
+
+    def save_book(self, book_path: str, state: dict) -> None:
+        write_json(f"{book_path}/book_state.json", state)
+
+    def pending(self, book_path: str, stage: str) -> List[str]:
+        column = STAGE_COLUMNS[stage]
+        states = self.load_book_chunks(book_path)
+        book = self.load_book(book_path) or {}
+        return [
+            key for key in book.get("chunks", []) if not states.get(key, {}).get(column)
+        ]
+
+
+@dataclass
+class SqliteStateStore(StateStore):
+    """
+    Every book and chunk state of the deployment in one SQLite database (WAL).
+
+    Books that were saved as json files before are read from them until
+    their next save, so existing uploads keep working.
+    """
+
+    path: str = STATE_PATH
+
+    def __post_init__(self) -> None:
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.local = threading.local()
+        self.legacy = JsonStateStore()
+
+        with self.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS books ("
+                "book TEXT PRIMARY KEY, name TEXT NOT NULL, book_id TEXT NOT NULL, "
+                "chunks TEXT NOT NULL, is_done INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "book TEXT NOT NULL, chapter_id TEXT NOT NULL, chunk_id TEXT NOT NULL, "
+                "summary TEXT NOT NULL DEFAULT '', characters TEXT NOT NULL DEFAULT '{}', "
+                "places TEXT NOT NULL DEFAULT '{}', scene_title TEXT NOT NULL DEFAULT '', "
+                "prompt TEXT NOT NULL DEFAULT '', image TEXT NOT NULL DEFAULT '', "
+                "audio INTEGER NOT NULL DEFAULT 0, is_done INTEGER NOT NULL DEFAULT 0, "
+                "text_hash TEXT NOT NULL DEFAULT '', "
+                "PRIMARY KEY (book, chapter_id, chunk_id))"
+            )
+            # Databases made before chunk states recorded the text they belong to
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(chunks)")
+            ]
+            if "text_hash" not in columns:
+                connection.execute(
+                    "ALTER TABLE chunks ADD COLUMN text_hash TEXT NOT NULL DEFAULT ''"
+                )
+            for stage, column in STAGE_COLUMNS.items():
+                empty = "0" if column == "audio" else "''"
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS chunks_missing_{column} "
+                    f"ON chunks (book) WHERE {column} = {empty}"
+                )
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def chunk_row(self, book_path: str, state: dict) -> Tuple:
+        return (
+            book_key(book_path),
+            state["chapter_id"],
+            state["chunk_id"],
+            state.get("summary", ""),
+            json.dumps(state.get("characters", {})),
+            json.dumps(state.get("places", {})),
+            state.get("scene_title", ""),
+            state.get("prompt", ""),
+            state.get("image", ""),
+            int(state.get("audio", False)),
+            int(state.get("is_done", False)),
+            state.get("text_hash", ""),
+        )
+
+    def chunk_state(self, row: sqlite3.Row) -> dict:
+        state = dict(zip(CHUNK_COLUMNS, row))
+        state["characters"] = json.loads(state["characters"])
+        state["places"] = json.loads(state["places"])
+        state["audio"] = bool(state["audio"])
+        state["is_done"] = bool(state["is_done"])
+        return state
+
+    def load_chunk(
+        self, book_path: str, chunk_path: str, chapter_id: str, chunk_id: str
+    ) -> Optional[dict]:
+        row = (
+            self.connect()
+            .execute(
+                f"SELECT {', '.join(CHUNK_COLUMNS)} FROM chunks "
+                "WHERE book = ? AND chapter_id = ? AND chunk_id = ?",
+                (book_key(book_path), chapter_id, chunk_id),
+            )
+            .fetchone()
+        )
+        if row:
+            return self.chunk_state(row)
+        return self.legacy.load_chunk(book_path, chunk_path, chapter_id, chunk_id)
+
+    def save_chunk(self, book_path: str, chunk_path: str, state: dict) -> None:
+        self.save_chunks([(book_path, chunk_path, state)])
+
+    def save_chunks(self, items: List[Tuple[str, str, dict]]) -> None:
+        """Saves (book_path, chunk_path, state) items in one transaction"""
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO chunks (book, chapter_id, chunk_id, summary, "
+                "characters, places, scene_title, prompt, image, audio, is_done, "
+                "text_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self.chunk_row(book_path, state) for book_path, _, state in items],
+            )
+
+    def load_book_chunks(self, book_path: str) -> Dict[str, dict]:
+        rows = (
+            self.connect()
+            .execute(
+                f"SELECT {', '.join(CHUNK_COLUMNS)} FROM chunks WHERE book = ?",
+                (book_key(book_path),),
+            )
+            .fetchall()
+        )
+        # Chunks of a json book not saved here since are still in their files
+        states = self.legacy.load_book_chunks(book_path)
+        for row in rows:
+            state = self.chunk_state(row)
+            states[f"{state['chapter_id']}/{state['chunk_id']}"] = state
+        return states
+
+    def load_book(self, book_path: str) -> Optional[dict]:
+        row = (
+            self.connect()
+            .execute(
+                "SELECT name, book_id, chunks, is_done FROM books WHERE book = ?",
+                (book_key(book_path),),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return self.legacy.load_book(book_path)
+        name, book_id, chunks, is_done = row
+        return {
+            "name": name,
+            "book_id": book_id,
+            "chunks": json.loads(chunks),
+            "is_done": bool(is_done),
+        }
+
+    def save_book(self, book_path: str, state: dict) -> None:
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO books (book, name, book_id, chunks, is_done) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    book_key(book_path),
+                    state["name"],
+                    state["book_id"],
+                    json.dumps(state["chunks"]),
+                    int(state.get("is_done", False)),
+                ),
+            )
+
+    def pending(self, book_path: str, stage: str) -> List[str]:
+        column = STAGE_COLUMNS[stage]
+        empty = "0" if column == "audio" else "''"
+        rows = (
+            self.connect()
+            .execute(
+                f"SELECT chapter_id, chunk_id FROM chunks WHERE book = ? AND {column} = {empty}",
+                (book_key(book_path),),
+            )
+            .fetchall()
+        )
+        return [f"{chapter_id}/{chunk_id}" for chapter_id, chunk_id in rows]
+
+
+@dataclass
+class BufferedStateStore(StateStore):
+    """
+    Write-behind in front of another StateStore.
+
+    `save_chunk` only records the state and returns, a writer thread saves
+    what was recorded every `interval` seconds as one batch, keeping only the
+    latest state of a chunk updated several times. A chunk read is answered
+    from what is queued, other reads flush first, and everything left is
+    flushed at exit.
+    """
+
+    store: StateStore
+    interval: float = STATE_FLUSH_INTERVAL
+
+    def __post_init__(self) -> None:
+        self.condition = threading.Condition()
+        self.queued: Dict[Tuple[str, str, str], Tuple[str, str, dict]] = {}
+        self.in_flight = 0
+        self.closed = False
+        self.saved = 0
+        self.written = 0
+        self.writer = threading.Thread(
+            target=self.run, name="state-writer", daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.close)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.queued and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.queued:
+                    return
+            if not self.closed:
+                time.sleep(self.interval)
+            self.write()
+
+    def write(self) -> None:
+        with self.condition:
+            if not self.queued:
+                return
+            items = self.queued
+            self.queued = {}
+            self.in_flight += 1
+        try:
+            self.store.save_chunks(list(items.values()))
+            with self.condition:
+                self.written += len(items)
+        except Exception as e:
+            logger.error(f"[State] : Saving {len(items)} chunks failed, {e}")
+            with self.condition:
+                # Keep them for the next write, unless they were updated since
+                for key, item in items.items():
+                    self.queued.setdefault(key, item)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def flush(self) -> None:
+        self.write()
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait()
+
+    def close(self) -> None:
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        logger.trace(
+            f"[State] : {self.saved} chunk updates written as {self.written} rows"
+        )
+
+    def save_chunk(self, book_path: str, chunk_path: str, state: dict) -> None:
+        key = (book_key(book_path), state["chapter_id"], state["chunk_id"])
+        with self.condition:
+            self.queued[key] = (book_path, chunk_path, state)
+            self.saved += 1
+            self.condition.notify()
+
+    def load_chunk(
+        self, book_path: str, chunk_path: str, chapter_id: str, chunk_id: str
+    ) -> Optional[dict]:
+        key = (book_key(book_path), chapter_id, chunk_id)
+        with self.condition:
+            # A queued state is the latest one, otherwise the chunk may be in
+            # the batch being written
+            item = self.queued.get(key)
+            while item is None and self.in_flight:
+                self.condition.wait()
+                item = self.queued.get(key)
+        if item is not None:
+            return item[2]
+        return self.store.load_chunk(book_path, chunk_path, chapter_id, chunk_id)
+
+    def load_book_chunks(self, book_path: str) -> Dict[str, dict]:
+        self.flush()
+        return self.store.load_book_chunks(book_path)
+
+    def load_book(self, book_path: str) -> Optional[dict]:
+        return self.store.load_book(book_path)
+
+    def save_book(self, book_path: str, state: dict) -> None:
+        self.store.save_book(book_path, state)
+
+    def pending(self, book_path: str, stage: str) -> List[str]:
+        self.flush()
+        return self.store.pending(book_path, stage)
+
+
+_store: Optional[StateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> StateStore:
+    """Returns the StateStore of the deployment, picked by STATE_BACKEND"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if STATE_BACKEND == "json":
+                store: StateStore = JsonStateStore()
+            else:
+                store = SqliteStateStore()
+            _store = BufferedStateStore(store=store)
+            logger.info(f"[State] : Using {type(store).__name__}")
+        return _store
@@ -0,0 +1,135 @@
+from dataclasses import dataclass
+import json
+from typing import Callable, Dict, List, Optional, Tuple
+
+from logger_module import logger
+
+
+@dataclass
+class FieldStream:
+    """
+    Reads a JSON object as it is generated and hands out each top-level
+    string field as soon as its closing quote arrives, e.g. "summary" long
+    before "characters" and "places" are written. Anything before the opening
+    brace (a code fence) is skipped.
+    """
+
+    def __post_init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.raw: List[str] = []
+        self.expect_key = False
+        self.key: Optional[str] = None
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """Returns the (name, value) of the fields completed by `text`"""
+        fields = []
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    field = self.end_string()
+                    if field:
+                        fields.append(field)
+                    continue
+                self.raw.append(char)
+            elif char in "{[":
+                self.depth += 1
+                self.expect_key = self.depth == 1 and char == "{"
+            elif char in "}]":
+                self.depth -= 1
+            elif self.depth == 1 and char == ",":
+                self.expect_key = True
+            elif self.depth >= 1 and char == '"':
+                self.in_string = True
+                self.raw = []
+        return fields
+
+    def end_string(self) -> Optional[Tuple[str, str]]:
+        if self.depth != 1:
+            return None
+        raw = "".join(self.raw)
+        try:
+            value = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            value = raw
+        if self.expect_key:
+            self.key = value
+            self.expect_key = False
+            return None
+        return (self.key, value) if self.key is not None else None
+
+
+@dataclass
+class CompletionStream:
+    """
+    Collects a streamed (server-sent events) chat completion, one `data:`
+    line at a time, into the same shape as a non-streamed response. Each
+    completed top-level string field of the JSON being generated is passed to
+    `on_field` as it arrives.
+    """
+
+    on_field: Optional[Callable[[str, str], None]] = None
+
+    def __post_init__(self) -> None:
+        self.fields = FieldStream()
+        self.parts: List[str] = []
+        self.usage: Dict = {}
+        self.done = False
+
+    def feed_line(self, line: str) -> None:
+        line = line.strip()
+        if not line.startswith("data:"):
+            return
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            self.done = True
+            return
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning(f"[Stream] : Unreadable event {data[:80]}")
+            return
+
+        # Groq reports usage on the last event, under x_groq
+        usage = event.get("usage") or (event.get("x_groq") or {}).get("usage")
+        if usage:
+            self.usage = usage
+        for choice in event.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if not content:
+                continue
+            self.parts.append(content)
+            if self.on_field:
+                for name, value in self.fields.feed(content):
+                    self.on_field(name, value)
+
+    def response_data(self) -> dict:
+        return {
+            "choices": [{"message": {"content": "".join(self.parts)}}],
+            "usage": self.usage,
+        }
+
+
+def test():
+    output = json.dumps(
+        {
+            "summary": 'Boxer says "I will work harder"',
+            "characters": {"Boxer": "A horse"},
+        }
+    )
+    stream = CompletionStream(on_field=lambda name, value: print("field", name, value))
+    for idx in range(0, len(output), 7):
+        event = {"choices": [{"delta": {"content": output[idx : idx + 7]}}]}
+        stream.feed_line(f"data: {json.dumps(event)}")
+    stream.feed_line("data: [DONE]")
+    print(stream.response_data())
+
+
+if __name__ == "__main__":
+    test()
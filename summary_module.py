@@ -0,0 +1,493 @@
+import asyncio
+from dataclasses import dataclass
+from enum import Enum
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from api_module import (
+    MessageSchema,
+    Summary,
+    SummaryLoop,
+    SummaryResponseSchema,
+    keep_streamed,
+    stream_summary,
+)
+from context_module import RollingContext, merge_entities
+from logger_module import logger
+from prompts import (
+    MAX_VALIDATION_ERROR_TRY,
+    SUMMARY_CHAPTER_CONTEXT,
+    SUMMARY_MAP_CONTEXT,
+    SUMMARY_STITCH_ROLE,
+)
+from ratelimit_module import RateLimiter
+from reader_new import Book, Chapter, Chunk, Stage
+from scheduler_module import BaseStageScheduler, chunk_key, run_coroutine
+
+
+class SummaryMode(Enum):
+    SERIAL = "SERIAL"
+    MAP_REDUCE = "MAP_REDUCE"
+    CHAPTER = "CHAPTER"
+
+
+class SummaryStitchContentSchema(BaseModel):
+    previous_summary: str
+    current_summary: str
+
+
+class SummaryStitchResponseSchema(BaseModel):
+    summary: str
+
+
+class RateLimited(Exception):
+    """A chunk's summary request was still rate limited after its retries"""
+
+
+async def summarize_chunk(
+    summary_handler: Summary,
+    chunk: Chunk,
+    previous_summary: str,
+    characters: Dict[str, str],
+    places: Dict[str, str],
+    semaphore: asyncio.Semaphore,
+    stream: bool = False,
+) -> Optional[SummaryResponseSchema]:
+    """
+    One summary call (plus validation repairs), None if it failed.
+    With `stream`, the chunk gets the summary text as soon as it is generated.
+    Raises RateLimited, rather than return None, when the chunk should be left
+    pending instead of given a fallback
+    """
+    message = summary_handler.get_messages(
+        content=chunk.chunk,
+        previous_summary=previous_summary,
+        characters=characters,
+        places=places,
+    )
+    async with semaphore:
+        status_code, response = await summary_handler.aget(
+            messages=message,
+            on_field=stream_summary(chunk, characters, places) if stream else None,
+        )
+        if status_code == 429 and not chunk.summary:
+            raise RateLimited(f"{chunk.chapter_id}/{chunk.chunk_id}")
+        if status_code in [200, 422]:
+            validated_response = summary_handler.validate_json(
+                response, SummaryResponseSchema
+            )
+            if isinstance(validated_response, SummaryResponseSchema):
+                logger.trace(f"[Summary] : Chunk_{chunk.chunk_id=} Done")
+            else:
+                validated_response = await handle_validation_error(
+                    summary_handler, response
+                )
+            return keep_streamed(chunk, validated_response, characters, places)
+
+    logger.warning(
+        f"[Summary] : {status_code=} error getting {chunk.chapter_id}/{chunk.chunk_id}"
+    )
+    return keep_streamed(chunk, None, characters, places)
+
+
+async def handle_validation_error(
+    summary_handler: Summary, input_text: str
+) -> Optional[SummaryResponseSchema]:
+    message = summary_handler.validation_messages(input_text)
+    for idx in range(MAX_VALIDATION_ERROR_TRY):
+        status_code, response = await summary_handler.aget(messages=message)
+        if status_code == 200:
+            validated_response = summary_handler.validate_json(
+                response, SummaryResponseSchema
+            )
+            if isinstance(validated_response, SummaryResponseSchema):
+                logger.info("[Summary] : Validation error resolved")
+                return validated_response
+        elif status_code == 422:
+            message = summary_handler.validation_messages(response)
+        logger.warning(f"[Summary] : Validation Unresolved on try {idx + 1}")
+    logger.error("[Summary] : COULDNT VALIDATE THE CHUNK, SKIPPING...")
+    return None
+
+
+# Map-Reduce ###########################################################################################################################################################################
+@dataclass
+class MapReduceSummaryLoop:
+    """
+    Summarizes every chunk in parallel with only its own text (map), then
+    rebuilds what the serial SummaryLoop carries from chunk to chunk (reduce):
+        - characters/places are merged in book order, so every chunk gets the
+          entities known up to it
+        - each summary is stitched to the previous one by a second, also
+          parallel, call (`stitch=False` skips it)
+    Chunks get the same ChunkState fields as in the serial mode.
+    """
+
+    book: Book
+    summary_handler: Summary
+    scheduler: Optional[BaseStageScheduler] = None
+    concurrency: int = 8
+    stitch: bool = True
+
+    def __post_init__(self) -> None:
+        # Keys of the chunks left pending, they get no summary in this run
+        self.pending: Set[str] = set()
+
+    def run(self) -> None:
+        """Blocking `arun`, callers already in an event loop should await `arun`"""
+        run_coroutine(self.arun)
+
+    async def arun(self) -> None:
+        chunks = self.book.get_chunks()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            mapped = await asyncio.gather(
+                *(self.map_chunk(chunk, semaphore) for chunk in chunks)
+            )
+            await self.reduce(chunks, list(mapped), semaphore)
+        finally:
+            await self.summary_handler.aclose()
+
+        if self.scheduler:
+            self.scheduler.finish(Stage.SUMMARY)
+
+    async def map_chunk(
+        self, chunk: Chunk, semaphore: asyncio.Semaphore
+    ) -> Optional[SummaryResponseSchema]:
+        if chunk.summary:
+            return SummaryResponseSchema(
+                summary=chunk.summary, characters=chunk.characters, places=chunk.places
+            )
+        try:
+            return await summarize_chunk(
+                self.summary_handler,
+                chunk,
+                previous_summary=SUMMARY_MAP_CONTEXT,
+                characters={},
+                places={},
+                semaphore=semaphore,
+            )
+        except RateLimited:
+            logger.warning(
+                f"[Summary] : Still rate limited, leaving {chunk_key(chunk)} pending"
+            )
+            self.pending.add(chunk_key(chunk))
+            return None
+
+    def plan_reduce(
+        self,
+        chunks: List[Chunk],
+        mapped: List[Optional[SummaryResponseSchema]],
+    ) -> List[Tuple[Chunk, str, str, Dict[str, str], Dict[str, str]]]:
+        """
+        (chunk, previous summary, summary, characters, places) of every chunk
+        still without a summary, with the entities known up to it
+        """
+        characters: Dict[str, str] = {}
+        places: Dict[str, str] = {}
+        previous: Optional[SummaryResponseSchema] = None
+        reduced = []
+        for chunk, output in zip(chunks, mapped):
+            if chunk_key(chunk) in self.pending:
+                continue
+            if output is None:
+                # Same fallback as the serial chain: carry the previous context over
+                output = previous or SummaryResponseSchema(
+                    summary=SUMMARY_MAP_CONTEXT, characters={}, places={}
+                )
+            characters = merge_entities(characters, output.characters)
+            places = merge_entities(places, output.places)
+            if not chunk.summary:
+                reduced.append(
+                    (
+                        chunk,
+                        previous.summary if previous else "",
+                        output.summary,
+                        dict(characters),
+                        dict(places),
+                    )
+                )
+            previous = output
+        return reduced
+
+    async def reduce(
+        self,
+        chunks: List[Chunk],
+        mapped: List[Optional[SummaryResponseSchema]],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        await asyncio.gather(
+            *(
+                self.stitch_chunk(*item, semaphore)
+                for item in self.plan_reduce(chunks, mapped)
+            )
+        )
+
+    def reduce_local(
+        self,
+        chunks: List[Chunk],
+        mapped: List[Optional[SummaryResponseSchema]],
+    ) -> None:
+        """`reduce` without stitch calls, needs no event loop (callers may be in one)"""
+        for chunk, _, summary, characters, places in self.plan_reduce(chunks, mapped):
+            chunk.set_sum(summary=summary, characters=characters, places=places)
+
+    async def stitch_chunk(
+        self,
+        chunk: Chunk,
+        previous_summary: str,
+        summary: str,
+        characters: Dict[str, str],
+        places: Dict[str, str],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        if self.stitch and previous_summary and previous_summary != summary:
+            async with semaphore:
+                status_code, response = await self.summary_handler.aget(
+                    messages=self.stitch_messages(previous_summary, summary),
+                    response_schema=SummaryStitchResponseSchema,
+                )
+            if status_code == 200:
+                validated_response = self.summary_handler.validate_json(
+                    response, SummaryStitchResponseSchema
+                )
+                if isinstance(validated_response, SummaryStitchResponseSchema):
+                    summary = validated_response.summary
+                else:
+                    logger.warning(
+                        f"[Summary] : Stitch unresolved on {chunk.chapter_id}/{chunk.chunk_id}, keeping map summary"
+                    )
+        # set_sum notifies the scheduler, downstream stages start right away
+        await asyncio.to_thread(
+            chunk.set_sum, summary=summary, characters=characters, places=places
+        )
+
+    def stitch_messages(
+        self, previous_summary: str, current_summary: str
+    ) -> List[MessageSchema]:
+        return [
+            MessageSchema(
+                role="system",
+                content=f"{SUMMARY_STITCH_ROLE} follow given schema: {SummaryStitchResponseSchema.model_json_schema()}",
+            ),
+            MessageSchema(
+                role="user",
+                content=SummaryStitchContentSchema(
+                    previous_summary=previous_summary,
+                    current_summary=current_summary,
+                ).model_dump_json(by_alias=True),
+            ),
+        ]
+
+
+# Chapter ##############################################################################################################################################################################
+@dataclass
+class ChapterSummaryLoop:
+    """
+    Runs one serial summary chain per chapter, up to `concurrency` chapters at
+    a time, so continuity is kept inside a chapter without chaining the whole
+    book. A chain opens with its first chunk summarized on its own plus the
+    characters/places the other chains have found so far. Once every chain is
+    done, a local pass reconciles the entity lists across chapters.
+
+    A chunk's summary is handed to the scheduler as soon as its chain has it,
+    so prompts that already ran keep the entities of that moment, the
+    reconciled lists only reach the saved state and the later stages.
+    """
+
+    book: Book
+    summary_handler: Summary
+    scheduler: Optional[BaseStageScheduler] = None
+    concurrency: int = 8
+
+    def __post_init__(self) -> None:
+        self.characters: Dict[str, str] = {}
+        self.places: Dict[str, str] = {}
+
+    def run(self) -> None:
+        """Blocking `arun`, callers already in an event loop should await `arun`"""
+        run_coroutine(self.arun)
+
+    async def arun(self) -> None:
+        chains = asyncio.Semaphore(self.concurrency)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.gather(
+                *(
+                    self.chain(chapter, chains, semaphore)
+                    for chapter in self.book.get_chapters()
+                )
+            )
+        finally:
+            await self.summary_handler.aclose()
+        await self.reconcile()
+
+        if self.scheduler:
+            self.scheduler.finish(Stage.SUMMARY)
+
+    async def chain(
+        self,
+        chapter: Chapter,
+        chains: asyncio.Semaphore,
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        async with chains:
+            context = RollingContext(
+                budget=self.summary_handler.budget,
+                summary=SUMMARY_CHAPTER_CONTEXT,
+                characters=self.characters,
+                places=self.places,
+            )
+            for chunk in chapter.get_chunks():
+                if not chunk.summary:
+                    previous_summary, characters, places = context.for_chunk(
+                        chunk.chunk
+                    )
+                    try:
+                        output = await summarize_chunk(
+                            self.summary_handler,
+                            chunk,
+                            previous_summary=previous_summary,
+                            characters=characters,
+                            places=places,
+                            semaphore=semaphore,
+                            stream=self.summary_handler.stream,
+                        )
+                    except RateLimited:
+                        # The rest of the chapter needs this chunk's context
+                        logger.warning(
+                            f"[Summary] : Still rate limited, leaving chapter {chapter.chapter_id} pending from {chunk_key(chunk)}"
+                        )
+                        return
+                    if output is None:
+                        # Same fallback as the serial chain: carry the previous context over
+                        output = SummaryResponseSchema(
+                            summary=context.summary,
+                            characters=characters,
+                            places=places,
+                        )
+                    await asyncio.to_thread(
+                        chunk.set_sum,
+                        summary=output.summary,
+                        characters=output.characters,
+                        places=output.places,
+                    )
+                context.update(
+                    chunk.chunk, chunk.summary, chunk.characters, chunk.places
+                )
+                self.characters = merge_entities(self.characters, chunk.characters)
+                self.places = merge_entities(self.places, chunk.places)
+        logger.info(f"[Summary] : Chapter {chapter.chapter_id} Done")
+
+    async def reconcile(self) -> None:
+        """
+        Gives every chunk the entities of all earlier chapters, as the serial
+        chain would have carried them. Runs after the summaries were handed on,
+        see the class docstring
+        """
+        known_characters: Dict[str, str] = {}
+        known_places: Dict[str, str] = {}
+        for chapter in self.book.get_chapters():
+            chapter_characters: Dict[str, str] = {}
+            chapter_places: Dict[str, str] = {}
+            for chunk in chapter.get_chunks():
+                if not chunk.summary:
+                    continue
+                characters = merge_entities(known_characters, chunk.characters)
+                places = merge_entities(known_places, chunk.places)
+                chapter_characters = merge_entities(
+                    chapter_characters, chunk.characters
+                )
+                chapter_places = merge_entities(chapter_places, chunk.places)
+                if characters != chunk.characters or places != chunk.places:
+                    await asyncio.to_thread(chunk.set_entities, characters, places)
+            known_characters = merge_entities(known_characters, chapter_characters)
+            known_places = merge_entities(known_places, chapter_places)
+
+
+def get_summary_loop(
+    mode: SummaryMode,
+    book: Book,
+    summary_handler: Summary,
+    scheduler: Optional[BaseStageScheduler] = None,
+):
+    if mode == SummaryMode.MAP_REDUCE:
+        return MapReduceSummaryLoop(
+            book=book, summary_handler=summary_handler, scheduler=scheduler
+        )
+    elif mode == SummaryMode.CHAPTER:
+        return ChapterSummaryLoop(
+            book=book, summary_handler=summary_handler, scheduler=scheduler
+        )
+    return SummaryLoop(book=book, summary_handler=summary_handler, scheduler=scheduler)
+
+
+def bench_loop(path: str, url: str, requests_per_minute: int, mode: SummaryMode):
+    """
+    The summary loop of `mode` on a fresh copy of the book state, with its own
+    rate limiter: `requests_per_minute`, or only the limits the server
+    reports when 0, so the modes are timed and not the limiter
+    """
+    book = Book(path, user_id=f"summary-bench-{mode.value.lower()}")
+    for chunk in book.get_chunks():
+        if chunk.summary:
+            chunk.clear_sum()
+    limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=0)
+    summary_handler = Summary(api_key="", url=url, limiter=limiter)
+    summary_handler.cache = None  # every mode has to reach the endpoint
+    return get_summary_loop(mode, book, summary_handler)
+
+
+def compare_modes(
+    path: str, url: str, requests_per_minute: int = 0
+) -> Dict[str, float]:
+    """
+    Times the summary stage of `path` in every mode against `url`
+    (e.g. a local provider stub), see `bench_loop`.
+    """
+    timings = {}
+    for mode in SummaryMode:
+        loop = bench_loop(path, url, requests_per_minute, mode)
+        start = time.perf_counter()
+        loop.run()
+        timings[mode.value] = time.perf_counter() - start
+    return timings
+
+
+async def acompare_modes(
+    path: str, url: str, requests_per_minute: int = 0
+) -> Dict[str, float]:
+    """`compare_modes` for callers already in an event loop"""
+    timings = {}
+    for mode in SummaryMode:
+        loop = await asyncio.to_thread(bench_loop, path, url, requests_per_minute, mode)
+        start = time.perf_counter()
+        if isinstance(loop, SummaryLoop):
+            await asyncio.to_thread(loop.run)
+        else:
+            await loop.arun()
+        timings[mode.value] = time.perf_counter() - start
+    return timings
+
+
+def main() -> None:
+    import glob
+    import sys
+
+    url = sys.argv[1] if len(sys.argv) > 1 else "http://127.0.0.1:8000/sum"
+    for path in sorted(glob.glob("./test_books/*.epub")):
+        timings = compare_modes(path, url)
+        serial = timings[SummaryMode.SERIAL.value]
+        print(
+            f"{path}: "
+            + " | ".join(
+                f"{mode}={seconds:.2f}s ({serial / seconds:.2f}x)"
+                for mode, seconds in timings.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Runs the tests in a scratch folder, with a small tokenizer trained on the
+test books standing in for the model's (a gated download), so nothing here
+needs network access or writes into the repo.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import zipfile
+
+import pytest
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="book-tests-")
+
+
+def train_tokenizer(path: str) -> None:
+    """Byte-level BPE like the Llama tokenizer: tokens carry their leading space"""
+    texts = []
+    with zipfile.ZipFile(os.path.join(REPO, "test_books", "AF.epub")) as epub:
+        for name in epub.namelist():
+            if name.endswith((".html", ".xhtml", ".htm")):
+                html = epub.read(name).decode("utf-8", "ignore")
+                texts.append(re.sub("<[^>]+>", " ", html))
+    tokenizer = Tokenizer(models.BPE(unk_token=None))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        texts,
+        trainers.BpeTrainer(
+            vocab_size=2000,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+            show_progress=False,
+        ),
+    )
+    tokenizer.save(path)
+
+
+# Set before the repo's modules are imported, they read these at import time
+os.environ["TOKENIZER_PATH"] = os.path.join(WORKDIR, "tokenizer.json")
+os.environ["STATE_DB_PATH"] = os.path.join(WORKDIR, "state.db")
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["CASSETTE_PATH"] = ""
+train_tokenizer(os.environ["TOKENIZER_PATH"])
+os.symlink(os.path.join(REPO, "test_books"), os.path.join(WORKDIR, "test_books"))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture(autouse=True, scope="session")
+def workdir():
+    """Books and their uploaded_books folders are made relative to the working directory"""
+    os.chdir(WORKDIR)
+    # Collecting imports the repo's __init__, which set the log sinks up with
+    # debug_logs.log in the repo, they are made again in here
+    import logger_module
+
+    importlib.reload(logger_module)
+    yield WORKDIR
+    os.chdir(REPO)
+
+
+class ChatServer:
+    """
+    Local chat completions endpoint. Answers with `replies`, (status, content)
+    pairs taken in order with the last one repeating, and keeps the request
+    bodies it got in `requests`
+    """
+
+    def __init__(self):
+        self.replies = [(200, "{}")]
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                status, content = server.replies[
+                    min(len(server.requests), len(server.replies)) - 1
+                ]
+                if status == 200:
+                    data = {
+                        "choices": [{"message": {"content": content}}],
+                        "usage": {"prompt_tokens": 10, "total_tokens": 20},
+                    }
+                else:
+                    data = {"error": {"message": content}}
+                encoded = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                if status == 429:
+                    self.send_header("retry-after", "0.01")
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+
+@pytest.fixture
+def chat_server():
+    server = ChatServer()
+    yield server
+    server.httpd.shutdown()
+
+
+@pytest.fixture
+def simulator():
+    """The provider simulator without latency or injected faults"""
+    from simulator_module import Latency, ProviderSimulator, RouteConfig
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    simulator = ProviderSimulator(
+        port=port,
+        routes={
+            route: RouteConfig(
+                latency=Latency(), rate_429=0, rate_5xx=0, rate_json_error=0
+            )
+            for route in ("sum", "prompt", "image", "audio")
+        },
+    )
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    # The stdout sink was bound to pytest's capture, which is closed before
+    # the state writer logs its last flush at exit
+    from logger_module import logger
+
+    logger.remove()
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+from api_module import Image, ImageLoop, Prompt, PromptLoop, Summary
+from audio_module import AudioTest, AudioTestLoop
+from ratelimit_module import RateLimiter
+from reader_new import Book, Stage
+from scheduler_module import AsyncStageScheduler, chunk_key
+from summary_module import SummaryMode, get_summary_loop
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/AF.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def test_stage_updates_from_threads_reach_the_loop(book):
+    async def main():
+        scheduler = AsyncStageScheduler(book=book)
+        chunk = book.get_chunks()[0]
+        thread = threading.Thread(
+            target=chunk.set_sum,
+            kwargs={"summary": "summary", "characters": {}, "places": {}},
+        )
+        thread.start()
+        ready = await asyncio.wait_for(scheduler.aget(Stage.PROMPT), timeout=5)
+        thread.join()
+        return chunk, ready
+
+    chunk, ready = asyncio.run(main())
+    assert ready is chunk
+
+
+async def process(book, url, summary_mode):
+    """The stages of `async_process_book`, against the simulator's routes"""
+    limiter = RateLimiter.unlimited()
+    summary_handler = Summary(api_key="", url=f"{url}/sum", limiter=limiter)
+    prompt_handler = Prompt(api_key="", url=f"{url}/prompt", limiter=limiter)
+    image_handler = Image(api_key="", url=f"{url}/image")
+    summary_handler.cache = None
+    prompt_handler.cache = None
+
+    scheduler = AsyncStageScheduler(book=book)
+    looper_sum = get_summary_loop(
+        SummaryMode(summary_mode),
+        book=book,
+        summary_handler=summary_handler,
+        scheduler=scheduler,
+    )
+    try:
+        await asyncio.gather(
+            (
+                looper_sum.arun()
+                if hasattr(looper_sum, "arun")
+                else asyncio.to_thread(looper_sum.run)
+            ),
+            PromptLoop(
+                book=book, prompt_handler=prompt_handler, scheduler=scheduler
+            ).arun(),
+            ImageLoop(
+                book=book, image_handler=image_handler, scheduler=scheduler
+            ).arun(),
+            AudioTestLoop(
+                book=book, audio_handler=AudioTest(test_url=url), scheduler=scheduler
+            ).arun(),
+        )
+    finally:
+        await prompt_handler.aclose()
+        await image_handler.aclose()
+        await summary_handler.aclose()
+    scheduler.close()
+
+
+@pytest.mark.parametrize("summary_mode", ["SERIAL", "MAP_REDUCE", "CHAPTER"])
+def test_every_stage_runs_on_every_chunk(book, simulator, summary_mode):
+    asyncio.run(asyncio.wait_for(process(book, simulator.url, summary_mode), 60))
+    for chunk in book.get_chunks():
+        for stage in Stage:
+            assert chunk.is_stage_done(stage), f"{stage.name} on {chunk_key(chunk)}"
+    outcomes = simulator.stats.snapshot()
+    assert outcomes["prompt"]["200"] == len(book.get_chunks())
+    assert outcomes["image"]["200"] == len(book.get_chunks())
@@ -0,0 +1,27 @@
+from base_reader import first_index, resolve_spine
+
+
+def test_resolve_spine_follows_spine_order():
+    manifest = [["b", "b.xhtml"], ["a", "a.xhtml"], ["c", "c.xhtml"]]
+    hrefs, rest = resolve_spine(["a", "b", "c"], manifest)
+    assert hrefs == ["a.xhtml", "b.xhtml", "c.xhtml"]
+    assert rest == []
+
+
+def test_resolve_spine_leaves_unreferenced_items():
+    manifest = [["a", "a.xhtml"], ["css", "style.css"], ["b", "b.xhtml"]]
+    hrefs, rest = resolve_spine(["b", "a", "missing"], manifest)
+    assert hrefs == ["b.xhtml", "a.xhtml"]
+    assert rest == [["css", "style.css"]]
+
+
+def test_resolve_spine_takes_shared_ids_in_manifest_order():
+    manifest = [["a", "first.xhtml"], ["a", "second.xhtml"], ["a", "third.xhtml"]]
+    hrefs, rest = resolve_spine(["a", "a"], manifest)
+    assert hrefs == ["first.xhtml", "second.xhtml"]
+    assert rest == [["a", "third.xhtml"]]
+
+
+def test_first_index_keeps_the_first_occurrence():
+    assert first_index(["a", "b", "a", "c", "b"]) == {"a": 0, "b": 1, "c": 3}
+    assert first_index([]) == {}
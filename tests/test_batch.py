@@ -0,0 +1,70 @@
+import uuid
+
+import pytest
+
+from api_module import Prompt, Summary
+from batch_module import (
+    LocalBatchRunner,
+    batch_path,
+    read_jsonl,
+    run_batch,
+    write_requests,
+)
+from ratelimit_module import RateLimiter
+from reader_new import Book, Stage
+from scheduler_module import chunk_key
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/AF.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def make_handlers(url):
+    summary_handler = Summary(
+        api_key="", url=f"{url}/sum", limiter=RateLimiter.unlimited()
+    )
+    prompt_handler = Prompt(
+        api_key="", url=f"{url}/prompt", limiter=RateLimiter.unlimited()
+    )
+    return summary_handler, prompt_handler
+
+
+def test_requests_file_has_one_line_per_pending_chunk(book, simulator):
+    handlers = make_handlers(simulator.url)
+    path, count = write_requests(book, Stage.SUMMARY, *handlers)
+    lines = list(read_jsonl(path))
+    assert count == len(lines) == 12
+    assert [line["custom_id"] for line in lines] == [
+        chunk_key(chunk) for chunk in book.get_chunks()
+    ]
+    assert not any(line["body"]["stream"] for line in lines)
+
+    # Prompts wait for their summaries
+    assert write_requests(book, Stage.PROMPT, *handlers)[1] == 0
+
+
+def test_batches_summarize_and_prompt_every_chunk(book, simulator):
+    handlers = make_handlers(simulator.url)
+    runner = LocalBatchRunner(url=f"{simulator.url}/sum")
+    assert run_batch(book, Stage.SUMMARY, runner, *handlers) == (12, 0)
+    chunks = book.get_chunks()
+    assert all(chunk.summary for chunk in chunks)
+    # The reduce step carries the entities over in book order
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous.characters.keys() <= chunk.characters.keys()
+
+    runner = LocalBatchRunner(url=f"{simulator.url}/prompt")
+    assert run_batch(book, Stage.PROMPT, runner, *handlers) == (12, 0)
+    assert all(chunk.prompt for chunk in chunks)
+    # Nothing is left to send
+    assert run_batch(book, Stage.SUMMARY, runner, *handlers) == (0, 0)
+
+
+def test_failed_requests_stay_pending(book, chat_server):
+    chat_server.replies = [(500, "Internal error")]
+    handlers = make_handlers(chat_server.url)
+    runner = LocalBatchRunner(url=f"{chat_server.url}/sum")
+    assert run_batch(book, Stage.SUMMARY, runner, *handlers) == (0, 12)
+    assert not any(chunk.summary for chunk in book.get_chunks())
+    assert list(read_jsonl(batch_path(book, Stage.SUMMARY, "results")))
@@ -0,0 +1,138 @@
+import os
+import uuid
+
+from reader_new import Book, chunk_hash
+from scheduler_module import chunk_key
+from state_module import get_store, write_json
+
+
+def make_book(user_id=None, **kwargs):
+    return Book(
+        "./test_books/AF.epub", user_id=user_id or f"test-{uuid.uuid4()}", **kwargs
+    )
+
+
+def legacy_state(chunk, summary):
+    """A chunk state saved before states recorded their text_hash"""
+    return {
+        "chunk_id": chunk.chunk_id,
+        "chapter_id": chunk.chapter_id,
+        "summary": summary,
+    }
+
+
+def test_legacy_sqlite_rows_are_kept():
+    book = make_book()
+    store = get_store()
+    for chunk in book.get_chunks():
+        store.save_chunk(book.path_content, chunk.path, legacy_state(chunk, "kept"))
+    store.flush()
+
+    book = make_book(book.user_id)
+    chunks = book.get_chunks()
+    assert all(chunk.summary == "kept" for chunk in chunks)
+
+    # The hash is filled in by the chunk's next save
+    chunks[0].set_prompt(scene_title="Barn", prompt="A barn")
+    store.flush()
+    states = store.load_book_chunks(book.path_content)
+    assert states["1/1"]["text_hash"] == chunk_hash(chunks[0].chunk)
+    assert states["1/1"]["summary"] == "kept"
+
+
+def test_legacy_json_files_are_kept():
+    chunks = make_book().get_chunks()
+    user_id = f"test-{uuid.uuid4()}"
+    book_path = f"./uploaded_books/{user_id}/AF"
+    keys = []
+    for chunk in chunks:
+        chunk_path = f"{book_path}/{chunk.chapter_id}/{chunk.chunk_id}"
+        os.makedirs(chunk_path)
+        write_json(f"{chunk_path}/state.json", legacy_state(chunk, "from json"))
+        keys.append(f"{chunk.chapter_id}/{chunk.chunk_id}")
+    write_json(
+        f"{book_path}/book_state.json",
+        {"name": "AF", "book_id": "af", "chunks": keys, "is_done": True},
+    )
+
+    book = make_book(user_id, lazy=True)
+    assert book.book_state.is_done
+    next(book.iter_chapters())
+    assert book.book_state.is_done
+    assert all(chunk.summary == "from json" for chunk in book.get_chunks())
+
+
+def test_changed_text_drops_the_state_and_the_book_is_not_done():
+    book = make_book()
+    book.book_state.is_done = True
+    book.dump_it()
+    store = get_store()
+    for chunk in book.get_chunks():
+        state = legacy_state(chunk, "other text")
+        state["text_hash"] = chunk_hash("other text")
+        store.save_chunk(book.path_content, chunk.path, state)
+    store.flush()
+
+    book = make_book(book.user_id, lazy=True)
+    assert book.book_state.is_done
+    chapter = next(book.iter_chapters())
+    assert not book.book_state.is_done
+    assert not get_store().load_book(book.path_content)["is_done"]
+    assert all(chunk.summary == "" for chunk in chapter.get_chunks())
+
+
+def test_chunks_do_not_read_their_state_one_by_one(monkeypatch):
+    store = get_store()
+    reads = []
+    load_chunk = store.load_chunk
+    monkeypatch.setattr(
+        store, "load_chunk", lambda *args: reads.append(args) or load_chunk(*args)
+    )
+    # A new book, then the same book with every chunk saved
+    book = make_book()
+    book.get_chunks()[0].set_prompt(scene_title="Barn", prompt="A barn")
+    book = make_book(book.user_id)
+    assert book.get_chunks()[0].prompt == "A barn"
+    assert reads == []
+
+
+def chunk_texts(book):
+    return [(chunk_key(chunk), chunk.chunk) for chunk in book.get_chunks()]
+
+
+def test_lazy_book_parses_chapters_as_they_are_reached():
+    eager = make_book()
+    book = make_book(lazy=True)
+    loaded = []
+    book.add_listener(loaded.append)
+    assert book.chapters == []
+
+    chapters = book.iter_chapters()
+    first = next(chapters)
+    assert book.chapters == [first]
+    assert loaded == [first]
+    assert not book.loaded
+
+    rest = list(chapters)
+    assert len(rest) == len(eager.chapters) - 1
+    # None tells the listeners the book is fully loaded
+    assert loaded[-1] is None
+    assert book.loaded
+    assert chunk_texts(book) == chunk_texts(eager)
+    assert book.book_state.chunks == eager.book_state.chunks
+
+
+def test_pool_parsing_matches_the_eager_book():
+    eager = make_book()
+    book = make_book(workers=2)
+    assert chunk_texts(book) == chunk_texts(eager)
+    # The pool is shut down once every chapter is in
+    assert book.pool is None
+
+
+def test_lazy_pool_book_loads_in_toc_order():
+    eager = make_book()
+    book = make_book(lazy=True, workers=2)
+    titles = [chapter.title for chapter in book.iter_chapters()]
+    assert titles == [chapter.title for chapter in eager.chapters]
+    assert chunk_texts(book) == chunk_texts(eager)
@@ -0,0 +1,74 @@
+from api_module import MessageSchema
+from budget_module import MESSAGE_OVERHEAD, REQUEST_OVERHEAD, TokenBudget
+
+
+def make_budget(max_input_tokens=0):
+    return TokenBudget(
+        model="llama-3.1-8b-instant",
+        max_completion_tokens=2048,
+        max_input_tokens=max_input_tokens,
+    )
+
+
+def build(summary, characters, places):
+    return [
+        MessageSchema(role="system", content=f"{characters} {places}"),
+        MessageSchema(role="user", content=f"{summary} Old Major calls a meeting."),
+    ]
+
+
+def test_limit_leaves_room_for_the_completion():
+    assert make_budget().limit == 131072 - 2048
+    assert make_budget(max_input_tokens=1500).limit == 1500
+
+
+def test_count_adds_the_chat_template_overhead():
+    budget = make_budget()
+    messages = build("", {}, {})
+    assert budget.count(messages) == REQUEST_OVERHEAD + sum(
+        MESSAGE_OVERHEAD + budget.count_text(message.content) for message in messages
+    )
+
+
+def test_fitting_request_is_left_alone():
+    budget = make_budget(max_input_tokens=1500)
+    characters = {"Boxer": "A strong horse."}
+    messages = budget.fit(build, "Mr. Jones is drunk.", characters, {})
+    assert messages == build("Mr. Jones is drunk.", characters, {})
+    assert budget.stats()["trimmed"] == 0
+
+
+def test_oldest_entities_go_first():
+    budget = make_budget(max_input_tokens=300)
+    characters = {f"Character {i}": "A farm animal. " * 10 for i in range(10)}
+    messages = budget.fit(build, "Mr. Jones is drunk.", characters, {})
+    assert budget.count(messages) <= budget.limit
+    assert "Character 0" not in messages[0].content
+    assert "Character 9" in messages[0].content
+    # The summary is only cut once the entities are not enough
+    assert "Mr. Jones is drunk." in messages[1].content
+    assert budget.stats()["trimmed"] == 1
+
+
+def test_summary_keeps_its_latest_sentences():
+    budget = make_budget(max_input_tokens=200)
+    summary = " ".join(f"Sentence number {i} of the summary." for i in range(100))
+    messages = budget.fit(build, summary, {}, {})
+    assert budget.count(messages) <= budget.limit
+    assert "Sentence number 99 of the summary." in messages[1].content
+    assert "Sentence number 0 " not in messages[1].content
+    # The chunk text itself is never cut
+    assert messages[1].content.endswith("Old Major calls a meeting.")
+
+
+def test_record_tracks_the_estimate_error():
+    budget = make_budget()
+    budget.record(110, 100)
+    budget.record(90, None)
+    stats = budget.stats()
+    assert (stats["requests"], stats["estimated_tokens"], stats["used_tokens"]) == (
+        1,
+        110,
+        100,
+    )
+    assert stats["error"] == 0.1
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from api_module import MessageSchema, Prompt
+from cache_module import ResponseCache, cache_key
+from ratelimit_module import RateLimiter
+
+VALID = json.dumps({"scene_title": "The barn", "prompt": "A barn at night"})
+INVALID = "Sorry, I cannot draw that scene."
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(path=str(tmp_path / "cache.db"))
+
+
+@pytest.fixture
+def handler(chat_server, cache):
+    handler = Prompt(
+        api_key="", url=f"{chat_server.url}/prompt", limiter=RateLimiter.unlimited()
+    )
+    handler.cache = cache
+    return handler
+
+
+def messages(text="A barn"):
+    return [MessageSchema(role="user", content=text)]
+
+
+def test_same_request_is_answered_from_the_cache(handler, chat_server):
+    chat_server.replies = [(200, VALID)]
+    assert handler.get(messages()) == (200, VALID)
+    assert handler.get(messages()) == (200, VALID)
+    assert len(chat_server.requests) == 1
+
+    assert handler.get(messages("Another barn")) == (200, VALID)
+    assert len(chat_server.requests) == 2
+
+
+def test_invalid_response_is_not_cached(handler, chat_server):
+    chat_server.replies = [(200, INVALID), (200, VALID)]
+    # The retry of a response that failed validation reaches the model again
+    assert handler.get(messages()) == (200, INVALID)
+    assert handler.get(messages()) == (200, VALID)
+    assert handler.get(messages()) == (200, VALID)
+    assert len(chat_server.requests) == 2
+
+
+def test_invalid_cached_response_is_ignored(handler, chat_server, cache):
+    cache.put(
+        cache_key(handler.url, handler.model, handler.temperature, messages()),
+        INVALID,
+    )
+    chat_server.replies = [(200, VALID)]
+    assert handler.get(messages()) == (200, VALID)
+    assert len(chat_server.requests) == 1
+
+
+def test_errors_are_not_cached(handler, chat_server):
+    chat_server.replies = [(401, "Invalid API key"), (200, VALID)]
+    assert handler.get(messages()) == (401, "ERROR_API_CALL")
+    assert handler.get(messages()) == (200, VALID)
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.db"), max_bytes=10)
+    cache.put("old", "12345")
+    cache.put("used", "12345")
+    assert cache.get("old") == "12345"
+    cache.put("new", "12345")
+    assert cache.get("used") is None
+    assert cache.get("old") == "12345"
+    assert cache.stats()["bytes"] == 10
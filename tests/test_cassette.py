@@ -0,0 +1,128 @@
+import asyncio
+import json
+import sqlite3
+import zlib
+
+import pytest
+
+from cassette_module import Cassette, recorded, set_cassette
+
+
+@pytest.fixture
+def cassette_path(tmp_path):
+    yield str(tmp_path / "calls.cassette")
+    set_cassette(None)
+
+
+def make_call(calls):
+    @recorded("chat", lambda text: text)
+    def call(text):
+        calls.append(text)
+        return f"{text} #{len(calls)}"
+
+    return call
+
+
+def test_replay_returns_recorded_results_in_order(cassette_path):
+    calls = []
+    call = make_call(calls)
+    set_cassette(Cassette(path=cassette_path, mode="record", speed=0))
+    assert [call("a"), call("a"), call("b")] == ["a #1", "a #2", "b #3"]
+
+    set_cassette(Cassette(path=cassette_path, mode="replay", speed=0))
+    # Identical calls replay in order, the last one repeats once they run out
+    assert [call("a"), call("a"), call("a"), call("b")] == [
+        "a #1",
+        "a #2",
+        "a #2",
+        "b #3",
+    ]
+    assert len(calls) == 3
+
+
+def test_unrecorded_calls_go_through(cassette_path):
+    calls = []
+    call = make_call(calls)
+    set_cassette(Cassette(path=cassette_path, mode="record", speed=0))
+    call("a")
+
+    cassette = Cassette(path=cassette_path, mode="replay", speed=0)
+    set_cassette(cassette)
+    assert call("new") == "new #2"
+    assert calls == ["a", "new"]
+    assert cassette.stats() == {"chat:misses": 1}
+
+
+def test_async_calls_replay(cassette_path):
+    calls = []
+
+    @recorded("audio", lambda text: text)
+    async def synthesize(text):
+        calls.append(text)
+        return text.encode()
+
+    set_cassette(Cassette(path=cassette_path, mode="record", speed=0))
+    assert asyncio.run(synthesize("hello")) == b"hello"
+
+    set_cassette(Cassette(path=cassette_path, mode="replay", speed=0))
+    assert asyncio.run(synthesize("hello")) == b"hello"
+    assert calls == ["hello"]
+
+
+def test_replay_scales_the_recorded_latency(cassette_path):
+    Cassette(path=cassette_path, mode="record").record("chat", "key", 2.0, "result")
+    delay, result = Cassette(path=cassette_path, mode="replay", speed=4).replay(
+        "chat", "key"
+    )
+    assert (delay, result) == (0.5, "result")
+    assert Cassette(path=cassette_path, mode="replay", speed=0).replay(
+        "chat", "key"
+    ) == (0.0, "result")
+
+
+def test_results_are_stored_as_json(cassette_path):
+    from api_module import ImageItem, ImageResponseSchema
+
+    item = ImageItem(
+        taskType="imageInference",
+        imageUUID="image",
+        taskUUID="task",
+        cost=0.0,
+        seed=1,
+        imageURL="http://images/1.png",
+        NSFWContent=False,
+    )
+    image = ImageResponseSchema(data=[item])
+    results = [(200, "text"), (200, image), b"\x00audio", None]
+    cassette = Cassette(path=cassette_path, mode="record")
+    for seq, result in enumerate(results):
+        cassette.record("chat", str(seq), 0.0, result)
+
+    connection = sqlite3.connect(cassette_path)
+    for (blob,) in connection.execute("SELECT result FROM calls"):
+        json.loads(zlib.decompress(blob))
+
+    cassette = Cassette(path=cassette_path, mode="replay", speed=0)
+    assert [cassette.replay("chat", str(seq))[1] for seq in range(4)] == results
+
+
+def test_recording_bypasses_the_response_cache(cassette_path, chat_server, tmp_path):
+    from api_module import MessageSchema, Prompt
+    from cache_module import ResponseCache
+    from ratelimit_module import RateLimiter
+
+    reply = json.dumps({"scene_title": "The barn", "prompt": "A barn at night"})
+    chat_server.replies = [(200, reply)]
+    handler = Prompt(
+        api_key="", url=f"{chat_server.url}/prompt", limiter=RateLimiter.unlimited()
+    )
+    handler.cache = ResponseCache(path=str(tmp_path / "cache.db"))
+    messages = [MessageSchema(role="user", content="A barn")]
+    assert handler.get(messages) == (200, reply)
+
+    cassette = Cassette(path=cassette_path, mode="record")
+    set_cassette(cassette)
+    assert handler.get(messages) == (200, reply)
+    # Recorded from the provider, not from the cache hit
+    assert len(chat_server.requests) == 2
+    assert cassette.stats() == {"chat:recorded": 1}
@@ -0,0 +1,105 @@
+import re
+
+import pytest
+
+from base_reader import get_ebook_cls
+from reader_new import chapter_text
+from utils import Chunker, Tokenizer, get_chunker
+
+
+def word_offsets(text):
+    """One token per word, carrying the whitespace before it like byte-level BPE"""
+    return [(match.start(), match.end()) for match in re.finditer(r"\s*\S+", text)]
+
+
+def make_text(paragraphs=4, sentences=3, words=5):
+    """Paragraphs of sentences of `words` words, "p<i>s<j>w<k>" each"""
+    return "\n".join(
+        " ".join(
+            " ".join(f"p{p}s{s}w{w}" for w in range(words)) + "."
+            for s in range(sentences)
+        )
+        for p in range(paragraphs)
+    )
+
+
+def make_chunker(max_len, overlap=0, snap=True):
+    # Chunker is a process wide singleton, each call re-initializes it
+    return Chunker(
+        max_len=max_len, tokenizer=Tokenizer(None), overlap=overlap, snap=snap
+    )
+
+
+def test_snap_ends_chunks_at_paragraphs():
+    text = make_text()
+    chunks = make_chunker(max_len=20).split(text, word_offsets(text))
+    assert chunks == text.split("\n")
+
+
+def test_snap_falls_back_to_sentence_ends():
+    # One paragraph, so only sentence ends are left to snap to
+    text = make_text(paragraphs=1, sentences=6)
+    chunks = make_chunker(max_len=12).split(text, word_offsets(text))
+    assert [len(chunk.split()) for chunk in chunks] == [10, 10, 10]
+    assert all(chunk.endswith(".") for chunk in chunks)
+
+
+def test_without_snap_chunks_cut_at_max_len():
+    text = make_text()
+    chunks = make_chunker(max_len=20, snap=False).split(text, word_offsets(text))
+    assert [len(chunk.split()) for chunk in chunks] == [20, 20, 20]
+
+
+def test_overlap_repeats_the_last_sentence():
+    text = make_text()
+    chunks = make_chunker(max_len=20, overlap=5).split(text, word_offsets(text))
+    paragraphs = text.split("\n")
+    assert chunks[0] == paragraphs[0]
+    for previous, chunk in zip(chunks, chunks[1:]):
+        last_sentence = previous.rsplit(". ", 1)[-1]
+        assert chunk.startswith(last_sentence)
+    # Nothing is lost, every paragraph still ends a chunk
+    assert [chunk.split(". ")[-1] for chunk in chunks] == [
+        paragraph.split(". ")[-1] for paragraph in paragraphs
+    ]
+
+
+def test_chunks_cover_the_text():
+    text = make_text(paragraphs=7, sentences=4)
+    chunks = make_chunker(max_len=23).split(text, word_offsets(text))
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_empty_text_has_no_chunks():
+    assert make_chunker(max_len=20).chunk("") == []
+
+
+def test_batch_matches_single():
+    ebook = get_ebook_cls("./test_books/AF.epub")
+    texts = [chapter_text(ebook.get_raw_text(name)) for name in ebook.contents]
+    chunker = make_chunker(max_len=200, overlap=20)
+    single = [chunker.chunk(text) for text in texts]
+    assert chunker.chunk_batch(texts) == single
+    assert sum(len(chunks) for chunks in single) > len(texts)
+
+
+def test_get_chunker_leaves_the_tokenizer_to_its_first_use(monkeypatch):
+    monkeypatch.setattr(Tokenizer, "_loaded", {})
+    chunker = get_chunker(max_len=20)
+    assert Tokenizer._loaded == {}
+    assert chunker.tokenizer.tokenize("A barn at night")[0] > 0
+    assert list(Tokenizer._loaded) == [chunker.tokenizer.path]
+
+
+def test_missing_tokenizer_fails_up_front(monkeypatch, tmp_path):
+    monkeypatch.delenv("HF_API", raising=False)
+    monkeypatch.setattr(Tokenizer, "_loaded", {})
+    tokenizer = Tokenizer(None, path=str(tmp_path / "tokenizer.json"))
+    try:
+        with pytest.raises(Exception, match="HF_API is not set"):
+            tokenizer.check()
+        with pytest.raises(Exception, match="HF_API is not set"):
+            tokenizer.tokenize("A barn")
+    finally:
+        # The tokenizer is a process wide singleton
+        Tokenizer(None)
@@ -0,0 +1,58 @@
+from budget_module import TokenBudget
+from context_module import RollingContext, merge_entities
+
+
+def make_context(**kwargs):
+    budget = TokenBudget(model="llama-3.1-8b-instant", max_completion_tokens=2048)
+    return RollingContext(budget=budget, summary="", **kwargs)
+
+
+def test_merge_entities_keeps_the_longer_description():
+    merged = merge_entities(
+        {"Boxer": "A horse.", "Clover": "A mare."},
+        {"boxer": "A strong, loyal horse.", "Benjamin": "A donkey."},
+    )
+    assert merged == {
+        "Boxer": "A strong, loyal horse.",
+        "Clover": "A mare.",
+        "Benjamin": "A donkey.",
+    }
+
+
+def test_entities_named_in_the_chunk_come_first():
+    context = make_context(max_tokens=60)
+    characters = {f"Animal{i}": "A farm animal. " * 4 for i in range(10)}
+    context.update("Animal3 talks.", "summary", characters, {})
+
+    _, sent, _ = context.for_chunk("Animal7 and Animal8 hide in the barn.")
+    assert {"Animal7", "Animal8"} <= sent.keys()
+    assert len(sent) < len(characters)
+    # Everything is still remembered for later chunks
+    assert context.characters.keys() == characters.keys()
+
+
+def test_recently_named_entities_are_kept_over_older_ones():
+    context = make_context(max_tokens=40)
+    context.update("Boxer works.", "summary", {"Boxer": "A horse. " * 4}, {})
+    context.update("Clover rests.", "summary", {"Clover": "A mare. " * 4}, {})
+    _, sent, _ = context.for_chunk("The barn is quiet.")
+    assert list(sent) == ["Clover"]
+
+
+def test_summary_is_kept_at_its_share_of_the_budget():
+    context = make_context(max_tokens=90)
+    summary = " ".join(f"Sentence number {i} of the summary." for i in range(100))
+    context.update("", summary, {}, {})
+    sent, _, _ = context.for_chunk("The barn is quiet.")
+    assert context.budget.count_text(sent) <= context.summary_tokens
+    assert sent.endswith("Sentence number 99 of the summary.")
+
+
+def test_stale_entities_are_shortened():
+    context = make_context(compress_every=2)
+    description = "A horse. He works harder than anyone."
+    context.update("Boxer works.", "summary", {"Boxer": description}, {})
+    for _ in range(3):
+        context.update("Clover rests.", "summary", {"Clover": description}, {})
+    # Boxer was not named in the last two chunks
+    assert context.characters == {"Boxer": "A horse.", "Clover": description}
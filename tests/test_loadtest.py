@@ -0,0 +1,34 @@
+import pytest
+
+import loadtest_module
+from loadtest_module import percentile, run_load_test
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3.0, 1.0, 2.0], 0.5) == 2.0
+    assert percentile([3.0, 1.0, 2.0], 0.99) == 3.0
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_load_test_measures_every_chunk(simulator, lazy):
+    report = run_load_test("./test_books/AF.epub", simulator, lazy=lazy)
+    assert report["chunks"] == 12
+    assert report["chunks_per_second"] > 0
+    for stage in report["stages"].values():
+        assert stage["done"] == 12
+        assert stage["retries"] == 0
+
+
+def test_lazy_book_is_loaded_during_the_timed_run(simulator, monkeypatch):
+    process_book = loadtest_module.test_process_book
+    loaded = []
+
+    def counting_process_book(book, **kwargs):
+        loaded.append(len(book.chapters))
+        return process_book(book, **kwargs)
+
+    monkeypatch.setattr(loadtest_module, "test_process_book", counting_process_book)
+    report = run_load_test("./test_books/AF.epub", simulator, lazy=True)
+    assert loaded == [0]
+    assert report["chunks"] == 12
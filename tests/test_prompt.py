@@ -0,0 +1,102 @@
+import json
+import uuid
+
+import pytest
+
+from api_module import Prompt, PromptLoop
+from ratelimit_module import RateLimiter
+from reader_new import Book, Stage
+from scheduler_module import StageScheduler, chunk_key
+
+VALID = json.dumps({"scene_title": "The barn", "prompt": "A barn at night"})
+INVALID = "Sorry, I cannot draw that scene."
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/AF.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def make_loop(book, url, **kwargs):
+    handler = Prompt(api_key="", url=f"{url}/prompt", limiter=RateLimiter.unlimited())
+    handler.cache = None
+    return PromptLoop(
+        book=book,
+        prompt_handler=handler,
+        scheduler=StageScheduler(book=book),
+        **kwargs,
+    )
+
+
+def summarize(chunk):
+    chunk.set_sum(summary=f"summary of {chunk_key(chunk)}", characters={}, places={})
+
+
+def test_invalid_response_is_repaired_by_the_model(book, chat_server):
+    loop = make_loop(book, chat_server.url)
+    chunk = book.get_chunks()[0]
+    summarize(chunk)
+    chat_server.replies = [(200, VALID)]
+
+    loop.handle_response(chunk, 200, INVALID)
+    assert chunk.is_stage_done(Stage.PROMPT)
+    assert chunk.prompt == "A barn at night"
+    # One validation request, with the invalid response in it
+    assert len(chat_server.requests) == 1
+    assert INVALID in json.dumps(chat_server.requests[0])
+
+
+def test_waiting_chunks_are_packed_into_one_request(book, simulator):
+    loop = make_loop(book, simulator.url, batch_tokens=100000, batch_size=4)
+    chunks = book.get_chunks()[:6]
+    for chunk in chunks:
+        summarize(chunk)
+
+    first = loop.scheduler.get(Stage.PROMPT)
+    assert loop.fill_batch(first) == chunks[:4]
+    second = loop.scheduler.get(Stage.PROMPT)
+    assert loop.fill_batch(second) == chunks[4:6]
+
+
+def test_batch_stops_at_its_token_budget(book, simulator):
+    loop = make_loop(book, simulator.url, batch_tokens=1, batch_size=4)
+    chunks = book.get_chunks()[:2]
+    for chunk in chunks:
+        summarize(chunk)
+
+    first = loop.scheduler.get(Stage.PROMPT)
+    assert loop.fill_batch(first) == [chunks[0]]
+    # The chunk that did not fit opens the next request
+    assert loop.scheduler.get(Stage.PROMPT) is chunks[1]
+
+
+def test_batch_response_is_matched_by_id(book, chat_server):
+    loop = make_loop(book, chat_server.url, batch_tokens=100000)
+    chunks = book.get_chunks()[:2]
+    for chunk in chunks:
+        summarize(chunk)
+        assert loop.scheduler.get(Stage.PROMPT) is chunk
+    response = json.dumps(
+        {
+            "prompts": [
+                {"id": chunk_key(chunks[1]), "scene_title": "Two", "prompt": "B"},
+                {"id": "unknown", "scene_title": "Other", "prompt": "C"},
+            ]
+        }
+    )
+
+    loop.handle_batch_response(chunks, 200, response)
+    assert (chunks[1].scene_title, chunks[1].prompt) == ("Two", "B")
+    # The chunk missing from the response goes back for another request
+    assert not chunks[0].is_stage_done(Stage.PROMPT)
+    assert loop.scheduler.get_nowait(Stage.PROMPT) is chunks[0]
+
+
+def test_batched_run_prompts_every_chunk(book, simulator):
+    loop = make_loop(book, simulator.url, batch_tokens=100000, batch_size=4)
+    for chunk in book.get_chunks():
+        summarize(chunk)
+    loop.scheduler.finish(Stage.SUMMARY)
+    loop.run()
+    assert all(chunk.prompt for chunk in book.get_chunks())
+    assert simulator.stats.snapshot()["prompt"]["200"] < len(book.get_chunks())
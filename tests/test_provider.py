@@ -0,0 +1,81 @@
+import json
+
+from api_module import (
+    MessageSchema,
+    Prompt,
+    PromptResponseSchema,
+    SummaryResponseSchema,
+)
+from provider_module import (
+    OutputMode,
+    detect_provider,
+    get_output_mode,
+    response_format,
+    strict_schema,
+    supported_modes,
+)
+from ratelimit_module import RateLimiter
+
+GROQ = "https://api.groq.com/openai/v1/chat/completions"
+VALID = json.dumps({"scene_title": "The barn", "prompt": "A barn at night"})
+
+
+def test_detect_provider():
+    assert detect_provider(GROQ) == "groq"
+    assert detect_provider("https://openrouter.ai/api/v1/chat/completions") == (
+        "openrouter"
+    )
+    assert detect_provider("http://localhost:11434/v1/chat/completions") == "ollama"
+    assert detect_provider("http://127.0.0.1:8000/sum") == "local"
+
+
+def test_groq_modes_depend_on_the_model():
+    assert supported_modes("groq", "llama-3.1-8b-instant") == [
+        OutputMode.JSON_OBJECT,
+        OutputMode.NONE,
+    ]
+    assert supported_modes("groq", "openai/gpt-oss-20b")[0] == (
+        OutputMode.JSON_SCHEMA_STRICT
+    )
+
+
+def test_strict_schema_requires_every_property():
+    schema = strict_schema(PromptResponseSchema)
+    assert schema["additionalProperties"] is False
+    assert set(schema["required"]) == {"scene_title", "prompt"}
+    # Dict[str, str] entities can not be expressed in strict mode
+    assert strict_schema(SummaryResponseSchema) is None
+
+
+def test_free_form_schemas_skip_strict_mode():
+    model = "openai/gpt-oss-20b"
+    assert get_output_mode("groq", model, PromptResponseSchema) == (
+        OutputMode.JSON_SCHEMA_STRICT
+    )
+    assert get_output_mode("groq", model, SummaryResponseSchema) == (
+        OutputMode.JSON_SCHEMA
+    )
+
+
+def test_response_format():
+    strict = response_format(OutputMode.JSON_SCHEMA_STRICT, PromptResponseSchema)
+    assert strict["json_schema"]["strict"] is True
+    assert response_format(OutputMode.JSON_OBJECT, PromptResponseSchema) == {
+        "type": "json_object"
+    }
+    assert response_format(OutputMode.NONE, PromptResponseSchema) is None
+
+
+def test_rejected_output_mode_is_downgraded(chat_server):
+    chat_server.replies = [(400, "response_format is not supported"), (200, VALID)]
+    handler = Prompt(
+        api_key="", url=f"{chat_server.url}/prompt", limiter=RateLimiter.unlimited()
+    )
+    handler.cache = None
+    assert handler.output_mode == OutputMode.JSON_OBJECT
+
+    messages = [MessageSchema(role="user", content="A barn")]
+    assert handler.get(messages) == (200, VALID)
+    assert chat_server.requests[0]["response_format"] == {"type": "json_object"}
+    assert "response_format" not in chat_server.requests[1]
+    assert handler.output_mode == OutputMode.NONE
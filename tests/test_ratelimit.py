@@ -0,0 +1,118 @@
+import uuid
+
+import pytest
+
+from api_module import MessageSchema, Summary, SummaryLoop
+from ratelimit_module import RateLimiter, parse_duration
+from reader_new import Book
+from summary_module import ChapterSummaryLoop, MapReduceSummaryLoop
+
+
+def test_parse_duration():
+    assert parse_duration("2m59.56s") == pytest.approx(179.56)
+    assert parse_duration("120ms") == pytest.approx(0.12)
+    assert parse_duration("12") == 12.0
+    assert parse_duration("") is None
+
+
+def test_reserve_spaces_requests_at_the_budget():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=0, headroom=1)
+    assert limiter.reserve(100) == 0
+    for _ in range(59):
+        limiter.reserve(100)
+    # The bucket is empty, the next request waits for one to refill
+    assert limiter.reserve(100) == pytest.approx(1.0, abs=0.05)
+
+
+def test_oversized_request_waits_instead_of_being_clamped():
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1)
+    assert limiter.reserve(9000) == pytest.approx(30.0, abs=0.05)
+    assert limiter.tokens == pytest.approx(-3000, abs=5)
+
+
+def test_settle_returns_unused_tokens():
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1)
+    limiter.reserve(4000)
+    limiter.settle(4000, 1000)
+    assert limiter.tokens == pytest.approx(5000, abs=5)
+
+
+def test_429_blocks_until_retry_after():
+    limiter = RateLimiter.unlimited()
+    limiter.update(429, {"retry-after": "2"})
+    assert limiter.reserve(100) == pytest.approx(2.0, abs=0.05)
+
+
+def test_unlimited_follows_the_reported_limits():
+    limiter = RateLimiter.unlimited()
+    assert limiter.reserve(100) == 0
+    limiter.update(200, {"x-ratelimit-limit-tokens": "1000"})
+    assert limiter.token_capacity == pytest.approx(900)
+
+
+def make_handler(url):
+    handler = Summary(api_key="", url=f"{url}/sum", limiter=RateLimiter.unlimited())
+    handler.cache = None
+    return handler
+
+
+class RecordingLimiter(RateLimiter):
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        self.reserved = []
+        self.settled = []
+
+    def reserve(self, tokens: int) -> float:
+        self.reserved.append(tokens)
+        return super().reserve(tokens)
+
+    def settle(self, reserved, used) -> None:
+        self.settled.append((reserved, used))
+        super().settle(reserved, used)
+
+
+def test_requests_reserve_their_completion_tokens(chat_server):
+    handler = make_handler(chat_server.url)
+    handler.limiter = RecordingLimiter(requests_per_minute=0, tokens_per_minute=0)
+    messages = [MessageSchema(role="user", content="A barn")]
+    handler.get(messages)
+    reserved = handler.estimate_tokens(messages) + handler.budget.max_completion_tokens
+    assert handler.limiter.reserved == [reserved]
+    # The reply reports 20 tokens used
+    assert handler.limiter.settled == [(reserved, 20)]
+
+
+def test_final_429_is_reported_as_rate_limited(chat_server):
+    chat_server.replies = [(429, "slow down")]
+    handler = make_handler(chat_server.url)
+    messages = [MessageSchema(role="user", content="A barn")]
+    assert handler.get(messages, max_retries=2) == (429, "ERROR_RATE_LIMITED")
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/AF.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def test_serial_loop_leaves_rate_limited_chunks_pending(book, chat_server):
+    chat_server.replies = [(429, "slow down")]
+    SummaryLoop(book=book, summary_handler=make_handler(chat_server.url)).run()
+    assert not any(chunk.summary for chunk in book.get_chunks())
+    # The chain stops at the first chunk instead of retrying every one
+    assert len(chat_server.requests) == 3
+
+
+def test_map_reduce_leaves_rate_limited_chunks_pending(book, chat_server):
+    chat_server.replies = [(429, "slow down")]
+    loop = MapReduceSummaryLoop(
+        book=book, summary_handler=make_handler(chat_server.url), stitch=False
+    )
+    loop.run()
+    assert not any(chunk.summary for chunk in book.get_chunks())
+    assert len(loop.pending) == len(book.get_chunks())
+
+
+def test_chapter_mode_leaves_rate_limited_chunks_pending(book, chat_server):
+    chat_server.replies = [(429, "slow down")]
+    ChapterSummaryLoop(book=book, summary_handler=make_handler(chat_server.url)).run()
+    assert not any(chunk.summary for chunk in book.get_chunks())
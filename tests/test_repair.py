@@ -0,0 +1,61 @@
+from repair_module import repair_json
+
+
+def test_valid_json_is_unchanged():
+    text = '{"summary": "The animals meet", "characters": {"Boxer": "A horse"}}'
+    assert repair_json(text) == {
+        "summary": "The animals meet",
+        "characters": {"Boxer": "A horse"},
+    }
+
+
+def test_code_fence_and_trailing_comma():
+    text = '```json\n{"summary": "Old Major\'s dream", "characters": {},}\n```'
+    assert repair_json(text) == {"summary": "Old Major's dream", "characters": {}}
+
+
+def test_prose_and_single_quotes():
+    text = "Here it is: {'scene_title': 'The barn', 'prompt': 'A barn at night'}"
+    assert repair_json(text) == {"scene_title": "The barn", "prompt": "A barn at night"}
+
+
+def test_unescaped_quotes_inside_a_string():
+    text = '{"summary": "He said "hello" to them", "places": {"Barn": "Red"}}'
+    assert repair_json(text) == {
+        "summary": 'He said "hello" to them',
+        "places": {"Barn": "Red"},
+    }
+
+
+def test_cut_off_output_is_closed():
+    text = '{"summary": "The animals meet", "characters": {"Boxer": "A huge horse'
+    assert repair_json(text) == {
+        "summary": "The animals meet",
+        "characters": {"Boxer": "A huge horse"},
+    }
+
+
+def test_missing_comma_and_dangling_key():
+    text = '{"summary": "a"\n"characters": {"Boxer": "strong"}, "places": {"Farm": '
+    assert repair_json(text) == {
+        "summary": "a",
+        "characters": {"Boxer": "strong"},
+        "places": {},
+    }
+
+
+def test_raw_newline_python_literals_and_bare_keys():
+    text = '{"prompt": "line one\nline two", "scene_title": None, count: 3}'
+    assert repair_json(text) == {
+        "prompt": "line one\nline two",
+        "scene_title": None,
+        "count": 3,
+    }
+
+
+def test_missing_comma_in_array():
+    assert repair_json("[1, 2 3]") == [1, 2, 3]
+
+
+def test_text_without_json():
+    assert repair_json("no json here") is None
@@ -0,0 +1,100 @@
+import threading
+import uuid
+
+import pytest
+
+from reader_new import Book, Stage
+from scheduler_module import StageScheduler, chunk_key
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/AF.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def summarize(chunk):
+    chunk.set_sum(summary=f"summary of {chunk_key(chunk)}", characters={}, places={})
+
+
+def test_summary_queues_its_dependents(book):
+    scheduler = StageScheduler(book=book)
+    chunk = book.get_chunks()[0]
+    assert scheduler.get_nowait(Stage.PROMPT) is None
+
+    summarize(chunk)
+    assert scheduler.get_nowait(Stage.PROMPT) is chunk
+    assert scheduler.get_nowait(Stage.AUDIO) is chunk
+    assert scheduler.get_nowait(Stage.IMAGE) is None
+
+
+def test_retry_requeues_until_max_attempts(book):
+    scheduler = StageScheduler(book=book, max_attempts=3)
+    chunk = book.get_chunks()[0]
+    summarize(chunk)
+    assert scheduler.get(Stage.PROMPT) is chunk
+
+    scheduler.retry(chunk, Stage.PROMPT)
+    assert scheduler.get(Stage.PROMPT) is chunk
+    scheduler.retry(chunk, Stage.PROMPT)
+    assert scheduler.get(Stage.PROMPT) is chunk
+
+    # Third failure: the chunk is given up on, with the image depending on it
+    scheduler.retry(chunk, Stage.PROMPT)
+    assert scheduler.get_nowait(Stage.PROMPT) is None
+    assert chunk_key(chunk) not in scheduler.remaining[Stage.PROMPT]
+    assert chunk_key(chunk) not in scheduler.remaining[Stage.IMAGE]
+    assert chunk_key(chunk) in scheduler.remaining[Stage.AUDIO]
+
+
+def test_abandon_resolves_every_dependent_stage(book):
+    scheduler = StageScheduler(book=book)
+    chunk = book.get_chunks()[0]
+    scheduler.abandon(chunk, Stage.SUMMARY)
+    for stage in Stage:
+        assert chunk_key(chunk) not in scheduler.remaining[stage]
+    other = book.get_chunks()[1]
+    assert chunk_key(other) in scheduler.remaining[Stage.SUMMARY]
+
+
+def test_done_chunks_are_skipped(book):
+    scheduler = StageScheduler(book=book)
+    first, second = book.get_chunks()[:2]
+    summarize(first)
+    summarize(second)
+    first.set_audio(b"audio")
+    assert scheduler.get(Stage.AUDIO) is second
+
+
+def test_sentinel_stops_every_worker(book):
+    scheduler = StageScheduler(book=book)
+    chunks = book.get_chunks()
+    for chunk in chunks[1:]:
+        scheduler.abandon(chunk, Stage.SUMMARY)
+    assert not scheduler.closed[Stage.PROMPT]
+
+    results = []
+    workers = [
+        threading.Thread(target=lambda: results.append(scheduler.get(Stage.PROMPT)))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    # The last chunk resolving closes the stage and releases all the workers
+    scheduler.abandon(chunks[0], Stage.SUMMARY)
+    for worker in workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+    assert results == [None, None, None]
+    assert all(scheduler.closed[stage] for stage in Stage)
+
+
+def test_finish_abandons_chunks_left_without_the_stage(book):
+    scheduler = StageScheduler(book=book)
+    chunks = book.get_chunks()
+    summarize(chunks[0])
+    scheduler.finish(Stage.SUMMARY)
+    assert scheduler.closed[Stage.SUMMARY]
+    for chunk in chunks[1:]:
+        for stage in Stage:
+            assert chunk_key(chunk) not in scheduler.remaining[stage]
+    assert chunk_key(chunks[0]) in scheduler.remaining[Stage.PROMPT]
@@ -0,0 +1,111 @@
+import json
+import random
+import socket
+
+import pytest
+import requests
+
+from api_module import PromptResponseSchema, SummaryResponseSchema
+from simulator_module import Latency, ProviderSimulator, RouteConfig
+
+
+@pytest.fixture
+def make_simulator():
+    """Starts a simulator whose routes all take `config` (no latency by default)"""
+    started = []
+
+    def make(**config):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        config = {
+            "latency": Latency(),
+            "rate_429": 0,
+            "rate_5xx": 0,
+            "rate_json_error": 0,
+            **config,
+        }
+        simulator = ProviderSimulator(
+            port=port,
+            routes={
+                route: RouteConfig(**config)
+                for route in ("sum", "prompt", "image", "audio")
+            },
+        )
+        simulator.start()
+        started.append(simulator)
+        return simulator
+
+    yield make
+    for simulator in started:
+        simulator.stop()
+
+
+def chat(simulator, route, content, **body):
+    return requests.post(
+        f"{simulator.url}/{route}",
+        json={"messages": [{"role": "user", "content": content}], **body},
+        timeout=10,
+    )
+
+
+def test_latency_parse_and_sample():
+    assert Latency.parse("fixed:0.5").sample(random.Random(0)) == 0.5
+    uniform = Latency.parse("uniform:1:2")
+    assert 1 <= uniform.sample(random.Random(0)) <= 2
+
+
+def test_chat_routes_answer_in_their_schema(simulator):
+    text = "Old Major calls a meeting in the Big Barn at Manor Farm."
+    response = chat(simulator, "sum", json.dumps({"current_chapter": text}))
+    content = response.json()["choices"][0]["message"]["content"]
+    assert SummaryResponseSchema.model_validate_json(content).summary
+    assert response.json()["usage"]["total_tokens"] > 0
+
+    response = chat(simulator, "prompt", json.dumps({"input_text": text}))
+    content = response.json()["choices"][0]["message"]["content"]
+    assert PromptResponseSchema.model_validate_json(content).prompt
+    assert simulator.stats.snapshot() == {"sum": {"200": 1}, "prompt": {"200": 1}}
+
+
+def test_streamed_chat_sends_events(simulator):
+    response = chat(simulator, "prompt", "A barn", stream=True)
+    lines = [line for line in response.text.splitlines() if line]
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    assert lines[-1] == "data: [DONE]"
+
+
+def test_image_and_audio_routes(simulator):
+    response = requests.post(
+        f"{simulator.url}/image", json=[{"taskUUID": "task"}], timeout=10
+    )
+    item = response.json()["data"][0]
+    assert item["taskUUID"] == "task"
+    assert requests.get(item["imageURL"], timeout=10).content == simulator.image_bytes
+    assert requests.get(f"{simulator.url}/audio", timeout=10).content == (
+        simulator.audio_bytes
+    )
+
+
+def test_requests_per_minute_limit(make_simulator):
+    simulator = make_simulator(requests_per_minute=2)
+    assert [chat(simulator, "sum", "A").status_code for _ in range(3)] == [
+        200,
+        200,
+        429,
+    ]
+    limited = chat(simulator, "sum", "A")
+    assert float(limited.headers["retry-after"]) > 0
+    assert limited.headers["x-ratelimit-remaining-requests"] == "0"
+    # Routes have their own windows
+    assert chat(simulator, "prompt", "A").status_code == 200
+
+
+def test_injected_faults(make_simulator):
+    simulator = make_simulator(rate_5xx=1.0)
+    assert chat(simulator, "sum", "A").status_code in (500, 502, 503)
+
+    simulator = make_simulator(rate_json_error=1.0)
+    response = chat(simulator, "sum", "A")
+    assert response.status_code == 400
+    assert response.json()["error"]["code"] == "json_validate_failed"
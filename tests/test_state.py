@@ -0,0 +1,80 @@
+import pytest
+
+from state_module import BufferedStateStore, SqliteStateStore
+
+
+def chunk_state(chunk_id, summary=""):
+    return {"chunk_id": chunk_id, "chapter_id": "1", "summary": summary}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SqliteStateStore(path=str(tmp_path / "state.db"))
+
+
+@pytest.fixture
+def book_path(tmp_path):
+    return str(tmp_path / "book")
+
+
+def test_flush_writes_the_latest_state_once(store, book_path):
+    # A long interval keeps the writer thread out of the way, flush writes
+    buffered = BufferedStateStore(store=store, interval=60)
+    for summary in ("first", "second", "third"):
+        buffered.save_chunk(book_path, f"{book_path}/1/1", chunk_state("1", summary))
+    buffered.save_chunk(book_path, f"{book_path}/1/2", chunk_state("2", "other"))
+    assert store.load_book_chunks(book_path) == {}
+
+    buffered.flush()
+    states = store.load_book_chunks(book_path)
+    assert states["1/1"]["summary"] == "third"
+    assert states["1/2"]["summary"] == "other"
+    assert (buffered.saved, buffered.written) == (4, 2)
+
+
+def test_chunk_reads_see_queued_states_without_writing(store, book_path):
+    buffered = BufferedStateStore(store=store, interval=60)
+    buffered.save_chunk(book_path, f"{book_path}/1/1", chunk_state("1", "queued"))
+    state = buffered.load_chunk(book_path, f"{book_path}/1/1", "1", "1")
+    assert state is not None
+    assert state["summary"] == "queued"
+    assert buffered.load_chunk(book_path, f"{book_path}/1/2", "1", "2") is None
+    assert buffered.written == 0
+
+    buffered.flush()
+    state = buffered.load_chunk(book_path, f"{book_path}/1/1", "1", "1")
+    assert state["summary"] == "queued"
+
+
+def test_book_reads_flush_first(store, book_path):
+    buffered = BufferedStateStore(store=store, interval=60)
+    buffered.save_chunk(book_path, f"{book_path}/1/1", chunk_state("1", "queued"))
+    assert buffered.load_book_chunks(book_path)["1/1"]["summary"] == "queued"
+    assert buffered.written == 1
+
+
+def test_failed_write_is_kept_for_the_next_one(store, book_path):
+    class FlakyStore(SqliteStateStore):
+        failures = 1
+
+        def save_chunks(self, items):
+            if self.failures:
+                self.failures -= 1
+                raise OSError("disk full")
+            super().save_chunks(items)
+
+    flaky = FlakyStore(path=store.path)
+    buffered = BufferedStateStore(store=flaky, interval=60)
+    buffered.save_chunk(book_path, f"{book_path}/1/1", chunk_state("1", "kept"))
+    buffered.flush()
+    assert store.load_book_chunks(book_path) == {}
+
+    buffered.flush()
+    assert store.load_book_chunks(book_path)["1/1"]["summary"] == "kept"
+
+
+def test_close_flushes_what_is_left(store, book_path):
+    buffered = BufferedStateStore(store=store, interval=60)
+    buffered.save_chunk(book_path, f"{book_path}/1/1", chunk_state("1", "at exit"))
+    buffered.close()
+    assert store.load_book_chunks(book_path)["1/1"]["summary"] == "at exit"
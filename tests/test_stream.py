@@ -0,0 +1,71 @@
+import json
+
+from api_module import MessageSchema, Summary
+from ratelimit_module import RateLimiter
+from stream_module import CompletionStream, FieldStream
+
+OUTPUT = json.dumps(
+    {
+        "summary": 'Boxer says "I will work harder"',
+        "characters": {"Boxer": "A horse"},
+        "places": {},
+    }
+)
+
+
+def pieces(text, size):
+    return [text[idx : idx + size] for idx in range(0, len(text), size)]
+
+
+def test_fields_come_out_as_soon_as_they_close():
+    stream = FieldStream()
+    fields = []
+    for idx, piece in enumerate(pieces(OUTPUT, 3)):
+        fields.extend((idx, field) for field in stream.feed(piece))
+    # Only the top-level string field, the nested ones are skipped
+    assert [field for _, field in fields] == [
+        ("summary", 'Boxer says "I will work harder"')
+    ]
+    # Handed out before the characters were generated
+    assert fields[0][0] < OUTPUT.index("characters") // 3
+
+
+def test_text_before_the_object_is_skipped():
+    stream = FieldStream()
+    assert stream.feed('```json\n{"summary": "A barn"}\n```') == [("summary", "A barn")]
+
+
+def test_completion_stream_collects_the_events():
+    fields = []
+    stream = CompletionStream(on_field=lambda name, value: fields.append(name))
+    for piece in pieces(OUTPUT, 7):
+        event = {"choices": [{"delta": {"content": piece}}]}
+        stream.feed_line(f"data: {json.dumps(event)}")
+    usage = {"prompt_tokens": 10, "total_tokens": 20}
+    stream.feed_line(f"data: {json.dumps({'choices': [], 'x_groq': {'usage': usage}})}")
+    stream.feed_line("data: not json")
+    stream.feed_line("data: [DONE]")
+
+    assert stream.done
+    assert fields == ["summary"]
+    assert stream.response_data() == {
+        "choices": [{"message": {"content": OUTPUT}}],
+        "usage": usage,
+    }
+
+
+def test_streamed_summary_hands_out_its_fields(simulator):
+    handler = Summary(
+        api_key="",
+        url=f"{simulator.url}/sum",
+        stream=True,
+        limiter=RateLimiter.unlimited(),
+    )
+    handler.cache = None
+    fields = {}
+    messages = [MessageSchema(role="user", content="Old Major calls a meeting.")]
+    status_code, response = handler.get(
+        messages, on_field=lambda name, value: fields.setdefault(name, value)
+    )
+    assert status_code == 200
+    assert fields["summary"] == json.loads(response)["summary"]
@@ -0,0 +1,102 @@
+import asyncio
+import uuid
+
+import pytest
+
+from api_module import Summary
+from prompts import SUMMARY_CHAPTER_CONTEXT, SUMMARY_MAP_CONTEXT
+from ratelimit_module import RateLimiter
+from reader_new import Book
+from state_module import get_store
+from summary_module import (
+    ChapterSummaryLoop,
+    MapReduceSummaryLoop,
+    SummaryMode,
+    acompare_modes,
+    compare_modes,
+)
+
+
+@pytest.fixture
+def book():
+    return Book("./test_books/DG.epub", user_id=f"test-{uuid.uuid4()}")
+
+
+def make_handler(url):
+    handler = Summary(api_key="", url=f"{url}/sum", limiter=RateLimiter.unlimited())
+    handler.cache = None
+    return handler
+
+
+def test_chapter_mode_summarizes_every_chunk(book, simulator):
+    ChapterSummaryLoop(book=book, summary_handler=make_handler(simulator.url)).run()
+    chunks = book.get_chunks()
+    assert all(chunk.summary for chunk in chunks)
+    assert simulator.stats.snapshot()["sum"]["200"] == len(chunks)
+
+
+def test_chapter_mode_gives_failed_openers_a_fallback(book, chat_server):
+    chat_server.replies = [(200, "no summary here")]
+    ChapterSummaryLoop(book=book, summary_handler=make_handler(chat_server.url)).run()
+    for chapter in book.get_chapters():
+        assert chapter.get_chunks()[0].summary == SUMMARY_CHAPTER_CONTEXT
+        assert all(chunk.summary for chunk in chapter.get_chunks())
+
+
+def test_chapter_mode_reconciles_entities_across_chapters(book, simulator):
+    ChapterSummaryLoop(book=book, summary_handler=make_handler(simulator.url)).run()
+    known = {}
+    for chapter in book.get_chapters():
+        for chunk in chapter.get_chunks():
+            assert known.keys() <= chunk.characters.keys()
+        for chunk in chapter.get_chunks():
+            known.update(chunk.characters)
+    assert known
+
+
+def test_map_reduce_merges_entities_in_book_order(book, simulator):
+    MapReduceSummaryLoop(book=book, summary_handler=make_handler(simulator.url)).run()
+    chunks = book.get_chunks()
+    assert all(chunk.summary for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous.characters.keys() <= chunk.characters.keys()
+    # One map call per chunk, and a stitch call for each one after the first
+    assert simulator.stats.snapshot()["sum"]["200"] == 2 * len(chunks) - 1
+
+
+def test_map_reduce_falls_back_when_the_first_chunk_fails(book, chat_server):
+    chat_server.replies = [(200, "no summary here")]
+    MapReduceSummaryLoop(
+        book=book, summary_handler=make_handler(chat_server.url), stitch=False
+    ).run()
+    assert all(chunk.summary == SUMMARY_MAP_CONTEXT for chunk in book.get_chunks())
+
+
+def test_loops_run_inside_an_event_loop(book, simulator):
+    async def handler():
+        MapReduceSummaryLoop(
+            book=book, summary_handler=make_handler(simulator.url)
+        ).run()
+
+    asyncio.run(handler())
+    assert all(chunk.summary for chunk in book.get_chunks())
+
+
+def test_compare_modes_starts_every_mode_over(simulator):
+    path = "./test_books/AF.epub"
+    timings = compare_modes(path, f"{simulator.url}/sum")
+    assert timings.keys() == {mode.value for mode in SummaryMode}
+    requests = simulator.stats.snapshot()["sum"]["200"]
+
+    # Saved summaries are cleared too, every mode asks for them again
+    timings = asyncio.run(acompare_modes(path, f"{simulator.url}/sum"))
+    assert timings.keys() == {mode.value for mode in SummaryMode}
+    assert simulator.stats.snapshot()["sum"]["200"] == 2 * requests
+
+
+def test_clear_sum_clears_the_saved_state(book):
+    chunk = book.get_chunks()[0]
+    chunk.set_sum(summary="old", characters={"Boxer": "A horse"}, places={})
+    chunk.clear_sum()
+    state = get_store().load_book_chunks(book.path_content)["1/1"]
+    assert (state["summary"], state["characters"]) == ("", {})
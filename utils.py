@@ -1,15 +1,20 @@
-from typing import List, Optional, Union, Tuple
-from huggingface_hub import login
-from transformers import AutoTokenizer
+from typing import ClassVar, Dict, List, Optional, Union, Tuple
+from tokenizers import Tokenizer as FastTokenizer
 from dataclasses import dataclass
 from logger_module import logger
 import os
+import re
+import shutil
+import threading
 import unicodedata
 import codecs
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Local copy of the model's tokenizer.json, fetched from the hub only if it is missing
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "./tokenizer/tokenizer.json")
+
 
 def normalize_text(text) -> str:
     # Decode all escape sequences (e.g., \n, \u3000, \xNN)
@@ -24,40 +29,107 @@ def normalize_text(text) -> str:
     return text
 
 
+def normalize_paragraphs(text) -> str:
+    """normalize_text on every line, keeping one newline between paragraphs"""
+    paragraphs = (normalize_text(line) for line in text.split("\n"))
+    return "\n".join(paragraph for paragraph in paragraphs if paragraph)
+
+
+# Where a sentence ends: closing punctuation before a space, a few closing
+# characters (quotes, brackets, also as normalize_text leaves them) allowed in between
+SENTENCE_END = re.compile(r"[.!?\u2026]\S{0,3}(?=\s)")
+
+
 @dataclass
 class Tokenizer:
+    """
+    The model's fast tokenizer, read from the local `path` the first time it
+    is used and then shared by the whole process.
+    """
+
     _instance = None  # Store the single instance
+    _loaded: ClassVar[Dict[str, FastTokenizer]] = {}
+    _lock: ClassVar[threading.Lock] = threading.Lock()
     api_key: Optional[str]
     model_name: str = "meta-llama/Llama-3.1-8B-Instruct"
+    path: str = TOKENIZER_PATH
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __post_init__(self):
-        hf_api = os.environ.get("HF_API")
-        if not hf_api:
-            raise Exception("HF_API for Tokenizer is Null")
-        try:
-            login(token=hf_api)
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                self.model_name, use_fast=True, trust_remote_code=True
-            )
-        except Exception as error:
-            logger.error(f"Error while downloading tokenizer, {error=}")
-        return self
+    @property
+    def tokenizer(self) -> FastTokenizer:
+        tokenizer = self._loaded.get(self.path)
+        if tokenizer is None:
+            with self._lock:
+                tokenizer = self._loaded.get(self.path)
+                if tokenizer is None:
+                    if not os.path.exists(self.path):
+                        self.download()
+                    try:
+                        tokenizer = FastTokenizer.from_file(self.path)
+                    except Exception as error:
+                        raise Exception(
+                            f"Could not load the tokenizer at {self.path}, {error}"
+                        ) from error
+                    self._loaded[self.path] = tokenizer
+                    logger.info(f"[Tokenizer] : Loaded {self.path}")
+        return tokenizer
+
+    def check(self) -> None:
+        """Raises if the tokenizer can not be had, without loading it"""
+        if self.path in self._loaded or os.path.exists(self.path):
+            return
+        if not (self.api_key or os.environ.get("HF_API")):
+            raise Exception(f"{self.path} is missing and HF_API is not set")
+
+    def download(self) -> None:
+        """One time fetch of tokenizer.json from the hub into `path`"""
+        from huggingface_hub import hf_hub_download
+
+        self.check()
+        hf_api = self.api_key or os.environ.get("HF_API")
+        logger.info(f"[Tokenizer] : Downloading tokenizer of {self.model_name}")
+        cached = hf_hub_download(self.model_name, "tokenizer.json", token=hf_api)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        shutil.copyfile(cached, self.path)
 
     def tokenize(self, text: str) -> Tuple[int, List[int]]:
+        # A missing tokenizer raises, chunks and budgets would silently be empty
+        tokenizer = self.tokenizer
         try:
-            tokens: List[int] = self.tokenizer.encode(
-                text, add_special_tokens=False, truncation=False
-            )
+            tokens: List[int] = tokenizer.encode(text, add_special_tokens=False).ids
         except Exception as error:
             logger.warning(f"Error while counting token, {error=}")
             return 0, []
         return len(tokens), tokens
 
+    def tokenize_offsets(self, text: str) -> Tuple[int, List[Tuple[int, int]]]:
+        """(start, end) character offsets of every token of `text`"""
+        tokenizer = self.tokenizer
+        try:
+            offsets: List[Tuple[int, int]] = tokenizer.encode(
+                text, add_special_tokens=False
+            ).offsets
+        except Exception as error:
+            logger.warning(f"Error while counting token, {error=}")
+            return 0, []
+        return len(offsets), offsets
+
+    def tokenize_offsets_batch(
+        self, texts: List[str]
+    ) -> List[Tuple[int, List[Tuple[int, int]]]]:
+        """tokenize_offsets for many texts in one call, encoded in parallel by the Rust side"""
+        tokenizer = self.tokenizer
+        try:
+            encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+        except Exception as error:
+            logger.warning(f"Error while counting token, {error=}")
+            return [self.tokenize_offsets(text) for text in texts]
+        return [(len(encoding.offsets), encoding.offsets) for encoding in encodings]
+
     def detokenize(self, tokens: List[int]) -> Optional[str]:
         try:
             decoded_text = self.tokenizer.decode(tokens)
@@ -71,6 +143,9 @@ class Chunker:
     _instance = None  # Store the single instance
     max_len: int
     tokenizer: Tokenizer
+    overlap: int = 0  # tokens of the previous chunk repeated at the start of the next
+    snap: bool = True  # end chunks at paragraph/sentence ends when possible
+    min_fill: float = 0.5  # a snapped chunk keeps at least this share of max_len
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -81,25 +156,115 @@ class Chunker:
         """
         Splits text into chunks that do not exceed the token limit.
 
+        Chunks are sliced out of the text at token offsets, nothing is decoded.
+        With `snap`, a chunk ends at the last paragraph end within its budget,
+        else at the last sentence end, and only cuts mid-sentence when neither
+        is past `min_fill` of the budget. With `overlap`, the next chunk starts
+        up to `overlap` tokens earlier, at a sentence start when there is one.
+
         -> List[str]
         """
-        total_chunks = []
+        clean_text = self.normalize(str_content)
+        num_tokens, offsets = self.tokenizer.tokenize_offsets(clean_text)
+        return self.split(clean_text, offsets)
+
+    def chunk_batch(self, str_contents: List[str]) -> List[List[str]]:
+        """`chunk` for many texts (a book's chapters), tokenized in one batch"""
+        clean_texts = [self.normalize(str_content) for str_content in str_contents]
+        return [
+            self.split(clean_text, offsets)
+            for clean_text, (_, offsets) in zip(
+                clean_texts, self.tokenizer.tokenize_offsets_batch(clean_texts)
+            )
+        ]
 
-        clean_text = normalize_text(str_content)
-        if clean_text is not None:
-            num_tokens, tokens = self.tokenizer.tokenize(clean_text)
+    def normalize(self, str_content: str) -> str:
+        if self.snap:
+            clean_text = normalize_paragraphs(str_content)
         else:
+            clean_text = normalize_text(str_content)
+        if clean_text is None:
             raise Exception("normalize_text raised an error")
-        start, count = 0, 1
+        return clean_text
+
+    def split(self, clean_text: str, offsets: List[Tuple[int, int]]) -> List[str]:
+        """Cuts `clean_text` into chunks, given the offsets of its tokens"""
+        total_chunks: List[str] = []
+        num_tokens = len(offsets)
+        if not num_tokens:
+            return total_chunks
+
+        last_paragraph, last_sentence, next_sentence = self.boundaries(
+            clean_text, offsets
+        )
+        min_len = max(1, int(self.max_len * self.min_fill))
+        overlap = min(self.overlap, min_len - 1)
+        start = 0
         while start < num_tokens:
-            chunk_tokens = tokens[start : start + self.max_len]
-            chunk_text = self.tokenizer.detokenize(chunk_tokens)
-            total_chunks.append(chunk_text)
-            count += 1
-            start += self.max_len  # Move to next chunk
+            end = start + self.max_len
+            if end >= num_tokens:
+                end = num_tokens
+            elif self.snap:
+                if last_paragraph[end] >= start + min_len:
+                    end = last_paragraph[end]
+                elif last_sentence[end] >= start + min_len:
+                    end = last_sentence[end]
+            # A chunk runs up to where the next one's first token starts
+            char_start = offsets[start][0] if start else 0
+            char_end = offsets[end][0] if end < num_tokens else len(clean_text)
+            total_chunks.append(clean_text[char_start:char_end].strip())
+            if end == num_tokens:
+                break
+            next_start = end - overlap
+            if overlap and next_sentence[next_start] < end:
+                next_start = next_sentence[next_start]
+            start = max(next_start, start + 1)
         return total_chunks
 
+    def boundaries(
+        self, text: str, offsets: List[Tuple[int, int]]
+    ) -> Tuple[List[int], List[int], List[int]]:
+        """
+        For every token index i, in one pass over the text and tokens:
+        the last token <= i starting a paragraph, the last token <= i starting
+        a sentence, and the first token >= i starting a sentence (len(offsets)
+        if none). Paragraph starts count as sentence starts.
+        """
+        num_tokens = len(offsets)
+        # Boundaries sit on the whitespace, which byte-level tokens carry at their start
+        paragraph_chars = [idx for idx, char in enumerate(text) if char == "\n"]
+        sentence_chars = sorted(
+            set(paragraph_chars + [m.end() for m in SENTENCE_END.finditer(text)])
+        )
+
+        def token_starts(chars: List[int]) -> List[bool]:
+            starts = [False] * (num_tokens + 1)
+            token = 0
+            for char in chars:
+                while token < num_tokens and offsets[token][0] < char:
+                    token += 1
+                starts[token] = True
+            return starts
+
+        paragraph_starts = token_starts(paragraph_chars)
+        sentence_starts = token_starts(sentence_chars)
+
+        last_paragraph = [0] * (num_tokens + 1)
+        last_sentence = [0] * (num_tokens + 1)
+        for idx in range(1, num_tokens + 1):
+            last_paragraph[idx] = (
+                idx if paragraph_starts[idx] else last_paragraph[idx - 1]
+            )
+            last_sentence[idx] = idx if sentence_starts[idx] else last_sentence[idx - 1]
+        next_sentence = [num_tokens] * (num_tokens + 1)
+        for idx in range(num_tokens - 1, -1, -1):
+            next_sentence[idx] = idx if sentence_starts[idx] else next_sentence[idx + 1]
+        return last_paragraph, last_sentence, next_sentence
+
 
-def get_chunker(max_len):
+def get_chunker(max_len, overlap: int = 0, snap: bool = True):
     tokenizer = Tokenizer(os.environ.get("HF_API"))
-    return Chunker(max_len=max_len, tokenizer=tokenizer)
+    # Loaded on first use, but a missing one fails the book before any chapter
+    # is chunked (a lazy book chunks them later, in the pipeline's threads)
+    tokenizer.check()
+    return Chunker(max_len=max_len, tokenizer=tokenizer, overlap=overlap, snap=snap)